@@ -0,0 +1,344 @@
+'''
+Local stand-in for the parts of Discord the cogs touch: bot, guild,
+members, roles, channels and messages. Every outbound call goes through
+FakeAPI, which adds simulated latency and Discord-like rate limits (a
+limited call waits for its bucket to reset, the way discord.py handles a
+429) and counts what was called. Nothing here touches the network.
+'''
+import asyncio
+import itertools
+import random
+import types
+import discord
+from discord.ext import commands
+import pesukarhu.clock
+
+class FakeAPI():
+    '''
+    Simulated REST API. latency is the mean round trip in seconds; each call
+    gets +-50% jitter from a seeded RNG so runs are repeatable. Latency and
+    rate limit waits run on clock, so they speed up with a replay's.
+    '''
+    # bucket prefix -> (requests, per seconds), roughly Discord's limits
+    limits = {
+        'send': (5, 5.0), # per channel
+        'edit': (5, 5.0), # per channel
+        'reaction': (1, 0.25), # per channel
+        'create_dm': (50, 1.0),
+        'roles': (10, 1.0), # per guild
+        'kick': (10, 1.0), # per guild
+        'ban': (10, 1.0), # per guild
+        'create_channel': (2, 10.0), # per guild
+        'permissions': (5, 5.0), # per channel
+        'fetch_member': (10, 1.0),
+        'delete_channel': (5, 5.0),
+    }
+
+    def __init__(self, latency=0.05, seed=0, rate_limits=True):
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.rate_limits = rate_limits
+        self.buckets = {}
+        self.locks = {}
+        self.calls = {}
+        self.rate_limited = {}
+        self.ids = itertools.count(10**17)
+        self.clock = pesukarhu.clock.Clock()
+
+    def next_id(self):
+        return next(self.ids)
+
+    async def call(self, route, bucket=None):
+        self.calls[route] = self.calls.get(route, 0) + 1
+        key = route if bucket is None else f'{route}:{bucket}'
+        # Like discord.py, hold a lock per bucket for the whole request, so
+        # requests on one bucket go out one at a time in the order made
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        async with self.locks[key]:
+            if self.rate_limits:
+                await self.wait_for_bucket(route, key)
+            if(self.latency > 0):
+                await self.clock.sleep(self.latency * self.random.uniform(0.5, 1.5))
+
+    async def wait_for_bucket(self, route, key):
+        requests, period = self.limits.get(route, (50, 1.0))
+        while True:
+            now = self.clock.monotonic()
+            remaining, reset = self.buckets.get(key, (requests, now + period))
+            if(now >= reset):
+                remaining, reset = requests, now + period
+            if(remaining > 0):
+                self.buckets[key] = (remaining - 1, reset)
+                return
+            # This is where Discord would answer 429; discord.py sleeps until
+            # the bucket resets and retries. Nothing is written back here; a
+            # stale write from a waiter would hand out a fresh bucket early
+            self.rate_limited[route] = self.rate_limited.get(route, 0) + 1
+            await self.clock.sleep(reset - now)
+
+class FakeRole():
+    def __init__(self, guild, id, name):
+        self.guild = guild
+        self.id = id
+        self.name = name
+        self.mention = f'<@&{id}>'
+
+    @property
+    def members(self):
+        return [member for member in self.guild.members if self in member.roles]
+
+    def is_default(self):
+        return self.id == self.guild.id
+
+class FakeMessage():
+    def __init__(self, api, channel, author, content, id=None, embed=None):
+        self.api = api
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.id = api.next_id() if id is None else id
+        self.embed = embed
+        self.reactions = []
+
+    async def add_reaction(self, emoji):
+        await self.api.call('reaction', self.channel.id)
+        self.reactions.append(emoji)
+
+    async def remove_reaction(self, emoji, member):
+        await self.api.call('reaction', self.channel.id)
+
+    async def clear_reactions(self):
+        await self.api.call('reaction', self.channel.id)
+        self.reactions = []
+
+    async def edit(self, content=None, embed=None):
+        await self.api.call('edit', self.channel.id)
+        self.content = content
+        self.embed = embed
+
+class FakeTextChannel(discord.TextChannel):
+    '''
+    Subclasses TextChannel so the cogs' isinstance checks pass; none of the
+    real constructor's gateway state is needed.
+    '''
+    def __init__(self, api, guild, id, name):
+        self.api = api
+        self.guild = guild
+        self.id = id
+        self.name = name
+        self.overwrites_set = {}
+        self.sent = 0
+
+    def __repr__(self):
+        return f'<FakeTextChannel id={self.id} name={self.name!r}>'
+
+    async def send(self, content=None, embed=None):
+        await self.api.call('send', self.id)
+        self.sent += 1
+        return FakeMessage(self.api, self, self.guild.me, content, embed=embed)
+
+    async def set_permissions(self, target, **permissions):
+        await self.api.call('permissions', self.id)
+        self.overwrites_set[getattr(target, 'id', None)] = permissions
+
+    async def delete(self, reason=None):
+        await self.api.call('delete_channel', self.guild.id)
+        self.guild.channels.pop(self.id, None)
+
+    async def edit(self, **options):
+        await self.api.call('edit', self.id)
+        if 'name' in options:
+            self.name = options['name']
+
+class FakeDMChannel():
+    def __init__(self, api, member):
+        self.api = api
+        self.id = api.next_id()
+        self.member = member
+
+    async def send(self, content=None, embed=None):
+        await self.api.call('send', self.id)
+        return FakeMessage(self.api, self, None, content)
+
+class FakeMember():
+    def __init__(self, api, guild, id, name, roles=None, bot=False):
+        self.api = api
+        self.guild = guild
+        self.id = id
+        self.name = name
+        self.nick = None
+        self.display_name = name
+        self.bot = bot
+        self.roles = [] if roles is None else list(roles)
+        self.avatar_url = ''
+        self.mention = f'<@{id}>'
+        self.dm_channel = None
+
+    async def create_dm(self):
+        await self.api.call('create_dm')
+        if self.dm_channel is None:
+            self.dm_channel = FakeDMChannel(self.api, self)
+        return self.dm_channel
+
+    async def send(self, content=None, embed=None):
+        channel = await self.create_dm()
+        return await channel.send(content, embed=embed)
+
+    async def add_roles(self, *roles, reason=None):
+        await self.api.call('roles', self.guild.id)
+        for role in roles:
+            if role not in self.roles:
+                self.roles.append(role)
+
+    async def remove_roles(self, *roles, reason=None):
+        await self.api.call('roles', self.guild.id)
+        self.roles = [role for role in self.roles if role not in roles]
+
+class FakeGuild():
+    def __init__(self, api, id, name='Benchmark Guild'):
+        self.api = api
+        self.id = id
+        self.name = name
+        self.roles = {id: FakeRole(self, id, '@everyone')}
+        self.channels = {}
+        self.member_map = {}
+        self.chunked = True
+        self.me = FakeMember(api, self, api.next_id(), 'pesukarhu', bot=True)
+        self.kicked = []
+        self.banned = []
+
+    @property
+    def members(self):
+        return list(self.member_map.values())
+
+    def add_role(self, id, name):
+        self.roles[id] = FakeRole(self, id, name)
+        return self.roles[id]
+
+    def add_channel(self, id, name):
+        self.channels[id] = FakeTextChannel(self.api, self, id, name)
+        return self.channels[id]
+
+    def add_member(self, id, name, roles=None, bot=False):
+        self.member_map[id] = FakeMember(self.api, self, id, name, roles, bot)
+        return self.member_map[id]
+
+    def get_member(self, id):
+        return self.member_map.get(id)
+
+    async def fetch_member(self, id):
+        await self.api.call('fetch_member')
+        member = self.member_map.get(id)
+        if member is None:
+            raise discord.NotFound(types.SimpleNamespace(status=404, reason='Not Found'), 'Unknown Member')
+        return member
+
+    def get_role(self, id):
+        return self.roles.get(id)
+
+    def get_channel(self, id):
+        return self.channels.get(id)
+
+    async def chunk(self):
+        self.chunked = True
+        return self.members
+
+    async def create_text_channel(self, name, overwrites=None, category=None, reason=None):
+        await self.api.call('create_channel', self.id)
+        channel = self.add_channel(self.api.next_id(), name)
+        if overwrites is not None:
+            for target, overwrite in overwrites.items():
+                channel.overwrites_set[getattr(target, 'id', None)] = overwrite
+        return channel
+
+    async def kick(self, member, reason=None):
+        await self.api.call('kick', self.id)
+        self.kicked.append(member.id)
+        self.member_map.pop(member.id, None)
+
+    async def ban(self, member, reason=None):
+        await self.api.call('ban', self.id)
+        self.banned.append(member.id)
+        self.member_map.pop(member.id, None)
+
+class FakeBot(commands.Bot):
+    '''
+    commands.Bot that never connects. Cogs are added the normal way; the
+    guild and channels come from FakeGuild instead of the gateway cache.
+    Has to be created inside a running event loop.
+    '''
+    def __init__(self, api, guild, **options):
+        super().__init__(command_prefix='$', intents=discord.Intents.all(), **options)
+        self.api = api
+        self.fake_guild = guild
+        self.fake_user = guild.me
+
+    @property
+    def user(self):
+        return self.fake_user
+
+    def is_ready(self):
+        return True
+
+    async def wait_until_ready(self):
+        return
+
+    def get_guild(self, id):
+        if(id == self.fake_guild.id):
+            return self.fake_guild
+        return None
+
+    def get_channel(self, id):
+        channel = self.fake_guild.get_channel(id)
+        if channel is None:
+            # Channels configured in settings but not set up by the scenario
+            channel = self.fake_guild.add_channel(id, f'channel-{id}')
+        return channel
+
+def reaction_payload(guild, member, message_id, emoji):
+    '''
+    Minimal stand-in for discord.RawReactionActionEvent
+    '''
+    return types.SimpleNamespace(member=member, user_id=member.id, guild_id=guild.id,
+                                 message_id=message_id, channel_id=None,
+                                 emoji=types.SimpleNamespace(name=emoji))
+
+def member_payload(guild_id, id, name, role_ids=()):
+    '''
+    GUILD_MEMBER_ADD / chunk style member data for a real discord.py
+    ConnectionState
+    '''
+    return {
+        'guild_id': str(guild_id),
+        'user': {'id': str(id), 'username': name, 'discriminator': f'{id % 10000:04d}', 'avatar': None},
+        'roles': [str(role_id) for role_id in role_ids],
+        'joined_at': '2021-06-01T00:00:00+00:00',
+        'nick': None,
+        'deaf': False,
+        'mute': False,
+    }
+
+def presence_payload(id):
+    return {
+        'user': {'id': str(id)},
+        'status': 'online',
+        'client_status': {'desktop': 'online'},
+        'activities': [{'name': 'Personal Finance', 'type': 0}],
+    }
+
+def guild_payload(id, members=(), presences=()):
+    '''
+    GUILD_CREATE data with the given member and presence payloads
+    '''
+    return {
+        'id': str(id),
+        'name': 'Benchmark Guild',
+        'member_count': max(len(members), 250),
+        'roles': [{'id': str(id), 'name': '@everyone', 'permissions': '0', 'position': 0, 'color': 0,
+                   'hoist': False, 'managed': False, 'mentionable': False}],
+        'channels': [],
+        'emojis': [],
+        'members': list(members),
+        'presences': list(presences),
+    }
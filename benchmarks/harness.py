@@ -0,0 +1,224 @@
+'''
+Sets up the cogs against the fake Discord layer and measures them:
+per-handler latency percentiles, event loop lag and peak memory.
+'''
+import os
+import time
+import asyncio
+import resource
+import tempfile
+import tracemalloc
+import yaml
+import benchmarks.fake_discord
+import pesukarhu.message_dispatch
+import pesukarhu.action_queue
+import pesukarhu.member_monitor
+import pesukarhu.emoji_replace
+import pesukarhu.intro_bot
+
+# IDs the fake guild is built with
+GUILD_ID = 1000
+ADMIN_ROLE_ID = 1001
+VERIFIED_ROLE_ID = 1002
+UNVERIFIED_ROLE_ID = 1003
+WARNING_ROLE_ID = 1004
+VERIFIER_ROLE_ID = 1005
+QUARANTINE_ROLE_ID = 1006
+LOG_CHANNEL_ID = 2001
+WARNING_CHANNEL_ID = 2002
+GENERAL_CHANNEL_ID = 2003
+INTRO_MESSAGE_ID = 3001
+
+def percentile(samples, fraction):
+    if(len(samples) == 0):
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class Timings():
+    '''
+    Latency samples (seconds) by handler name
+    '''
+    def __init__(self):
+        self.samples = {}
+
+    def record(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    async def timed(self, name, coro):
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def wrap(self, name, handler):
+        async def timed_handler(*args, **kwargs):
+            return await self.timed(name, handler(*args, **kwargs))
+        return timed_handler
+
+    def summary(self):
+        summary = {}
+        for name, samples in self.samples.items():
+            summary[name] = {
+                'count': len(samples),
+                'p50_ms': percentile(samples, 0.50) * 1000,
+                'p90_ms': percentile(samples, 0.90) * 1000,
+                'p99_ms': percentile(samples, 0.99) * 1000,
+                'max_ms': max(samples) * 1000,
+            }
+        return summary
+
+class LoopLagMonitor():
+    '''
+    Wakes every interval and records how late it woke up - the time the
+    loop spent busy with something else
+    '''
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self.task = None
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self):
+        self.task = asyncio.get_event_loop().create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def summary(self):
+        return {
+            'p50_ms': percentile(self.samples, 0.50) * 1000,
+            'p99_ms': percentile(self.samples, 0.99) * 1000,
+            'max_ms': (max(self.samples) if self.samples else 0.0) * 1000,
+        }
+
+class Environment():
+    '''
+    A fake guild with the bot's roles and channels, a FakeBot carrying the
+    real cogs, and the measurement hooks. Settings, state files and the
+    state database live in a throwaway directory, and the environment
+    variables set for the cogs are put back by close(). Create inside a
+    running event loop.
+    '''
+    def __init__(self, latency=0.05, rate_limits=True, seed=0, trace_memory=False, env=None):
+        self.workdir = tempfile.TemporaryDirectory(prefix='pesukarhu-bench-')
+        self.saved_environ = dict(os.environ)
+        self.configure(env)
+        self.trace_memory = trace_memory
+        if self.trace_memory:
+            tracemalloc.start()
+        self.start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.api = benchmarks.fake_discord.FakeAPI(latency=latency, seed=seed, rate_limits=rate_limits)
+        self.guild = benchmarks.fake_discord.FakeGuild(self.api, GUILD_ID)
+        self.roles = {}
+        for id, name in ((ADMIN_ROLE_ID, 'Admin'), (VERIFIED_ROLE_ID, 'Verified'), (UNVERIFIED_ROLE_ID, 'Unverified'),
+                         (WARNING_ROLE_ID, 'Warning'), (VERIFIER_ROLE_ID, 'Verifier'),
+                         (QUARANTINE_ROLE_ID, 'Quarantine')):
+            self.roles[id] = self.guild.add_role(id, name)
+        for id, name in ((LOG_CHANNEL_ID, 'log'), (WARNING_CHANNEL_ID, 'warnings'), (GENERAL_CHANNEL_ID, 'general')):
+            self.guild.add_channel(id, name)
+        self.bot = benchmarks.fake_discord.FakeBot(self.api, self.guild)
+        self.timings = Timings()
+        self.loop_lag = LoopLagMonitor()
+        self.dispatcher = None
+        self.monitor = None
+        self.emoji_replace = None
+        self.intro_bot = None
+
+    def configure(self, env):
+        values = {
+            'PESUKARHU_GUILD': GUILD_ID,
+            'PESUKARHU_ADMIN_ROLE': ADMIN_ROLE_ID,
+            'PESUKARHU_LOG_CHANNEL': LOG_CHANNEL_ID,
+            'PESUKARHU_WARNING_CHANNEL': WARNING_CHANNEL_ID,
+            'PESUKARHU_VERIFIED_ROLE_ID': VERIFIED_ROLE_ID,
+            'PESUKARHU_UNVERIFIED_ROLE_ID': UNVERIFIED_ROLE_ID,
+            'PESUKARHU_WARNING_ROLE_ID': WARNING_ROLE_ID,
+            'PESUKARHU_MEMBER_REFRESH_PERIOD': 1.0,
+            'PESUKARHU_UNVERIFIED_WARN_DELAY': 5.0,
+            'PESUKARHU_UNVERIFIED_KICK_DELAY': 10.0,
+            'PESUKARHU_RETENTION_TIME': 5.0,
+            'PESUKARHU_RAID_DETECTION_WINDOW': 120.0,
+            'PESUKARHU_RAID_DETECTION_LEVEL': 50,
+            'PESUKARHU_RAID_QUARANTINE_ROLE_ID': QUARANTINE_ROLE_ID,
+            'PESUKARHU_STATE_DB': os.path.join(self.workdir.name, 'state.db'),
+        }
+        if env is not None:
+            values.update(env)
+        self.set_env(values)
+        # IntroBot reads its settings and state from the working directory
+        repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with open(os.path.join(repo, 'intro_bot_settings.yaml'), 'r') as stream:
+            settings = yaml.safe_load(stream)
+        settings['guild'] = GUILD_ID
+        settings['log_channel'] = LOG_CHANNEL_ID
+        settings['warning_channel'] = WARNING_CHANNEL_ID
+        settings['verifier_role'] = VERIFIER_ROLE_ID
+        # Scenarios that expire tickets (PESUKARHU_INTRO_EXPIRE_TICKETS=1)
+        # get the shortest timeout expiry allows
+        settings['timeout_offset'] = 3600
+        self.previous_cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+        with open('intro_bot_settings.yaml', 'w') as stream:
+            yaml.dump(settings, stream)
+        with open('intro_bot_state.yaml', 'w') as stream:
+            yaml.dump({'intro_id': INTRO_MESSAGE_ID, 'ticket_count': 0}, stream)
+
+    def set_env(self, values):
+        # Read by the cogs when they're added; undone by close()
+        for key, value in values.items():
+            os.environ[key] = str(value)
+
+    def add_cogs(self, monitor=True, emoji_replace=True, intro_bot=True):
+        self.dispatcher = pesukarhu.message_dispatch.MessageDispatch(self.bot)
+        self.bot.add_cog(self.dispatcher)
+        self.bot.add_cog(pesukarhu.action_queue.ActionQueue(self.bot))
+        if monitor:
+            self.monitor = pesukarhu.member_monitor.MemberMonitor(self.bot)
+            self.bot.add_cog(self.monitor)
+        if emoji_replace:
+            self.emoji_replace = pesukarhu.emoji_replace.EmojiReplace(self.bot)
+            self.bot.add_cog(self.emoji_replace)
+        if intro_bot:
+            self.intro_bot = pesukarhu.intro_bot.IntroBot(self.bot)
+            self.bot.add_cog(self.intro_bot)
+        # Time every message handler the way the dispatcher runs it
+        for subscription in self.dispatcher.subscriptions:
+            subscription.handler = self.timings.wrap(f'{subscription.name}.handle_message', subscription.handler)
+        self.loop_lag.start()
+
+    def close(self):
+        self.loop_lag.stop()
+        for name in list(self.bot.cogs):
+            self.bot.remove_cog(name)
+        store = getattr(self.bot, 'pesukarhu_state_store', None)
+        if store is not None:
+            store.close()
+        os.chdir(self.previous_cwd)
+        self.workdir.cleanup()
+        os.environ.clear()
+        os.environ.update(self.saved_environ)
+
+    def report(self):
+        report = {
+            'handlers': self.timings.summary(),
+            'loop_lag': self.loop_lag.summary(),
+            'api_calls': dict(sorted(self.api.calls.items())),
+            'rate_limited': dict(sorted(self.api.rate_limited.items())),
+            # ru_maxrss is the process high water mark in KiB on Linux, so
+            # only its growth since the environment was set up belongs to
+            # this scenario - and none of a peak an earlier one already set
+            'rss_growth_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - self.start_rss) / 1024,
+        }
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            report['peak_traced_mb'] = peak / (1024 * 1024)
+            tracemalloc.stop()
+        return report
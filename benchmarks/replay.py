@@ -0,0 +1,112 @@
+'''
+Feeds the events of a gateway recording (see pesukarhu.recorder) to the
+cogs in a harness Environment, standing in fake members, channels and
+messages for the anonymized IDs.
+'''
+import types
+import asyncio
+import benchmarks.fake_discord
+import benchmarks.harness as harness
+
+ROLES = {
+    'admin': harness.ADMIN_ROLE_ID,
+    'verified': harness.VERIFIED_ROLE_ID,
+    'unverified': harness.UNVERIFIED_ROLE_ID,
+    'warning': harness.WARNING_ROLE_ID,
+    'quarantine': harness.QUARANTINE_ROLE_ID,
+}
+CHANNELS = {
+    'log': harness.LOG_CHANNEL_ID,
+    'warning': harness.WARNING_CHANNEL_ID,
+}
+
+class Replayer():
+    '''
+    Applies recorded events, calling the cog listeners the way discord.py
+    dispatches gateway events - each in a task of its own, so one waiting
+    on the API doesn't hold up the next - and timing each one. Members and
+    channels seen for the first time without a join are taken to have been
+    there all along. Messages in a ticket go to whichever ticket the replay opened
+    for its owner; ones for a ticket it doesn't have are skipped.
+    '''
+    def __init__(self, env):
+        self.env = env
+        self.guild = env.guild
+        self.accounts = {}
+        self.events = {}
+        self.skipped = 0
+        self.pending = set()
+        self.handlers = {
+            'm': self.message,
+            'j': self.join,
+            'r': self.remove,
+            'u': self.update,
+            'a': self.reaction,
+        }
+
+    def get_roles(self, names):
+        return [self.env.roles[ROLES[name]] for name in names if name in ROLES]
+
+    def get_member(self, id, roles=()):
+        member = self.guild.get_member(id)
+        if member is None:
+            member = self.accounts.get(id)
+        if member is None:
+            member = benchmarks.fake_discord.FakeMember(self.env.api, self.guild, id, f'member{id % 100000}',
+                                                        roles=self.get_roles(roles))
+            self.accounts[id] = member
+            self.guild.member_map[id] = member
+        return member
+
+    def get_channel(self, channel):
+        if isinstance(channel, str):
+            return self.guild.get_channel(CHANNELS[channel])
+        return self.guild.get_channel(channel) or self.guild.add_channel(channel, f'channel-{channel % 100000}')
+
+    def apply(self, kind, fields):
+        handler = self.handlers.get(kind)
+        if handler is None:
+            self.skipped += 1
+            return
+        self.events[kind] = self.events.get(kind, 0) + 1
+        task = asyncio.ensure_future(handler(*fields))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def message(self, channel, author, content, owner=None):
+        if(channel == 'ticket'):
+            ticket = self.env.intro_bot.log.log.get(owner)
+            if ticket is None:
+                self.skipped += 1
+                return
+            target = self.guild.get_channel(ticket.channel)
+        else:
+            target = self.get_channel(channel)
+        message = benchmarks.fake_discord.FakeMessage(self.env.api, target, self.get_member(author), content)
+        await self.env.timings.timed('MessageDispatch.on_message', self.env.dispatcher.on_message(message))
+
+    async def join(self, id, roles):
+        member = self.accounts.get(id)
+        if member is None:
+            member = self.get_member(id, roles)
+        else:
+            # Back after leaving
+            member.roles = self.get_roles(roles)
+            self.guild.member_map[id] = member
+        await self.env.timings.timed('MemberMonitor.on_member_join', self.env.monitor.on_member_join(member))
+
+    async def remove(self, id):
+        member = self.get_member(id)
+        self.guild.member_map.pop(id, None)
+        await self.env.timings.timed('MemberMonitor.on_member_remove', self.env.monitor.on_member_remove(member))
+
+    async def update(self, id, before_roles, after_roles):
+        member = self.get_member(id, before_roles)
+        before = types.SimpleNamespace(roles=self.get_roles(before_roles))
+        member.roles = self.get_roles(after_roles)
+        await self.env.timings.timed('MemberMonitor.on_member_update', self.env.monitor.on_member_update(before, member))
+
+    async def reaction(self, id, message, emoji):
+        message_id = harness.INTRO_MESSAGE_ID if message == 'intro' else message
+        payload = benchmarks.fake_discord.reaction_payload(self.guild, self.get_member(id), message_id, emoji)
+        await self.env.timings.timed('IntroBot.on_raw_reaction_add', self.env.intro_bot.on_raw_reaction_add(payload))
@@ -0,0 +1,123 @@
+'''
+Offline benchmark / load test for the cogs. Runs each scenario against the
+fake Discord layer in benchmarks.fake_discord and prints per-handler
+latency percentiles, event loop lag, outbound API calls (and how many hit
+a rate limit) and how much the peak RSS of the process grew during the
+scenario. No token or network access needed.
+
+    python -m benchmarks.run                      # every scenario
+    python -m benchmarks.run join_raid --members 2000 --latency 0.02
+    python -m benchmarks.run chat_firehose --json results.json
+    python -m benchmarks.run member_cache --members 50000   # full vs lean gateway profile
+    python -m benchmarks.run replay --recording events.jsonl.gz --speed 10 --env-file .env
+'''
+import argparse
+import asyncio
+import json
+import logging
+import dotenv
+import benchmarks.harness
+import benchmarks.scenarios
+import pesukarhu.structured_logging
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the pesukarhu cogs')
+    parser.add_argument('scenarios', nargs='*',
+                        help=f'scenarios to run: {", ".join(benchmarks.scenarios.SCENARIOS)} (default: all)')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean simulated API round trip (seconds)')
+    parser.add_argument('--no-rate-limits', action='store_true', help='disable simulated rate limits')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace-memory', action='store_true', help='report peak traced Python memory (slows the run)')
+    parser.add_argument('--members', type=int, default=10000, help='join_raid, virtual_day: accounts joining, member_cache: accounts already in the guild, status_views: listed members')
+    parser.add_argument('--joins', type=int, default=1000, help='member_cache: accounts joining while the bot runs')
+    parser.add_argument('--join-rate', type=float, default=0, help='join_raid: joins per second, 0 for as fast as possible')
+    parser.add_argument('--raid-action', default='none', help='join_raid: none, quarantine, kick or ban')
+    parser.add_argument('--tickets', type=int, default=1000, help='intro_tickets: concurrent tickets')
+    parser.add_argument('--rate', type=float, default=500, help='chat_firehose: messages per second')
+    parser.add_argument('--seconds', type=float, default=10.0, help='chat_firehose: duration')
+    parser.add_argument('--hours', type=float, default=24.0, help='virtual_day: simulated hours of joins')
+    parser.add_argument('--recording', help='replay: recording made with PESUKARHU_RECORD_FILE')
+    parser.add_argument('--speed', type=float, default=0.0, help='replay: times real time, 0 for as fast as possible on a virtual clock')
+    parser.add_argument('--env-file', help='settings to run the cogs with, eg the bot\'s .env; the fake guild keeps its own IDs')
+    parser.add_argument('--timeout', type=float, default=60.0, help='longest a scenario waits for outstanding work')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the bot\'s own logging')
+    return parser.parse_args()
+
+def scenario_options(name, args):
+    if(name == 'join_raid'):
+        return {'members': args.members, 'join_rate': args.join_rate, 'drain_timeout': args.timeout}
+    if(name == 'intro_tickets'):
+        return {'tickets': args.tickets, 'timeout': args.timeout}
+    if(name == 'chat_firehose'):
+        return {'rate': args.rate, 'seconds': args.seconds, 'seed': args.seed}
+    if(name == 'member_cache'):
+        return {'members': args.members, 'joins': args.joins}
+    if(name == 'status_views'):
+        return {'members': args.members}
+    if(name == 'virtual_day'):
+        return {'members': args.members, 'hours': args.hours, 'seed': args.seed}
+    if(name == 'replay'):
+        return {'recording': args.recording, 'speed': args.speed, 'drain_timeout': args.timeout}
+    return {}
+
+def read_env_file(path):
+    '''
+    Settings from a .env file, less the IDs, token and files the harness
+    sets up itself
+    '''
+    owned = ('_GUILD', '_ROLE', '_ROLE_ID', '_CHANNEL', '_TOKEN', '_STATE_DB', '_RECORD_FILE')
+    return {key: value for key, value in dotenv.dotenv_values(path).items()
+            if (value is not None) and (not key.endswith(owned))}
+
+async def run_scenario(name, args):
+    settings = {'PESUKARHU_RAID_ACTION': args.raid_action}
+    if args.env_file is not None:
+        settings.update(read_env_file(args.env_file))
+    env = benchmarks.harness.Environment(latency=args.latency, rate_limits=not args.no_rate_limits,
+                                         seed=args.seed, trace_memory=args.trace_memory, env=settings)
+    try:
+        result = await benchmarks.scenarios.SCENARIOS[name](env, **scenario_options(name, args))
+        report = env.report()
+        report['result'] = result
+        return report
+    finally:
+        env.close()
+        # Let the cancelled workers unwind before the loop closes
+        await asyncio.sleep(0.1)
+
+def print_report(name, report):
+    print(f'== {name}')
+    for key, value in report['result'].items():
+        print(f'   {key}: {value if not isinstance(value, float) else round(value, 3)}')
+    print(f'   {"handler":<40} {"count":>8} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+    for handler, stats in report['handlers'].items():
+        print(f'   {handler:<40} {stats["count"]:>8} {stats["p50_ms"]:>9.2f} {stats["p90_ms"]:>9.2f} {stats["p99_ms"]:>9.2f} {stats["max_ms"]:>9.2f}')
+    lag = report['loop_lag']
+    print(f'   event loop lag: p50 {lag["p50_ms"]:.2f} ms, p99 {lag["p99_ms"]:.2f} ms, max {lag["max_ms"]:.2f} ms')
+    print(f'   api calls: {report["api_calls"]}')
+    print(f'   rate limited: {report["rate_limited"]}')
+    memory = f'   rss high water growth: {report["rss_growth_mb"]:.1f} MB'
+    if 'peak_traced_mb' in report:
+        memory += f', peak traced: {report["peak_traced_mb"]:.1f} MB'
+    print(memory)
+
+def main():
+    args = parse_args()
+    for name in args.scenarios:
+        if name not in benchmarks.scenarios.SCENARIOS:
+            raise SystemExit(f'Unknown scenario {name} - choose from {", ".join(benchmarks.scenarios.SCENARIOS)}')
+    # Same logging pipeline as the bot, so --verbose measures its cost too
+    log_listener = pesukarhu.structured_logging.setup_logging(logging.INFO if args.verbose else logging.ERROR)
+    names = args.scenarios if args.scenarios else list(benchmarks.scenarios.SCENARIOS)
+    results = {}
+    for name in names:
+        results[name] = asyncio.run(run_scenario(name, args))
+        print_report(name, results[name])
+    if args.json is not None:
+        with open(args.json, 'w') as stream:
+            json.dump(results, stream, indent=2)
+    log_listener.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+'''
+Load scenarios. Each takes a harness Environment plus its size options and
+returns a dict of scenario specific results; latency and resource numbers
+come from the Environment's report.
+'''
+import time
+import asyncio
+import types
+import random
+import tracemalloc
+import discord
+import benchmarks.fake_discord
+import benchmarks.harness as harness
+import benchmarks.replay
+import pesukarhu.ticket_pool
+import pesukarhu.gateway
+import pesukarhu.clock
+import pesukarhu.recorder
+
+async def wait_until(condition, timeout, poll=0.1):
+    '''
+    Waits for condition() to become true; returns how long it took, or None
+    on timeout
+    '''
+    start = time.monotonic()
+    while(time.monotonic() - start < timeout):
+        if condition():
+            return time.monotonic() - start
+        await asyncio.sleep(poll)
+    return None
+
+async def join_raid(env, members=10000, join_rate=0, drain_timeout=30.0):
+    '''
+    members accounts join (join_rate per second, 0 for as fast as
+    possible) and never verify, so every one is either kicked by the raid
+    action or warned and then kicked
+    '''
+    env.add_cogs(emoji_replace=False, intro_bot=False)
+    unverified = env.roles[harness.UNVERIFIED_ROLE_ID]
+    start = time.monotonic()
+    for idx in range(members):
+        member = env.guild.add_member(env.api.next_id(), f'raider{idx}', roles=[unverified])
+        await env.timings.timed('MemberMonitor.on_member_join', env.monitor.on_member_join(member))
+        if(join_rate > 0):
+            await asyncio.sleep(max(0.0, start + (idx + 1) / join_rate - time.monotonic()))
+        else:
+            await asyncio.sleep(0) # let the rest of the bot run, like the gateway would
+    join_time = time.monotonic() - start
+    drain_time = await wait_until(lambda: len(env.guild.kicked) + len(env.guild.banned) >= members, drain_timeout)
+    return {
+        'joins': members,
+        'join_seconds': join_time,
+        'kicked': len(env.guild.kicked),
+        'banned': len(env.guild.banned),
+        'raid_batches': env.monitor.raid_batches,
+        'all_kicked_after_joins_seconds': drain_time,
+        'log_channel_messages': env.guild.get_channel(harness.LOG_CHANNEL_ID).sent,
+    }
+
+async def intro_tickets(env, tickets=1000, answer_delay=0.5, timeout=60.0):
+    '''
+    tickets members react to the intro message at once, then each answers
+    every question answer_delay seconds after it shows up
+    '''
+    env.add_cogs(monitor=False, emoji_replace=False)
+    # Let the ticket pool fill the way it would after on_ready
+    backend = env.intro_bot.tickets
+    await env.intro_bot.on_ready()
+    warm_time = None
+    if isinstance(backend, pesukarhu.ticket_pool.TicketPool):
+        warm_time = await wait_until(lambda: len(backend.ready) >= backend.min_size, timeout)
+    questions = len(env.intro_bot.settings.questions)
+    members = [env.guild.add_member(env.api.next_id(), f'newbie{idx}') for idx in range(tickets)]
+
+    async def verify(member):
+        payload = benchmarks.fake_discord.reaction_payload(env.guild, member, harness.INTRO_MESSAGE_ID, '✅')
+        await env.timings.timed('IntroBot.on_raw_reaction_add', env.intro_bot.on_raw_reaction_add(payload))
+        for idx in range(questions):
+            await asyncio.sleep(answer_delay)
+            ticket = env.intro_bot.log.get_member(member.id)
+            channel = env.guild.get_channel(ticket.channel)
+            message = benchmarks.fake_discord.FakeMessage(env.api, channel, member, f'answer {idx} from {member.name}')
+            await env.dispatcher.on_message(message)
+            # Wait for the bot to ask the next question (or finish) before answering
+            await wait_until(lambda: ticket.get_current_question_index() > idx + 1 or idx + 1 == questions, timeout, poll=0.01)
+
+    start = time.monotonic()
+    tasks = [asyncio.ensure_future(verify(member)) for member in members]
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    return {
+        'tickets': tickets,
+        'completed': len([task for task in done if task.exception() is None]),
+        'seconds': time.monotonic() - start,
+        'channels_created': env.api.calls.get('create_channel', 0),
+        'pool_warm_seconds': warm_time,
+    }
+
+async def chat_firehose(env, rate=500, seconds=10.0, seed=0):
+    '''
+    rate messages per second of ordinary chat in one channel for seconds
+    '''
+    env.add_cogs(monitor=False)
+    rng = random.Random(seed)
+    vocabulary = ['the', 'money', 'budget', 'index', 'fund', 'roth', 'ira', 'stocks', 'raccoon!',
+                  'uncopyrightable', 'dermatoglyphics', 'misconjugatedly', 'hello', 'yes', 'no']
+    authors = [env.guild.add_member(env.api.next_id(), f'chatter{idx}') for idx in range(200)]
+    channel = env.guild.get_channel(harness.GENERAL_CHANNEL_ID)
+    count = int(rate * seconds)
+    start = time.monotonic()
+    for idx in range(count):
+        content = ' '.join(rng.choice(vocabulary) for word in range(rng.randint(3, 20)))
+        message = benchmarks.fake_discord.FakeMessage(env.api, channel, rng.choice(authors), content)
+        await env.timings.timed('MessageDispatch.on_message', env.dispatcher.on_message(message))
+        await asyncio.sleep(max(0.0, start + (idx + 1) / rate - time.monotonic()))
+    return {
+        'messages': count,
+        'seconds': time.monotonic() - start,
+        'reactions': env.api.calls.get('reaction', 0),
+        'reactions_shed': env.emoji_replace.reactions.shed,
+    }
+
+async def member_cache(env, members=10000, joins=1000):
+    '''
+    discord.py's own member cache under each gateway profile. The guild has
+    members accounts, which the full profile chunks at startup (with a
+    presence each) and the lean one never receives, then joins accounts
+    join. Reports the cache size and what tracemalloc sees it hold.
+    '''
+    results = {}
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        for profile in ('full', 'lean'):
+            options = pesukarhu.gateway.get_bot_options(profile)
+            state = discord.state.ConnectionState(dispatch=lambda *args, **kwargs: None, handlers={}, hooks={},
+                                                  syncer=None, http=None, loop=asyncio.get_event_loop(), **options)
+            existing = []
+            presences = []
+            if options['chunk_guilds_at_startup']:
+                existing = [benchmarks.fake_discord.member_payload(harness.GUILD_ID, harness.GUILD_ID + 1 + idx, f'member{idx}',
+                                                                   [harness.VERIFIED_ROLE_ID])
+                            for idx in range(members)]
+            if options['intents'].presences:
+                presences = [benchmarks.fake_discord.presence_payload(harness.GUILD_ID + 1 + idx) for idx in range(len(existing))]
+            data = benchmarks.fake_discord.guild_payload(harness.GUILD_ID, existing, presences)
+            # The payloads themselves don't count, only what the cache keeps
+            before = tracemalloc.get_traced_memory()[0]
+            guild = discord.Guild(data=data, state=state)
+            state._add_guild(guild)
+            for idx in range(joins):
+                state.parse_guild_member_add(benchmarks.fake_discord.member_payload(harness.GUILD_ID, harness.GUILD_ID + 1 + members + idx,
+                                                                                    f'joiner{idx}', [harness.UNVERIFIED_ROLE_ID]))
+            results[f'{profile}_cached_members'] = len(guild.members)
+            results[f'{profile}_cache_mb'] = (tracemalloc.get_traced_memory()[0] - before) / (1024 * 1024)
+            del data, existing, presences, guild, state
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    if(results['full_cache_mb'] > 0):
+        results['lean_saving_pct'] = 100 * (1 - results['lean_cache_mb'] / results['full_cache_mb'])
+    return results
+
+async def status_views(env, members=10000, flips=3):
+    '''
+    $member_list over a raid sized list of members: renders every page,
+    again with nothing changed, and again after one member per page has
+    changed state, then turns flips pages of the command itself
+    '''
+    env.add_cogs(emoji_replace=False, intro_bot=False)
+    member_list = env.monitor.member_list
+    for idx in range(members):
+        member_list.add_member(harness.GUILD_ID + 1 + idx, f'raider{idx}')
+    view = member_list.get_view()
+    results = {'members': members, 'pages': view.page_count()}
+
+    def render_all():
+        start = time.perf_counter()
+        for page in range(view.page_count()):
+            view.get_embed(page)
+        return (time.perf_counter() - start) * 1000
+
+    results['first_pass_ms'] = render_all()
+    results['cached_pass_ms'] = render_all()
+    for id in view.ids[::view.page_size]:
+        member_list.verify_member(id)
+    rendered = member_list.rows.rendered
+    results['after_changes_ms'] = render_all()
+    results['rows_rerendered'] = member_list.rows.rendered - rendered
+
+    admin = env.guild.add_member(env.api.next_id(), 'admin', roles=[env.roles[harness.ADMIN_ROLE_ID]])
+    channel = env.guild.get_channel(harness.GENERAL_CHANNEL_ID)
+    sent = []
+
+    async def send(content=None, embed=None):
+        message = await channel.send(content, embed=embed)
+        sent.append(message)
+        return message
+
+    ctx = types.SimpleNamespace(send=send, author=admin, bot=env.bot)
+    show = asyncio.ensure_future(member_list.get_view(max_age=3600).show(ctx))
+    await wait_until(lambda: len(sent) > 0 and len(sent[0].reactions) == 2, 10.0, poll=0.01)
+    for idx in range(flips):
+        previous = sent[0].embed
+        env.bot.dispatch('raw_reaction_add', benchmarks.fake_discord.reaction_payload(env.guild, admin, sent[0].id, '▶️'))
+        await wait_until(lambda: sent[0].embed is not previous, 10.0, poll=0.01)
+    results['shown_page'] = sent[0].embed.footer.text
+    show.cancel()
+    return results
+
+async def virtual_day(env, members=100000, hours=24.0, seed=0):
+    '''
+    hours of churn on a VirtualClock: members join spread over the period
+    and most verify, some leave, some open an intro ticket and abandon it,
+    and the rest are warned and kicked by the maintenance loop. Every
+    delay, deadline and timeout runs on virtual time, so the whole period
+    takes as long as the bot's own work on it.
+    '''
+    clock = pesukarhu.clock.VirtualClock()
+    env.bot.pesukarhu_clock = clock
+    env.api.latency = 0
+    env.api.rate_limits = False
+    # Realistic delays, no raid at a steady join rate, and abandoned tickets expire
+    env.set_env({'PESUKARHU_UNVERIFIED_WARN_DELAY': 3600, 'PESUKARHU_UNVERIFIED_KICK_DELAY': 7200,
+                 'PESUKARHU_RETENTION_TIME': 600, 'PESUKARHU_MEMBER_REFRESH_PERIOD': 60,
+                 'PESUKARHU_RAID_DETECTION_LEVEL': 10 * members, 'PESUKARHU_RAID_DETECTION_EXTRA_WINDOWS': '',
+                 'PESUKARHU_INTRO_EXPIRE_TICKETS': 1})
+    env.add_cogs(emoji_replace=False)
+    await env.intro_bot.on_ready()
+    rng = random.Random(seed)
+    unverified = env.roles[harness.UNVERIFIED_ROLE_ID]
+    verified = env.roles[harness.VERIFIED_ROLE_ID]
+    period = hours * 3600
+    events = [] # (virtual time, order, kind, member)
+    accounts = {}
+    counts = {'join': 0, 'verify': 0, 'leave': 0, 'abandon': 0}
+    for idx in range(members):
+        join_time = rng.uniform(0, period)
+        member = env.guild.add_member(env.api.next_id(), f'member{idx}', roles=[unverified])
+        accounts[member.id] = member
+        events.append((join_time, idx, 'join', member))
+        fate = rng.random()
+        if(fate < 0.6):
+            kind, delay = 'verify', rng.uniform(60, 3000)
+        elif(fate < 0.7):
+            kind, delay = 'leave', rng.uniform(60, 10000)
+        elif(fate < 0.75):
+            kind, delay = 'abandon', rng.uniform(30, 600)
+        else:
+            kind, delay = 'idle', None
+        if delay is not None:
+            events.append((join_time + delay, idx, kind, member))
+    events.sort(key=lambda event: (event[0], event[1]))
+    guild = env.guild
+
+    async def kicked_leave(seen):
+        # The gateway would send these
+        for id in guild.kicked[seen:]:
+            await env.monitor.on_member_remove(accounts[id])
+        return len(guild.kicked)
+
+    start_time = clock.time()
+    start = time.perf_counter()
+    kicked_seen = 0
+    for event_time, idx, kind, member in events:
+        await clock.advance(start_time + event_time - clock.time())
+        kicked_seen = await kicked_leave(kicked_seen)
+        if(member.id not in guild.member_map):
+            continue # kicked before they got round to it
+        counts[kind] += 1
+        if(kind == 'join'):
+            await env.timings.timed('MemberMonitor.on_member_join', env.monitor.on_member_join(member))
+        elif(kind == 'verify'):
+            before = types.SimpleNamespace(roles=list(member.roles))
+            member.roles = [verified]
+            await env.timings.timed('MemberMonitor.on_member_update', env.monitor.on_member_update(before, member))
+        elif(kind == 'leave'):
+            guild.member_map.pop(member.id, None)
+            await env.timings.timed('MemberMonitor.on_member_remove', env.monitor.on_member_remove(member))
+        elif(kind == 'abandon'):
+            payload = benchmarks.fake_discord.reaction_payload(guild, member, harness.INTRO_MESSAGE_ID, '✅')
+            await env.timings.timed('IntroBot.on_raw_reaction_add', env.intro_bot.on_raw_reaction_add(payload))
+    # Let the last joins run out their kick delay, retention and ticket timeouts
+    drain = max(7200 + 600, env.intro_bot.settings.timeout_offset) + 120
+    await clock.advance(start_time + period + drain - clock.time())
+    kicked_seen = await kicked_leave(kicked_seen)
+    await clock.advance(3600)
+    return {
+        'virtual_hours': (clock.time() - start_time) / 3600,
+        'wall_seconds': time.perf_counter() - start,
+        'joins': counts['join'],
+        'verified': counts['verify'],
+        'left': counts['leave'],
+        'tickets_abandoned': counts['abandon'],
+        'kicked': len(guild.kicked),
+        'still_listed': len(env.monitor.member_list.member_list),
+        'open_tickets': len(env.intro_bot.log.log),
+        'timers_fired': clock.fired,
+    }
+
+async def replay(env, recording=None, speed=0.0, drain_timeout=30.0):
+    '''
+    Replays a gateway recording made with PESUKARHU_RECORD_FILE through the
+    cogs, at speed times real time, or with speed 0 as fast as possible on
+    a VirtualClock, which keeps the gaps between events and every deadline
+    but skips the waiting. The simulated API runs on the same clock. The
+    cogs run on the harness settings; pass the bot's .env as --env-file
+    for the ones it was recorded with.
+    '''
+    if recording is None:
+        return {'skipped': 'no --recording given'}
+    events = list(pesukarhu.recorder.read_recording(recording))
+    if(speed > 0):
+        clock = pesukarhu.clock.ScaledClock(speed)
+    else:
+        clock = pesukarhu.clock.VirtualClock()
+    env.bot.pesukarhu_clock = clock
+    env.api.clock = clock
+    env.add_cogs()
+    await env.intro_bot.on_ready()
+    replayer = benchmarks.replay.Replayer(env)
+    start_time = clock.monotonic()
+    start = time.perf_counter()
+    for seconds, kind, fields in events:
+        delay = start_time + seconds - clock.monotonic()
+        if(speed > 0):
+            if(delay > 0):
+                await clock.sleep(delay)
+        else:
+            await clock.advance(delay)
+        replayer.apply(kind, fields)
+    wall_seconds = time.perf_counter() - start
+    # Handlers still waiting on the API; on the virtual clock that means
+    # moving it on until they're done
+    drain_start = clock.monotonic()
+    while(replayer.pending and (clock.monotonic() - drain_start < drain_timeout)):
+        if(speed > 0):
+            await asyncio.sleep(0.01)
+        else:
+            await clock.advance(0.1)
+    recorded_seconds = events[-1][0] if events else 0.0
+    return {
+        'events': dict(sorted(replayer.events.items())),
+        'skipped': replayer.skipped,
+        'recorded_seconds': recorded_seconds,
+        'wall_seconds': wall_seconds,
+        'speedup': recorded_seconds / wall_seconds if wall_seconds > 0 else 0.0,
+        'events_per_second': len(events) / wall_seconds if wall_seconds > 0 else 0.0,
+        'handlers_unfinished': len(replayer.pending),
+        'kicked': len(env.guild.kicked),
+        'open_tickets': len(env.intro_bot.log.log),
+    }
+
+SCENARIOS = {
+    'join_raid': join_raid,
+    'intro_tickets': intro_tickets,
+    'chat_firehose': chat_firehose,
+    'member_cache': member_cache,
+    'status_views': status_views,
+    'virtual_day': virtual_day,
+    'replay': replay,
+}
@@ -0,0 +1,254 @@
+import os
+import enum
+import asyncio
+import heapq
+import itertools
+import discord
+from discord.ext import commands
+from dotenv import load_dotenv
+import logging
+import pesukarhu.extensions
+import pesukarhu.clock
+
+class ActionQueue(commands.Cog):
+    '''
+    Central executor for outbound Discord calls (DMs, role changes, kicks,
+    bans, log messages). Callers submit actions instead of awaiting them
+    inline, so one slow or rate-limited call doesn't stall everything behind
+    it. Actions run highest priority first on a pool of workers, with
+    bounded concurrency per rate-limit bucket and retry with exponential
+    backoff. An action whose bucket is full is parked with its bucket
+    rather than waited on, so workers stay free for other buckets, and goes
+    back on the queue as soon as a slot frees. An action submitted under a
+    key that is already queued or running is not queued again.
+    '''
+    class Priority(enum.IntEnum):
+        MODERATION = 0 # kicks and bans
+        ROLE = 1 # role changes
+        MESSAGE = 2 # DMs and user facing messages
+        LOG = 3 # log channel embeds
+        REACTION = 4 # cosmetic reactions, shed when they wait too long
+
+    class Action():
+        '''
+        A queued call. factory returns a fresh coroutine for every attempt.
+        '''
+        def __init__(self, factory, priority, bucket, key, description, future):
+            self.factory = factory
+            self.priority = priority
+            self.bucket = bucket
+            self.key = key
+            self.description = description
+            self.future = future
+            self.attempts = 0
+
+    def __init__(self, bot):
+        self.bot = bot
+        load_dotenv()
+        self.guild = int(os.getenv('PESUKARHU_GUILD'))
+        self.admin_role_id = int(os.getenv('PESUKARHU_ADMIN_ROLE'))
+        self.worker_count = int(os.getenv('PESUKARHU_ACTION_WORKERS', '16'))
+        self.bucket_concurrency = int(os.getenv('PESUKARHU_ACTION_BUCKET_CONCURRENCY', '4'))
+        self.max_retries = int(os.getenv('PESUKARHU_ACTION_MAX_RETRIES', '5'))
+        self.retry_delay = float(os.getenv('PESUKARHU_ACTION_RETRY_DELAY', '1.0'))
+        logging.info(f'Initializing ActionQueue:')
+        logging.info(f'   workers = {self.worker_count}')
+        logging.info(f'   bucket concurrency = {self.bucket_concurrency}')
+        logging.info(f'   max retries = {self.max_retries}')
+        logging.info(f'   retry delay = {self.retry_delay} (sec)')
+        self.clock = pesukarhu.clock.get_clock(bot)
+        self.workers = []
+        self.handing_over = False
+        handover = pesukarhu.extensions.take_over(bot, 'ActionQueue')
+        if handover is None:
+            self.queue = None # created on first submit so it binds to the running loop
+            self.counter = itertools.count() # keeps equal priorities in submit order
+            self.pending = {}
+            self.running = {} # bucket -> actions in flight
+            self.parked = {} # bucket -> heap of queue entries waiting for a slot
+            self.completed = 0
+            self.failed = 0
+            self.retried = 0
+            self.deduplicated = 0
+        else:
+            # Reloaded; take over everything still queued, including the
+            # actions the old workers were running when they were stopped
+            for name, value in handover.items():
+                setattr(self, name, value)
+            if self.queue is not None:
+                self.start_workers()
+
+    def submit(self, factory, priority, bucket, key=None, description=''):
+        '''
+        Queues factory() to be awaited. bucket groups calls that share a
+        Discord rate limit, eg ('kick', guild_id) or ('channel', channel_id).
+        key, eg (member_id, 'kick'), makes the action idempotent while it is
+        pending. Returns a future for the result; awaiting it is optional.
+        '''
+        if((key is not None) and (key in self.pending)):
+            self.deduplicated += 1
+            logging.info(f'Skipping duplicate action {description} ({key})')
+            return self.pending[key].future
+        if self.queue is None:
+            self.queue = asyncio.PriorityQueue()
+        if(len(self.workers) == 0):
+            self.start_workers()
+        future = self.bot.loop.create_future()
+        # Mark exceptions as retrieved; failures are logged here, and fire and
+        # forget callers shouldn't get "exception never retrieved" warnings
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        action = self.Action(factory, priority, bucket, key, description, future)
+        if key is not None:
+            self.pending[key] = action
+        self.queue.put_nowait((priority, next(self.counter), action))
+        return future
+
+    def start_workers(self):
+        self.workers = [self.bot.loop.create_task(self.worker()) for idx in range(self.worker_count)]
+
+    def claim_slot(self, entry):
+        # Takes one of the action's bucket slots, or parks the entry until
+        # one frees; returns whether it can run now
+        bucket = entry[2].bucket
+        if(self.running.get(bucket, 0) >= self.bucket_concurrency):
+            heapq.heappush(self.parked.setdefault(bucket, []), entry)
+            return False
+        self.running[bucket] = self.running.get(bucket, 0) + 1
+        return True
+
+    def release_slot(self, bucket):
+        # Hands the freed slot to the best parked action by putting it back
+        # on the queue
+        self.running[bucket] -= 1
+        if(self.running[bucket] == 0):
+            del self.running[bucket]
+        parked = self.parked.get(bucket)
+        if parked:
+            self.queue.put_nowait(heapq.heappop(parked))
+            if(len(parked) == 0):
+                del self.parked[bucket]
+
+    def finish(self, action, result=None, exception=None):
+        if action.key is not None:
+            self.pending.pop(action.key, None)
+        if action.future.done():
+            return
+        if exception is None:
+            self.completed += 1
+            action.future.set_result(result)
+        else:
+            self.failed += 1
+            action.future.set_exception(exception)
+
+    def retry(self, action):
+        # Requeue after the backoff without tying up a worker while waiting
+        delay = self.retry_delay * (2 ** (action.attempts - 1))
+        self.retried += 1
+        logging.warning(f'Retrying action {action.description} in {delay:.1f}s (attempt {action.attempts})')
+        self.clock.call_later(delay, self.queue.put_nowait, (action.priority, next(self.counter), action))
+
+    def abandon(self, action):
+        # A worker was cancelled holding action
+        if self.handing_over:
+            # Run again from scratch by the reloaded queue's workers
+            action.attempts -= 1
+            self.queue.put_nowait((action.priority, next(self.counter), action))
+        else:
+            self.finish(action, exception=asyncio.CancelledError())
+
+    async def worker(self):
+        while True:
+            # Nothing is awaited between taking an entry and the try below,
+            # so a cancelled worker can't be holding an action it dropped
+            entry = await self.queue.get()
+            if not self.claim_slot(entry):
+                continue
+            action = entry[2]
+            action.attempts += 1
+            try:
+                result = await action.factory()
+            except (discord.Forbidden, discord.NotFound) as e:
+                # Retrying won't help
+                logging.warning(f'Action {action.description} failed: {e}')
+                self.finish(action, exception=e)
+            except discord.HTTPException as e:
+                if(((e.status == 429) or (e.status >= 500)) and (action.attempts <= self.max_retries)):
+                    self.retry(action)
+                else:
+                    logging.warning(f'Action {action.description} failed: {e}')
+                    self.finish(action, exception=e)
+            except asyncio.CancelledError:
+                self.abandon(action)
+                raise
+            except Exception as e:
+                logging.exception(f'Action {action.description} failed')
+                self.finish(action, exception=e)
+            else:
+                self.finish(action, result=result)
+            finally:
+                self.release_slot(action.bucket)
+
+    def get_metrics(self):
+        return {
+            'actions_queued': 0 if self.queue is None else self.queue.qsize(),
+            'actions_parked': sum(len(parked) for parked in self.parked.values()),
+            'actions_pending': len(self.pending),
+            'actions_completed': self.completed,
+            'actions_failed': self.failed,
+            'actions_retried': self.retried,
+        }
+
+    def export_state(self):
+        self.handing_over = True
+        return {
+            'queue': self.queue,
+            'counter': self.counter,
+            'pending': self.pending,
+            'running': self.running,
+            'parked': self.parked,
+            'completed': self.completed,
+            'failed': self.failed,
+            'retried': self.retried,
+            'deduplicated': self.deduplicated,
+        }
+
+    def cog_unload(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+
+    def get_embed(self):
+        queued = 0 if self.queue is None else self.queue.qsize()
+        embed=discord.Embed(title=f'Action queue: ({queued} queued)')
+        embed.add_field(name="Pending keys", value=f'{len(self.pending)}', inline=True)
+        embed.add_field(name="Completed", value=f'{self.completed}', inline=True)
+        embed.add_field(name="Failed", value=f'{self.failed}', inline=True)
+        embed.add_field(name="Retried", value=f'{self.retried}', inline=True)
+        embed.add_field(name="Deduplicated", value=f'{self.deduplicated}', inline=True)
+        embed.add_field(name="Parked", value=f'{sum(len(parked) for parked in self.parked.values())}', inline=True)
+        embed.add_field(name="Busy buckets", value=f'{len(self.running)}', inline=True)
+        return embed
+
+    @commands.command()
+    async def action_queue(self, ctx):
+        await ctx.send(embed=self.get_embed())
+
+    async def cog_check(self, ctx):
+        # Check if user has admin role
+        guild = self.bot.get_guild(self.guild)
+        admin_role = guild.get_role(self.admin_role_id)
+        return admin_role in ctx.author.roles
+
+def get_action_queue(bot):
+    '''
+    Returns the bot's ActionQueue cog, adding it if this is the first cog
+    asking for it
+    '''
+    actions = bot.get_cog('ActionQueue')
+    if actions is None:
+        actions = ActionQueue(bot)
+        bot.add_cog(actions)
+    return actions
+
+def setup(bot):
+    get_action_queue(bot)
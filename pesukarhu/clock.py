@@ -0,0 +1,153 @@
+import time
+import heapq
+import asyncio
+import itertools
+
+class Clock():
+    '''
+    Time source for the cogs' timing logic: deadlines, delays, batching
+    windows and rate windows. time() is epoch seconds, for timestamps that
+    are stored or shown; it is read from the wall clock once and advanced
+    by the monotonic clock after that, so an NTP step doesn't make every
+    warn, kick or ticket timeout fire early or late at once. monotonic()
+    is for intervals. sleep, wait_for and call_later wait on this clock.
+    '''
+    def __init__(self):
+        self.epoch_offset = time.time() - time.monotonic()
+
+    def time(self):
+        return self.epoch_offset + time.monotonic()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    async def sleep(self, delay):
+        await asyncio.sleep(delay)
+
+    async def wait_for(self, awaitable, timeout):
+        return await asyncio.wait_for(awaitable, timeout=timeout)
+
+    def call_later(self, delay, callback, *args):
+        '''
+        Returns a handle with cancel()
+        '''
+        return asyncio.get_event_loop().call_later(delay, callback, *args)
+
+class ScaledClock(Clock):
+    '''
+    Real time running speed times faster, for replaying a recording at
+    10x with every delay, deadline and timeout shortened to match
+    '''
+    def __init__(self, speed):
+        super().__init__()
+        self.speed = speed
+        self.start = time.monotonic()
+
+    def time(self):
+        return self.epoch_offset + self.monotonic()
+
+    def monotonic(self):
+        return self.start + (time.monotonic() - self.start) * self.speed
+
+    async def sleep(self, delay):
+        await asyncio.sleep(delay / self.speed)
+
+    async def wait_for(self, awaitable, timeout):
+        return await asyncio.wait_for(awaitable, timeout=None if timeout is None else timeout / self.speed)
+
+    def call_later(self, delay, callback, *args):
+        return asyncio.get_event_loop().call_later(delay / self.speed, callback, *args)
+
+class VirtualClock(Clock):
+    '''
+    Simulated time that only moves when advance() is called, for driving
+    the cogs through hours of deadlines in seconds. Everything waiting on
+    the clock - sleeps, wait_for timeouts, call_later callbacks and the
+    maintenance loops paced by them - runs in time order as advance()
+    passes it, with the event loop left to settle after each. Anything
+    that waits on the event loop's own timer still runs in real time.
+    '''
+    class Timer():
+        __slots__ = ('callback', 'args', 'cancelled')
+
+        def __init__(self, callback, args):
+            self.callback = callback
+            self.args = args
+            self.cancelled = False
+
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self, start=None):
+        self.now = float(time.time() if start is None else start)
+        self.timers = []
+        self.counter = itertools.count() # keeps equal times in scheduling order
+        self.fired = 0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def call_later(self, delay, callback, *args):
+        timer = self.Timer(callback, args)
+        heapq.heappush(self.timers, (self.now + max(0.0, delay), next(self.counter), timer))
+        return timer
+
+    async def sleep(self, delay):
+        future = asyncio.get_event_loop().create_future()
+        timer = self.call_later(delay, lambda: future.done() or future.set_result(None))
+        try:
+            await future
+        finally:
+            timer.cancel()
+
+    async def wait_for(self, awaitable, timeout):
+        task = asyncio.ensure_future(awaitable)
+        timer = asyncio.ensure_future(self.sleep(timeout))
+        try:
+            await asyncio.wait((task, timer), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            timer.cancel()
+        if task.done():
+            return task.result()
+        task.cancel()
+        raise asyncio.TimeoutError()
+
+    async def settle(self):
+        # Let everything runnable run; the loop's ready queue is private, so
+        # fall back to a fixed number of passes without it
+        ready = getattr(asyncio.get_event_loop(), '_ready', None)
+        for idx in range(10000):
+            if((ready is None and idx >= 100) or (ready is not None and len(ready) == 0)):
+                return
+            await asyncio.sleep(0)
+
+    async def advance(self, seconds):
+        '''
+        Moves time forward by seconds, firing the timers that come due in
+        order and settling the event loop after each
+        '''
+        target = self.now + seconds
+        await self.settle()
+        while(self.timers and self.timers[0][0] <= target):
+            when, _, timer = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+            self.now = max(self.now, when)
+            self.fired += 1
+            timer.callback(*timer.args)
+            await self.settle()
+        self.now = max(self.now, target)
+
+def get_clock(bot):
+    '''
+    Returns the bot's Clock. A simulation sets bot.pesukarhu_clock to a
+    VirtualClock before adding the cogs.
+    '''
+    clock = getattr(bot, 'pesukarhu_clock', None)
+    if clock is None:
+        clock = Clock()
+        bot.pesukarhu_clock = clock
+    return clock
@@ -0,0 +1,96 @@
+import asyncio
+import heapq
+import itertools
+import pesukarhu.clock
+
+class DeadlineIndex():
+    '''
+    Min-heap of (deadline, key) pairs used to find the entries whose next
+    transition is due without scanning every entry. Rescheduling a key leaves
+    its old heap entry behind; stale entries are skipped when they reach the
+    top of the heap, so schedule/cancel are O(log n) / O(1).
+    '''
+    def __init__(self, clock=None):
+        self.clock = pesukarhu.clock.Clock() if clock is None else clock
+        self.heap = []
+        self.deadlines = {}
+        self.counter = itertools.count() # tie breaker so keys are never compared
+        self.changed = None # created lazily so it binds to the running loop
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def schedule(self, key, deadline):
+        if(deadline is None):
+            self.cancel(key)
+            return
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.counter), key))
+        # Wake the waiter if this entry is now the earliest one
+        if(self.heap[0][2] == key and self.changed is not None):
+            self.changed.set()
+        # Stale entries pile up when keys are rescheduled often; rebuild the
+        # heap once they outnumber the live ones
+        if(len(self.heap) > 2 * len(self.deadlines) + 64):
+            self.compact()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    def get(self, key):
+        return self.deadlines.get(key)
+
+    def compact(self):
+        self.heap = [(deadline, next(self.counter), key) for key, deadline in self.deadlines.items()]
+        heapq.heapify(self.heap)
+
+    def discard_stale(self):
+        while(self.heap):
+            deadline, _, key = self.heap[0]
+            if(self.deadlines.get(key) == deadline):
+                return
+            heapq.heappop(self.heap)
+
+    def next_deadline(self):
+        self.discard_stale()
+        if(not self.heap):
+            return None
+        return self.heap[0][0]
+
+    def pop_due(self, current_time):
+        '''
+        Removes and returns the keys whose deadline is at or before
+        current_time, earliest first
+        '''
+        due = []
+        while(True):
+            self.discard_stale()
+            if((not self.heap) or (self.heap[0][0] > current_time)):
+                return due
+            deadline, _, key = heapq.heappop(self.heap)
+            del self.deadlines[key]
+            due.append(key)
+
+    async def wait(self, current_time, max_delay):
+        '''
+        Sleeps until the earliest deadline, an earlier deadline being
+        scheduled, or max_delay seconds on the index's clock, whichever comes
+        first. Deadlines and current_time are in seconds (eg epoch
+        timestamps).
+        '''
+        if(self.changed is None):
+            self.changed = asyncio.Event()
+        self.changed.clear()
+        delay = max_delay
+        deadline = self.next_deadline()
+        if(deadline is not None):
+            delay = min(delay, max(0.0, deadline - current_time))
+        if(delay <= 0):
+            return
+        try:
+            await self.clock.wait_for(self.changed.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
@@ -1,74 +1,241 @@
+import os
+import asyncio
+import functools
+import collections
 import discord
 from discord.ext import commands
 from discord.ext.commands import bot
-import re
+from dotenv import load_dotenv
 import logging
 import random
+import pesukarhu.message_dispatch
+import pesukarhu.action_queue
+import pesukarhu.clock
+
+EMOJI = {
+    'a': '🇦',
+    'b': '🇧',
+    'c': '🇨',
+    'd': '🇩',
+    'e': '🇪',
+    'f': '🇫',
+    'g': '🇬',
+    'h': '🇭',
+    'i': '🇮',
+    'j': '🇯',
+    'k': '🇰',
+    'l': '🇱',
+    'm': '🇲',
+    'n': '🇳',
+    'o': '🇴',
+    'p': '🇵',
+    'q': '🇶',
+    'r': '🇷',
+    's': '🇸',
+    't': '🇹',
+    'u': '🇺',
+    'v': '🇻',
+    'w': '🇼',
+    'x': '🇽',
+    'y': '🇾',
+    'z': '🇿'
+}
+PROBABILITY = [0, # 1 letter
+               0, # 2 letter
+               0, # 3 letter
+               0, # 4 letter
+               0.001, # 5 letter
+               0.002, # 6 letter
+               0.005, # 7 letter
+               0.01, # 8 letter
+               0.02, # 9 letter
+               0.03, # 10 letter
+               0.05, # 11 letter
+               0.1, # 12 letter
+               0.2, # 13 letter
+               0.3] # 14 letter
+# Precomputed for neat_probability: a bit per letter, and the probability
+# by word length. Longer words than the table always count, up to 26
+# letters - any more can't all be different
+LETTER_BITS = {letter: 1 << idx for idx, letter in enumerate(EMOJI)}
+LENGTH_PROBABILITY = [0] + PROBABILITY + [1] * (len(EMOJI) - len(PROBABILITY))
+
+def neat_probability(word):
+    '''
+    Chance of reacting to word - 0 unless it's all different letters
+    a-z, checked in one pass without building any strings
+    '''
+    if(len(word) >= len(LENGTH_PROBABILITY)):
+        return 0
+    probability = LENGTH_PROBABILITY[len(word)]
+    if(probability == 0):
+        return 0
+    seen = 0
+    for letter in word:
+        bit = LETTER_BITS.get(letter, 0)
+        if((bit == 0) or (seen & bit)): # not a-z, or a repeat
+            return 0
+        seen |= bit
+    return probability
+
+def choose_emoji(words):
+    '''
+    Reactions for a message from its ParsedMessage words: the letters of
+    the first neat word that wins its roll, then a raccoon for raccoon.
+    Returns (neat word or None, emoji).
+    '''
+    neat_word = None
+    emoji = []
+    for word in words:
+        probability = neat_probability(word)
+        if((probability > 0) and (random.random() < probability)):
+            neat_word = word
+            emoji = [EMOJI[letter] for letter in word]
+            break # don't try to react to two words per message
+    # Words are split on whitespace, so this matches the same messages as
+    # searching the normalized content
+    if any("raccoon" in word for word in words):
+        emoji.append('🦝')
+    return neat_word, emoji
+
+class ReactionScheduler():
+    '''
+    Adds reactions through the ActionQueue at its lowest priority, so they
+    wait behind moderation traffic and never hold up the message listener.
+    Each scheduled message is an entry of emoji to add in order. Up to
+    pipeline reactions are in flight at once, across messages and within
+    one: a message's next reaction is queued as soon as the one before it
+    has been sent, which keeps the letters in order since discord.py makes
+    requests on one route in the order they're started.
+
+    The newest entry goes first, so a fresh message cuts ahead of a word
+    still being spelled on an old one. What's left of an entry is shed once
+    it is older than max_age, or when more than queue_size entries wait.
+    '''
+    class Entry():
+        def __init__(self, message, emoji, created):
+            self.message = message
+            self.emoji = emoji
+            self.created = created
+            self.next = 0 # index of the next emoji to queue
+            self.blocked = False # the previous emoji hasn't been sent yet
+            self.failed = False
+
+        def remaining(self):
+            return len(self.emoji) - self.next
+
+    def __init__(self, actions, clock):
+        self.actions = actions
+        self.clock = clock
+        self.entries = collections.deque()
+        self.in_flight = 0
+        self.scheduled = 0
+        self.sent = 0
+        self.shed = 0
+        self.load_settings()
+
+    def load_settings(self):
+        self.pipeline = max(1, int(os.getenv('PESUKARHU_REACTION_PIPELINE', '4')))
+        self.max_age = float(os.getenv('PESUKARHU_REACTION_MAX_AGE', '30.0'))
+        self.queue_size = max(1, int(os.getenv('PESUKARHU_REACTION_QUEUE_SIZE', '20')))
+        logging.info(f'   reaction pipeline = {self.pipeline}')
+        logging.info(f'   reaction max age = {self.max_age} (sec)')
+        logging.info(f'   reaction queue size = {self.queue_size}')
+
+    def schedule(self, message, emoji):
+        if(len(emoji) == 0):
+            return
+        self.entries.appendleft(self.Entry(message, emoji, self.clock.monotonic()))
+        self.scheduled += len(emoji)
+        while(len(self.entries) > self.queue_size):
+            self.shed_entry(self.entries.pop())
+        self.pump()
+
+    def shed_entry(self, entry):
+        self.shed += entry.remaining()
+        entry.next = len(entry.emoji)
+
+    def stale(self, entry):
+        return self.clock.monotonic() - entry.created > self.max_age
+
+    def pump(self):
+        # Queue the next emoji of each entry that's ready, newest first,
+        # until the pipeline is full
+        for entry in list(self.entries):
+            if(self.in_flight >= self.pipeline):
+                break
+            if((entry.remaining() > 0) and (entry.failed or self.stale(entry))):
+                self.shed_entry(entry)
+            if(entry.remaining() == 0):
+                self.entries.remove(entry)
+                continue
+            if entry.blocked:
+                continue
+            entry.blocked = True
+            self.in_flight += 1
+            done = self.actions.submit(functools.partial(self.react, entry, entry.emoji[entry.next]),
+                                       pesukarhu.action_queue.ActionQueue.Priority.REACTION,
+                                       ('reaction', entry.message.channel.id),
+                                       description=f'reaction {entry.emoji[entry.next]} on {entry.message.id}')
+            entry.next += 1
+            done.add_done_callback(self.finished)
+
+    def finished(self, done):
+        self.in_flight -= 1
+        self.pump()
+
+    async def react(self, entry, emoji):
+        if(entry.failed or self.stale(entry)):
+            # Waited too long behind other actions
+            entry.failed = True
+            entry.blocked = False
+            self.shed += 1
+            return
+        reaction = asyncio.ensure_future(entry.message.add_reaction(emoji))
+        # The request starts before anything woken by this pump does
+        entry.blocked = False
+        self.pump()
+        try:
+            await reaction
+        except Exception:
+            # Message deleted, reactions blocked, ... the rest won't do better
+            entry.failed = True
+            raise
+        self.sent += 1
+
+    def get_metrics(self):
+        return {
+            'reactions_waiting': sum(entry.remaining() for entry in self.entries),
+            'reactions_in_flight': self.in_flight,
+            'reactions_sent': self.sent,
+            'reactions_shed': self.shed,
+        }
 
 class EmojiReplace(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        logging.info(f'Initializing EmojiReplace')
-        self.remove_non_alphanumeric = re.compile(r'([^\s\w]|_)+')
-        self.emoji_replace = {
-            'a': '🇦',
-            'b': '🇧',
-            'c': '🇨',
-            'd': '🇩',
-            'e': '🇪',
-            'f': '🇫',
-            'g': '🇬',
-            'h': '🇭',
-            'i': '🇮',
-            'j': '🇯',
-            'k': '🇰',
-            'l': '🇱',
-            'm': '🇲',
-            'n': '🇳',
-            'o': '🇴',
-            'p': '🇵',
-            'q': '🇶',
-            'r': '🇷',
-            's': '🇸',
-            't': '🇹',
-            'u': '🇺',
-            'v': '🇻',
-            'w': '🇼',
-            'x': '🇽',
-            'y': '🇾',
-            'z': '🇿'
-        }
-        self.probability = [0, # 1 letter
-                            0, # 2 letter
-                            0, # 3 letter
-                            0, # 4 letter
-                            0.001, # 5 letter
-                            0.002, # 6 letter
-                            0.005, # 7 letter
-                            0.01, # 8 letter
-                            0.02, # 9 letter
-                            0.03, # 10 letter
-                            0.05, # 11 letter
-                            0.1, # 12 letter
-                            0.2, # 13 letter
-                            0.3] # 14 letter
-
-    @commands.Cog.listener()
-    async def on_message(self, message):
-        if message.author.bot:
-            # don't respond to myself or other bots
-            return
+        load_dotenv()
+        logging.info(f'Initializing EmojiReplace:')
+        self.reactions = ReactionScheduler(pesukarhu.action_queue.get_action_queue(bot), pesukarhu.clock.get_clock(bot))
+        self.dispatcher = pesukarhu.message_dispatch.get_dispatcher(bot)
+        self.dispatcher.subscribe(self.handle_message, name='EmojiReplace', channel_types=(discord.channel.TextChannel,))
+
+    def cog_unload(self):
+        self.dispatcher.unsubscribe(self.handle_message)
+
+    def reload_settings(self):
+        logging.info(f'Reloading EmojiReplace settings:')
+        self.reactions.load_settings()
+
+    async def handle_message(self, parsed):
+        message = parsed.message
+        neat_word, emoji = choose_emoji(parsed.words)
+        if neat_word is not None:
+            logging.info(f'Found neat word - {neat_word}', extra={'event': 'neat_word', 'member': message.author.id, 'channel': message.channel.id})
+        self.reactions.schedule(message, emoji)
+
+    def get_metrics(self):
+        return self.reactions.get_metrics()
 
-        if isinstance(message.channel, discord.channel.TextChannel):
-            raw_message = message.content.lower()
-            raw_message = self.remove_non_alphanumeric.sub('', raw_message)
-            for word in raw_message.split():
-                if(len(''.join(set(word))) == len(word)): # if all letters are unique
-                    if((len(word) > len(self.probability)) or
-                    (random.random() < self.probability[len(word)-1])):
-                        logging.info(f'Found neat word - {word}')
-                        for idx in range(0, len(word)):
-                            await message.add_reaction(self.emoji_replace[word[idx]])
-                        break # don't try to react to two words per message
-            if("raccoon" in raw_message):
-                await message.add_reaction('🦝')
+def setup(bot):
+    bot.add_cog(EmojiReplace(bot))
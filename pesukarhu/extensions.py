@@ -0,0 +1,204 @@
+import os
+import sys
+import importlib
+from discord.ext import commands
+from discord.ext import tasks
+from dotenv import load_dotenv
+import logging
+
+class ExtensionManager(commands.Cog):
+    '''
+    Reloads cog code and settings without restarting the bot, so a change
+    doesn't cost a new gateway session, member chunking and everything the
+    cogs only keep in memory. $reload reloads extensions; $reload settings
+    re-reads .env and intro_bot_settings.yaml into the running cogs. With
+    PESUKARHU_RELOAD_WATCH=1 the same happens by itself when one of those
+    files or a pesukarhu module changes on disk.
+
+    A cog being reloaded can hand live state to the instance replacing it:
+    its export_state() returns a dict that the new instance picks up with
+    take_over(bot, cog_name) in its __init__. Only hand over objects from
+    modules that aren't being reloaded - enums and classes defined in the
+    reloaded module itself are new objects afterwards, so that state is
+    rebuilt from the state store instead. Extensions other cogs hold on to
+    (MessageDispatch, ActionQueue) take every extension loaded after them
+    along when they are reloaded.
+
+    Load this extension last.
+    '''
+    shared = ('pesukarhu.message_dispatch', 'pesukarhu.action_queue')
+    settings_files = ('.env', 'intro_bot_settings.yaml')
+
+    def __init__(self, bot):
+        self.bot = bot
+        load_dotenv()
+        self.guild = int(os.getenv('PESUKARHU_GUILD'))
+        self.admin_role_id = int(os.getenv('PESUKARHU_ADMIN_ROLE'))
+        self.watch = os.getenv('PESUKARHU_RELOAD_WATCH', '0') == '1'
+        self.watch_period = float(os.getenv('PESUKARHU_RELOAD_WATCH_PERIOD', '2.0'))
+        logging.info(f'Initializing ExtensionManager:')
+        logging.info(f'   watch = {self.watch}')
+        logging.info(f'   watch period = {self.watch_period} (sec)')
+        # Reloading moves an extension to the end of bot.extensions, so keep
+        # the original load order for shared extensions' dependents
+        self.load_order = [name for name in bot.extensions if name != __name__]
+        self.mtimes = {}
+        self.reloads = 0
+        if self.watch:
+            self.file_watch.change_interval(seconds=self.watch_period)
+            self.file_watch.start()
+
+    def cog_unload(self):
+        self.file_watch.cancel()
+
+    def get_load_order(self):
+        loaded = [name for name in self.load_order if name in self.bot.extensions]
+        loaded += [name for name in self.bot.extensions if (name not in loaded) and (name != __name__)]
+        return loaded
+
+    def reload_extensions(self, names):
+        '''
+        Reloads names, handing state over between the old and new cogs.
+        Returns the extensions reloaded, in load order. Raises
+        commands.ExtensionError if one fails; that one is left on its old
+        code and the ones after it aren't reloaded.
+        '''
+        loaded = self.get_load_order()
+        targets = set(names)
+        for name in names:
+            if((name in self.shared) and (name in loaded)):
+                targets.update(loaded[loaded.index(name) + 1:])
+        reloaded = []
+        for name in loaded:
+            if name not in targets:
+                continue
+            for cog in list(self.bot.cogs.values()):
+                if((cog.__module__ == name) and hasattr(cog, 'export_state')):
+                    hand_over(self.bot, cog.qualified_name, cog.export_state())
+            try:
+                self.bot.reload_extension(name)
+            finally:
+                # A failed reload sets the old module up again, and its cog
+                # has already picked the state back up
+                self.bot.pesukarhu_handover = {}
+            logging.warning(f'Reloaded extension {name}')
+            reloaded.append(name)
+            self.reloads += 1
+        return reloaded
+
+    def reload_settings(self):
+        '''
+        Reloads .env into the environment and has every cog with a
+        reload_settings() re-read its settings in place. Returns the cogs
+        reloaded.
+        '''
+        load_dotenv(override=True)
+        reloaded = []
+        for cog in list(self.bot.cogs.values()):
+            if((cog is not self) and hasattr(cog, 'reload_settings')):
+                cog.reload_settings()
+                reloaded.append(cog.qualified_name)
+        logging.warning(f'Reloaded settings of {", ".join(reloaded)}')
+        return reloaded
+
+    def scan(self):
+        # Returns (kind, name) of every watched file changed since the last
+        # scan; kind is settings, extension or module (a helper module)
+        files = {}
+        for path in self.settings_files:
+            files[os.path.abspath(path)] = ('settings', path)
+        for name, module in list(sys.modules.items()):
+            path = getattr(module, '__file__', None)
+            if((path is None) or (not name.startswith('pesukarhu.')) or (name == __name__)):
+                continue
+            files[path] = ('extension' if name in self.bot.extensions else 'module', name)
+        changed = []
+        for path, target in files.items():
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            previous = self.mtimes.get(path)
+            self.mtimes[path] = mtime
+            if((previous is not None) and (previous != mtime)):
+                changed.append(target)
+        return changed
+
+    @tasks.loop(seconds=2.0) # interval set from PESUKARHU_RELOAD_WATCH_PERIOD
+    async def file_watch(self):
+        changed = self.scan()
+        if(len(changed) == 0):
+            return
+        logging.warning(f'Changed on disk: {", ".join(name for kind, name in changed)}')
+        try:
+            if any(kind == 'settings' for kind, name in changed):
+                self.reload_settings()
+            modules = [name for kind, name in changed if kind == 'module']
+            extensions = [name for kind, name in changed if kind == 'extension']
+            for name in modules:
+                importlib.reload(sys.modules[name])
+            if(len(modules) > 0):
+                # Any extension could be using a helper module
+                extensions = self.get_load_order()
+            if(len(extensions) > 0):
+                self.reload_extensions(extensions)
+        except Exception:
+            logging.exception(f'Reload after file change failed, still running the old code')
+
+    @file_watch.before_loop
+    async def before_file_watch(self):
+        # Take the first snapshot of modification times
+        self.scan()
+
+    @commands.command()
+    async def reload(self, ctx, target='all'):
+        # $reload [all|settings|<extension>], eg $reload intro_bot
+        if(target == 'settings'):
+            reloaded = self.reload_settings()
+            await ctx.send(f'Reloaded settings of {", ".join(reloaded)}')
+            return
+        loaded = self.get_load_order()
+        if(target == 'all'):
+            names = loaded
+        else:
+            name = target if target.startswith('pesukarhu.') else f'pesukarhu.{target}'
+            if name not in loaded:
+                await ctx.send(f'Huh? {target} is not a loaded extension - choose from settings, all, {", ".join(name.split(".")[-1] for name in loaded)}')
+                return
+            names = [name]
+        try:
+            reloaded = self.reload_extensions(names)
+        except commands.ExtensionError as e:
+            logging.exception(f'$reload {target} failed')
+            await ctx.send(f'Reload failed, {e.name} is still running the old code: {e}')
+            return
+        await ctx.send(f'Reloaded {", ".join(reloaded)}')
+
+    def get_metrics(self):
+        return {
+            'extension_reloads': self.reloads,
+        }
+
+    async def cog_check(self, ctx):
+        # Check if user has admin role
+        guild = self.bot.get_guild(self.guild)
+        admin_role = guild.get_role(self.admin_role_id)
+        return admin_role in ctx.author.roles
+
+def hand_over(bot, name, state):
+    '''
+    Keeps state for the cog named name until its replacement takes it over
+    '''
+    if not hasattr(bot, 'pesukarhu_handover'):
+        bot.pesukarhu_handover = {}
+    bot.pesukarhu_handover[name] = state
+
+def take_over(bot, name):
+    '''
+    Returns the state the cog named name handed over while being reloaded,
+    or None on a normal start
+    '''
+    return getattr(bot, 'pesukarhu_handover', {}).get(name)
+
+def setup(bot):
+    bot.add_cog(ExtensionManager(bot))
@@ -0,0 +1,106 @@
+import os
+import asyncio
+import discord
+from dotenv import load_dotenv
+import logging
+
+def get_profile():
+    load_dotenv()
+    return os.getenv('PESUKARHU_GATEWAY_PROFILE', 'full')
+
+def get_bot_options(profile):
+    '''
+    Intents, member cache flags and startup chunking for a gateway profile,
+    as keyword arguments for commands.Bot:
+
+    full - every intent and every member cached; the whole member list is
+           chunked at startup unless PESUKARHU_CHUNK_AT_STARTUP=0
+    lean - only the events the cogs handle (joins, leaves and role changes,
+           guild messages, reactions) and no presences. Only members who
+           join while the bot runs are cached - those are the ones being
+           verified - and everybody else is fetched by ID when needed, see
+           MemberResolver
+    '''
+    logging.info(f'Gateway profile: {profile}')
+    if(profile == 'lean'):
+        intents = discord.Intents.none()
+        intents.guilds = True
+        intents.members = True
+        intents.guild_messages = True
+        intents.guild_reactions = True
+        if hasattr(intents, 'message_content'):
+            # Privileged and separate from guild_messages from discord.py 2.0
+            intents.message_content = True
+        member_cache_flags = discord.MemberCacheFlags.none()
+        member_cache_flags.joined = True
+        return {
+            'intents': intents,
+            'member_cache_flags': member_cache_flags,
+            'chunk_guilds_at_startup': False,
+        }
+    if(profile != 'full'):
+        logging.error(f'Unknown gateway profile {profile}, using full')
+    intents = discord.Intents.all()
+    # Without startup chunking on_ready fires as soon as the gateway is up; the
+    # cogs restore their state from the state store and fill in the rest of the
+    # guild in the background
+    return {
+        'intents': intents,
+        'member_cache_flags': discord.MemberCacheFlags.from_intents(intents),
+        'chunk_guilds_at_startup': os.getenv('PESUKARHU_CHUNK_AT_STARTUP', '0') == '1',
+    }
+
+class MemberResolver():
+    '''
+    Member lookup by ID for when the cache doesn't hold everyone: the lean
+    profile, or a full one that is still chunking. Tries the cache, then
+    asks Discord. Fetched members aren't kept - callers check their roles
+    before kicking or banning, so they need a fresh copy each time - but
+    concurrent lookups of the same ID share one request.
+    '''
+    def __init__(self):
+        self.fetching = {}
+        self.cache_hits = 0
+        self.fetches = 0
+        self.not_found = 0
+
+    async def resolve(self, guild, id):
+        '''
+        Returns the Member, or None if they aren't in the guild
+        '''
+        member = guild.get_member(id)
+        if member is not None:
+            self.cache_hits += 1
+            return member
+        fetch = self.fetching.get(id)
+        if fetch is None:
+            self.fetches += 1
+            fetch = self.fetching[id] = asyncio.ensure_future(self.fetch(guild, id))
+            fetch.add_done_callback(lambda done: self.fetching.pop(id, None))
+        # One caller giving up mustn't cancel the others' lookup
+        return await asyncio.shield(fetch)
+
+    async def fetch(self, guild, id):
+        try:
+            return await guild.fetch_member(id)
+        except discord.NotFound:
+            self.not_found += 1
+            return None
+
+    def get_metrics(self):
+        return {
+            'member_cache_hits': self.cache_hits,
+            'member_fetches': self.fetches,
+            'member_not_found': self.not_found,
+        }
+
+def get_member_resolver(bot):
+    '''
+    Returns the bot's MemberResolver, creating it if this is the first cog
+    asking for it
+    '''
+    resolver = getattr(bot, 'pesukarhu_member_resolver', None)
+    if resolver is None:
+        resolver = MemberResolver()
+        bot.pesukarhu_member_resolver = resolver
+    return resolver
@@ -1,38 +1,61 @@
 import os
 import re
 import discord
-import datetime
+import collections
 from discord.ext import commands
+from discord.ext import tasks
 from discord.ext.commands import bot
 from dotenv import load_dotenv
 import logging
 import yaml
+import functools
+import pesukarhu.deadline_index
+import pesukarhu.message_dispatch
+import pesukarhu.action_queue
+import pesukarhu.state_store
+import pesukarhu.ticket_pool
+import pesukarhu.telemetry
+import pesukarhu.keyed_executor
+import pesukarhu.extensions
+import pesukarhu.paged_view
+import pesukarhu.clock
 
 class IntroBot(commands.Cog):
     class State():
         '''
-        Stores state of the bot / reads/retrieves from state file
+        Stores state of the bot in the state store. The state file is only
+        read to seed the store the first time the bot runs with it.
         ''' 
-        def __init__(self, state_file):
-            with open("intro_bot_state.yaml", 'r') as stream:
-                config = yaml.safe_load(stream)
-
-            self.ticket_count = int(config['ticket_count'])
-            self.intro_id = int(config['intro_id'])
+        def __init__(self, state_file, store):
+            self.store_backend = store
+            ticket_count = store.get_value('intro_ticket_count')
+            intro_id = store.get_value('intro_id')
+            if((ticket_count is None) or (intro_id is None)):
+                logging.info(f'Seeding state store from {state_file}')
+                with open(state_file, 'r') as stream:
+                    config = yaml.safe_load(stream)
+                ticket_count = config['ticket_count']
+                intro_id = config['intro_id']
+
+            self.ticket_count = int(ticket_count)
+            self.intro_id = int(intro_id)
+            self.store()
 
         def store(self):
-            config = {}
-            config['ticket_count'] = self.ticket_count
-            config['intro_id'] = self.intro_id
-
-            with open("intro_bot_state.yaml", 'w') as stream:
-                yaml.dump(config, stream)
+            # Queued for the store's writer thread, doesn't block
+            self.store_backend.set_value('intro_ticket_count', self.ticket_count)
+            self.store_backend.set_value('intro_id', self.intro_id)
 
     class Settings():
         '''
         Stores settings of the bot
         '''
         def __init__(self, state_file):
+            self.load()
+
+        def load(self):
+            # Also used to reload in place; the ticket backend and the log
+            # hold on to this object
             with open("intro_bot_settings.yaml", 'r') as stream:
                 config = yaml.safe_load(stream)
 
@@ -44,30 +67,57 @@ class IntroBot(commands.Cog):
             self.questions = config['questions']
             self.intro_message_title = config['intro_message_title']
             self.intro_message_description = config['intro_message_description']
-            self.timeout_offset = datetime.timedelta(0, config['timeout_offset'])
+            self.timeout_offset = round(config['timeout_offset']) # seconds
 
     class Question():
         '''
-        Stores info a single question asked
+        Stores info a single question asked. Times are integer epoch seconds.
         '''
-        def __init__(self, question):
-            current_time = datetime.datetime.now()
+        __slots__ = ('question', 'response', 'time_asked', 'time_responded')
+
+        def __init__(self, question, current_time):
             self.question = question
             self.response = ""
             self.time_asked = current_time
             self.time_responded = None
 
+        def to_record(self):
+            return {
+                'question': self.question,
+                'response': self.response,
+                'time_asked': self.time_asked,
+                'time_responded': self.time_responded,
+            }
+
+        @classmethod
+        def from_record(cls, record):
+            question = cls.__new__(cls)
+            question.question = record['question']
+            question.response = record['response']
+            # int() also reads records written with float timestamps
+            question.time_asked = int(record['time_asked'])
+            if record['time_responded'] is None:
+                question.time_responded = None
+            else:
+                question.time_responded = int(record['time_responded'])
+            return question
+
     class Member():
         '''
-        Stores information about a user ID
+        Stores information about a user ID. Times are integer epoch seconds;
+        finish_time is set once every question has been answered, reminded
+        once they've been told the ticket is about to time out.
         '''
-        def __init__(self, name, channel, timeout_offset):
-            current_time = datetime.datetime.now()
+        __slots__ = ('name', 'channel', 'questions', 'add_time', 'timeout', 'finish_time', 'reminded')
+
+        def __init__(self, name, channel, current_time, timeout_offset):
             self.name = name
             self.channel = channel
             self.questions = []
             self.add_time = current_time
             self.timeout = current_time + timeout_offset
+            self.finish_time = None
+            self.reminded = False
         
         def add_question(self, question):
             self.questions.append(question)
@@ -75,98 +125,272 @@ class IntroBot(commands.Cog):
         def get_current_question_index(self):
             return len(self.questions)
 
-        def record_response(self, response):
-            current_time = datetime.datetime.now()
+        def record_response(self, response, current_time):
             question_idx = self.get_current_question_index()
             self.questions[question_idx-1].response = response
             self.questions[question_idx-1].time_responded = current_time
 
+        def to_record(self):
+            return {
+                'name': self.name,
+                'channel': self.channel,
+                'questions': [question.to_record() for question in self.questions],
+                'add_time': self.add_time,
+                'timeout': self.timeout,
+                'finish_time': self.finish_time,
+                'reminded': self.reminded,
+            }
+
+        @classmethod
+        def from_record(cls, record):
+            member = cls.__new__(cls)
+            member.name = record['name']
+            member.channel = record['channel']
+            member.questions = [IntroBot.Question.from_record(question) for question in record['questions']]
+            member.add_time = int(record['add_time'])
+            member.timeout = int(record['timeout'])
+            member.finish_time = record.get('finish_time')
+            member.reminded = record.get('reminded', False)
+            return member
+
     class Log():
         '''
-        Stores information about all user ID being verified, indexed by ID
+        Stores information about all user ID being verified, indexed by ID.
+        Finished verifications are kept for PESUKARHU_INTRO_RETENTION_TIME
+        so verifiers can still look at them, and at most
+        PESUKARHU_INTRO_MAX_FINISHED of them are kept at all. With
+        PESUKARHU_INTRO_EXPIRE_TICKETS=1 unfinished ones get a reminder
+        PESUKARHU_INTRO_REMINDER_LEAD seconds before their timeout and are
+        expired at it; otherwise they stay open until answered. release is
+        called with the ticket channel of every verification dropped from
+        the log.
         '''
-        def __init__(self, bot, settings):
+        # Expiry is refused below this timeout (seconds), so a leftover test
+        # value can't close tickets before anybody could answer them
+        min_timeout = 3600
+
+        def __init__(self, bot, settings, store, release):
             self.bot = bot
+            self.clock = pesukarhu.clock.get_clock(bot)
             self.settings = settings
+            self.store = store
+            self.release = release
+            logging.info(f'Initializing IntroBot Log:')
+            self.load_settings()
+            # Next reminder / timeout / retention deadline of every ticket
+            self.deadlines = pesukarhu.deadline_index.DeadlineIndex(self.clock)
             self.log = {}
+            # Reverse index of ticket channel ID to the member it belongs to,
+            # so on_message can reject non-ticket channels without a scan
+            self.channels = {}
+            # Finished verifications, oldest first, so trimming only ever
+            # looks at the front
+            self.finished = collections.OrderedDict()
+            # Rendered $show_log rows, dropped whenever a verification changes
+            self.rows = pesukarhu.paged_view.RowCache(self.render_row)
+            # Resume verifications that were in progress before a restart
+            for id, record in self.store.load('intro_member').items():
+                self.log[id] = IntroBot.Member.from_record(record)
+                self.channels[self.log[id].channel] = id
+            for id, member in sorted(self.log.items(), key=lambda item: item[1].finish_time or 0):
+                if member.finish_time is not None:
+                    self.finished[id] = member.finish_time
+            for id in self.log:
+                self.schedule(id)
+            logging.info(f'Restored {len(self.log)} verifications ({len(self.finished)} finished)')
+            self.trim()
+
+        def load_settings(self):
+            self.retention_time = round(float(os.getenv('PESUKARHU_INTRO_RETENTION_TIME', '86400')))
+            self.max_finished = int(os.getenv('PESUKARHU_INTRO_MAX_FINISHED', '200'))
+            self.expire = os.getenv('PESUKARHU_INTRO_EXPIRE_TICKETS', '0') == '1'
+            if(self.expire and (self.settings.timeout_offset < self.min_timeout)):
+                logging.error(f'Ticket timeout of {self.settings.timeout_offset}s is under {self.min_timeout}s, not expiring tickets')
+                self.expire = False
+            # Never remind before half the timeout has passed
+            self.reminder_lead = min(round(float(os.getenv('PESUKARHU_INTRO_REMINDER_LEAD', '3600'))),
+                                     self.settings.timeout_offset // 2)
+            logging.info(f'   retention time = {self.retention_time} (sec)')
+            logging.info(f'   max finished = {self.max_finished}')
+            logging.info(f'   expire tickets = {self.expire}')
+            logging.info(f'   reminder lead = {self.reminder_lead} (sec)')
+
+        def reload_settings(self):
+            # Open tickets keep the timeout they were given; reminders and
+            # retention move to the new values
+            self.load_settings()
+            for id in self.log:
+                self.schedule(id)
+            self.trim()
+
+        def save(self, id):
+            self.rows.invalidate(id)
+            self.store.save('intro_member', id, self.log[id].to_record())
+
+        def schedule(self, id):
+            # Each ticket has one next deadline: the reminder, then the
+            # timeout while unfinished (if they expire); removal once
+            # finished
+            member = self.log[id]
+            if member.finish_time is not None:
+                self.deadlines.schedule(id, member.finish_time + self.retention_time)
+            elif not self.expire:
+                # Open until answered
+                self.deadlines.cancel(id)
+            elif not member.reminded:
+                self.deadlines.schedule(id, member.timeout - self.reminder_lead)
+            else:
+                self.deadlines.schedule(id, member.timeout)
         
         def add_user(self, id, name, channel):
-            logging.info(f'Adding user: {id} - {name} - channel: {channel}')
-            self.log[id] = IntroBot.Member(name, channel, self.settings.timeout_offset)
+            logging.info(f'Adding user: {id} - {name} - channel: {channel}', extra={'event': 'ticket_opened', 'member': id, 'channel': channel})
+            if id in self.log:
+                # Re-triggered verification; the old ticket no longer routes here
+                self.channels.pop(self.log[id].channel, None)
+                self.finished.pop(id, None)
+                if(self.log[id].channel != channel):
+                    self.release(self.log[id].channel)
+            self.log[id] = IntroBot.Member(name, channel, int(self.clock.time()), self.settings.timeout_offset)
+            self.channels[channel] = id
+            self.save(id)
+            self.schedule(id)
+            self.trim()
 
         def add_question(self, id, question):
-            self.log[id].add_question(IntroBot.Question(question))
+            self.log[id].add_question(IntroBot.Question(question, int(self.clock.time())))
+            self.save(id)
 
         def get_current_question_index(self, id):
             return self.log[id].get_current_question_index()
 
         def record_response(self, id, response):
-            self.log[id].record_response(response)
-
-        def remove_user(self, id):
-            logging.info(f'Removing user: {id}')
+            self.log[id].record_response(response, int(self.clock.time()))
+            self.save(id)
+
+        def finish_user(self, id):
+            # Answered everything; starts the retention clock. A follow up
+            # question answered later moves them back to the end
+            current_time = int(self.clock.time())
+            self.log[id].finish_time = current_time
+            self.finished.pop(id, None)
+            self.finished[id] = current_time
+            self.save(id)
+            self.schedule(id)
+            self.trim()
+
+        def set_reminded(self, id):
+            self.log[id].reminded = True
+            self.save(id)
+            self.schedule(id)
+
+        def trim(self):
+            # Drop the oldest finished verifications over the cap; expiry by
+            # age goes through the deadlines
+            while(len(self.finished) > self.max_finished):
+                self.remove_user(next(iter(self.finished)))
+
+        def remove_user(self, id, release=True):
+            logging.info(f'Removing user: {id}', extra={'event': 'ticket_removed', 'member': id})
+            self.channels.pop(self.log[id].channel, None)
+            self.finished.pop(id, None)
+            self.deadlines.cancel(id)
+            if release:
+                self.release(self.log[id].channel)
             del self.log[id]
+            self.rows.invalidate(id)
+            self.store.delete('intro_member', id)
+
+        def pop_due(self, current_time):
+            return self.deadlines.pop_due(current_time)
+
+        async def wait_for_deadline(self, max_delay):
+            await self.deadlines.wait(self.clock.time(), max_delay)
+
+        def get_channel_owner(self, channel):
+            return self.channels.get(channel)
 
         def get_member(self, id):
             return self.log[id]
 
-        def get_embed(self):
-            current_time = datetime.datetime.now()
-
-            if(len(self.log) == 0):
-                id_string = "Empty"
-                channel_string = "Empty"
-                age_string = "Empty"
-            else:
-                id_string = ""
-                channel_string = ""
-                age_string = ""
-
-                guild = self.bot.get_guild(self.settings.guild)
-
-                for key, member in self.log.items():
-                    age = current_time - member.add_time # as timedelta object
-                    age = age.total_seconds() # as float
-
-                    new_id = f'<@{key}>\n'
-                    ticket_channel = guild.get_channel(member.channel)
-                    new_channel = f'{ticket_channel.mention} ({member.get_current_question_index()})\n'
-                    new_age = f'{member.add_time.strftime("%Y%m%d|%H:%M:%S")} ({age:.0f})\n'
-                    # Check to make sure we don't exceed 1024 characters per field. We
-                    # won't hit the 6000 character total limit
-                    if((len(id_string) + len(new_id) <= 1000) and \
-                       (len(channel_string) + len(new_channel) <= 1000) and \
-                       (len(age_string) + len(new_age) <= 1000)):
-                        id_string += new_id
-                        channel_string += new_channel
-                        age_string += new_age
-                    else:
-                        break
-
-            embed=discord.Embed(title=f'Verification list: ({len(self.log)} members)')
-            embed.add_field(name="Name", value=id_string, inline=True) 
-            embed.add_field(name="Progress", value=channel_string, inline=True)
-            embed.add_field(name="Age", value=age_string, inline=True)
-
-            return embed
+        @staticmethod
+        def get_state(member):
+            if member.finish_time is not None:
+                return 'finished'
+            if member.reminded:
+                return 'reminded'
+            return 'open'
+
+        def render_row(self, id):
+            member = self.log.get(id)
+            if member is None:
+                return (f'<@{id}>', 'Gone', 'Gone')
+            # Plain mention works for channels, cached or not;
+            # Discord keeps the age current in the reader's timezone
+            return (f'<@{id}>',
+                    f'<#{member.channel}> ({member.get_current_question_index()}, {self.get_state(member)})',
+                    f'<t:{member.add_time}:f> (<t:{member.add_time}:R>)')
+
+        def get_view(self, state=None, max_age=None):
+            '''
+            Paged listing of the verifications, optionally only those in
+            state (open, reminded or finished) and / or started at most
+            max_age seconds ago
+            '''
+            current_time = int(self.clock.time())
+            ids = [id for id, member in self.log.items()
+                   if(((state is None) or (self.get_state(member) == state)) and
+                      ((max_age is None) or (current_time - member.add_time <= max_age)))]
+            filters = []
+            if state is not None:
+                filters.append(state.capitalize())
+            if max_age is not None:
+                filters.append(f'started in the last {max_age}s')
+            return pesukarhu.paged_view.PagedView(f'Verification list: ({len(ids)} of {len(self.log)} members)',
+                                                  ('Name', 'Progress', 'Age'), ids, self.rows,
+                                                  description=', '.join(filters) if filters else None)
 
     def __init__(self, bot):
         self.bot = bot
+        self.clock = pesukarhu.clock.get_clock(bot)
         self.settings = self.Settings('intro_bot_settings.yaml')
-        self.log = self.Log(bot, self.settings)
-        self.state = self.State('intro_bot_state.yaml')
+        store = pesukarhu.state_store.get_state_store(bot)
+        handover = pesukarhu.extensions.take_over(bot, 'IntroBot')
+        # On a reload state and the log are rebuilt from the store, whose
+        # reads include every change the old cog made, written yet or not
+        self.state = self.State('intro_bot_state.yaml', store)
+        if handover is None:
+            self.tickets = pesukarhu.ticket_pool.TicketPool(bot, self.settings, self.state, store)
+            # Everything touching one member's ticket runs in order; tickets of
+            # different members proceed concurrently
+            self.members = pesukarhu.keyed_executor.KeyedExecutor(bot, 'intro_members')
+        else:
+            # Ready channels, waiting claims and per member ordering carry on
+            self.tickets = handover['tickets']
+            self.tickets.rebind(self.settings, self.state)
+            self.tickets.refill_soon()
+            self.members = handover['members']
+        self.actions = pesukarhu.action_queue.get_action_queue(bot)
+        self.log = self.Log(bot, self.settings, store, self.release_ticket)
+        self.refresh_period = float(os.getenv('PESUKARHU_INTRO_REFRESH_PERIOD', '60.0'))
+        # Only ticket channels are routed to us; the channel index is live so
+        # new tickets are picked up without resubscribing
+        self.dispatcher = pesukarhu.message_dispatch.get_dispatcher(bot)
+        self.dispatcher.subscribe(self.handle_message, name='IntroBot', channel_ids=self.log.channels)
         logging.info(f'Initializing IntroBot:')
         logging.info(f'   prefix = "{self.settings.prefix}"')
         for question in self.settings.questions:
             logging.info(f'   question = "{question}"')
+        logging.info(f'   refresh period = {self.refresh_period} (sec)')
         # Setup some random color constants
         self.red = 0xFF4500
         self.green = 0x32CD32
         self.yellow = 0xFFFF00
+        self.ticket_maintenance.start()
 
     @commands.Cog.listener()
     async def on_ready(self):
         logging.info(f'{self.bot.user} is enabled')
+        self.tickets.refill_soon()
 
     @commands.command()
     async def create_intro(self, ctx):
@@ -175,6 +399,7 @@ class IntroBot(commands.Cog):
 
         message = await ctx.send(embed=embed)
         self.state.intro_id = message.id
+        self.state.store()
         emojis = ['🚫', '✅', '⛔']
         for emoji in emojis:
             await message.add_reaction(emoji)
@@ -199,10 +424,10 @@ class IntroBot(commands.Cog):
         self.log.add_question(id, question)
         member = self.log.get_member(id)
         guild = self.bot.get_guild(self.settings.guild)
-        channel = guild.get_channel(ticket_channel)
+        channel = await self.tickets.resolve(guild, ticket_channel)
         success = await channel.send(f'<@{id}>: **Question {question_idx+1}**: {question}')
         if success:
-            logging.info(f'Sent member {member.name} question {question}')
+            logging.info(f'Sent member {member.name} question {question}', extra={'event': 'question_sent', 'member': id, 'channel': ticket_channel})
         else:
             logging.info(f'Failed to send member {member.name} question {question}')
 
@@ -222,18 +447,22 @@ class IntroBot(commands.Cog):
         # Verify second part is a number. Should use a converter here with an exception, but I can't figure out how to make the converters work
         if(str.isdigit(id)):
             id = int(id)
-            member = self.log.get_member(id)
-            logging.info(f'{ctx.author.display_name} sent additional message to user ID {id} | {member.name}: {ctx.message.content}')
-            guild = self.bot.get_guild(self.settings.guild)
-            channel = guild.get_channel(member.channel)
-            await channel.send('We have an additional clarification question for you.')
-            await self.send_question(id, question, member.channel)
+            logging.info(f'{ctx.author.display_name} sent additional message to user ID {id}: {ctx.message.content}')
+            await self.members.run(id, functools.partial(self.send_clarification, id, question))
         else:
             logging.info(f'{ctx.author.display_name} attempted to send additional question with message {ctx.message.content}')
             await ctx.send(f'Huh? {id} is not a number')
             return
 
+    async def send_clarification(self, id, question):
+        member = self.log.get_member(id)
+        guild = self.bot.get_guild(self.settings.guild)
+        channel = await self.tickets.resolve(guild, member.channel)
+        await channel.send('We have an additional clarification question for you.')
+        await self.send_question(id, question, member.channel)
+
     @commands.Cog.listener()
+    @pesukarhu.telemetry.timed()
     async def on_raw_reaction_add(self, payload):
         member = payload.member
         if member.bot: 
@@ -242,62 +471,188 @@ class IntroBot(commands.Cog):
 
         if payload.message_id == self.state.intro_id:
             if payload.emoji.name == '✅':
-                logging.info(f'{payload.member.display_name} triggered verification react')
-                # Create ticket channel
-                guild = self.bot.get_guild(payload.guild_id)
-                ticket_channel = await guild.create_text_channel(f'verify-{self.state.ticket_count}')
-                await ticket_channel.set_permissions(guild.get_role(guild.id), send_messages=False, read_messages=False)
-                await ticket_channel.set_permissions(guild.get_role(self.settings.verifier_role), send_messages=True, read_messages=True, add_reactions=True, embed_links=True, attach_files=True, read_message_history=True, external_emojis=True)
-                await ticket_channel.set_permissions(guild.get_member(payload.member.id), send_messages=True, read_messages=True, add_reactions=True, embed_links=True, attach_files=True, read_message_history=True, external_emojis=True)
-                self.state.ticket_count += 1
-                self.state.store()
-                # Add user to log
-                self.log.add_user(payload.member.id, payload.member.display_name, ticket_channel.id)
-                # Send prefix to channel
-                await ticket_channel.send(self.settings.prefix)
-                # Send first question in list
-                await self.send_next_question(payload.member.id, ticket_channel.id)
+                try:
+                    await self.members.run(payload.member.id, functools.partial(self.start_verification, payload))
+                except self.members.QueueFull as e:
+                    logging.warning(f'Ignoring verification react from {payload.member.id}: {e}')
+
+    async def start_verification(self, payload):
+        logging.info(f'{payload.member.display_name} triggered verification react', extra={'event': 'verification_react', 'member': payload.member.id})
+        # Take a ticket channel from the pool
+        guild = self.bot.get_guild(payload.guild_id)
+        ticket_channel = await self.tickets.claim(guild, payload.member)
+        # Add user to log
+        self.log.add_user(payload.member.id, payload.member.display_name, ticket_channel.id)
+        # Send prefix to channel
+        await ticket_channel.send(self.settings.prefix)
+        # Send first question in list
+        await self.send_next_question(payload.member.id, ticket_channel.id)
+
+    def cog_unload(self):
+        self.dispatcher.unsubscribe(self.handle_message)
+        self.tickets.cancel()
+        self.ticket_maintenance.cancel()
+
+    def reload_settings(self):
+        '''
+        Re-reads intro_bot_settings.yaml and the ticket thresholds from the
+        environment (already reloaded from .env by the caller)
+        '''
+        logging.info(f'Reloading IntroBot settings:')
+        self.settings.load()
+        self.log.reload_settings()
+        self.refresh_period = float(os.getenv('PESUKARHU_INTRO_REFRESH_PERIOD', '60.0'))
+        logging.info(f'   refresh period = {self.refresh_period} (sec)')
+
+    def export_state(self):
+        # Objects from other modules only; anything defined in this module
+        # is rebuilt by the reloaded code
+        return {
+            'tickets': self.tickets,
+            'members': self.members,
+        }
+
+    @tasks.loop(seconds=0) # paced by the deadline wait
+    async def ticket_maintenance(self):
+        await self.log.wait_for_deadline(self.refresh_period)
+        with pesukarhu.telemetry.measure(self.bot, 'IntroBot.ticket_maintenance_tick'):
+            self.process_due_tickets()
+
+    @ticket_maintenance.before_loop
+    async def before_ticket_maintenance(self):
+        await self.bot.wait_until_ready()
+
+    def process_due_tickets(self):
+        for id in self.log.pop_due(int(self.clock.time())):
+            member = self.log.get_member(id)
+            self.actions.submit(functools.partial(self.members.run, id, functools.partial(self.handle_deadline, id)),
+                                self.actions.Priority.MESSAGE, ('channel', member.channel),
+                                key=(id, 'deadline'), description=f'ticket deadline {id}')
+
+    async def handle_deadline(self, id):
+        # Runs in the member's turn, so it can't cut into an answer being
+        # processed - which also means the ticket may have moved on since
+        # the deadline came due
+        if id not in self.log.log:
+            return
+        member = self.log.get_member(id)
+        current_time = int(self.clock.time())
+        if member.finish_time is not None:
+            if(member.finish_time + self.log.retention_time <= current_time):
+                # Retention is over
+                self.log.remove_user(id)
+                return
+        elif not self.log.expire:
+            # Expiry was turned off after this came due
+            return
+        elif((not member.reminded) and (member.timeout - self.log.reminder_lead <= current_time < member.timeout)):
+            self.log.set_reminded(id)
+            await self.remind(id, member.channel, member.timeout)
+            return
+        elif(member.timeout <= current_time):
+            logging.info(f'Verification of {id} | {member.name} timed out')
+            self.log.remove_user(id, release=False)
+            await self.close_ticket(id, member.name, member.channel)
+            return
+        self.log.schedule(id)
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
-        if message.author.bot:
-            # don't respond to myself or other bots
+    async def remind(self, id, channel_id, timeout):
+        guild = self.bot.get_guild(self.settings.guild)
+        channel = await self.tickets.resolve(guild, channel_id)
+        if channel is None:
             return
+        await channel.send(f'<@{id}> - this verification ticket closes <t:{timeout}:R> if the questions aren\'t answered')
 
-        if isinstance(message.channel, discord.channel.TextChannel):
-            found = False
-
-            for key, member in self.log.log.items():
-                if(message.channel.id == member.channel):
-                    found = True
-                    break
-
-            if found:
-                # Record response
-                logging.info(f'{message.author.display_name} sent response: {message.content}')
-                self.log.record_response(message.author.id, message.content)
-                # Check if we have more to send
-                if(self.log.get_current_question_index(message.author.id) >= len(self.settings.questions)):
-                    logging.info(f'{message.author.display_name} sent last response!')
-                    await message.channel.send('That\'s the last question. Our verification team will either verify your account, ask further question, or deny your application.')
-                    # Send responses to log
-                    log_channel = self.bot.get_channel(self.settings.log_channel)
-                    embed=discord.Embed(color=self.yellow)
-                    embed.add_field(name="Mention (ID)", value=f'<@{message.author.id}> ({message.author.id})', inline=True) 
-                    embed.add_field(name="Channel", value=f'{message.channel.mention}', inline=True) 
-                    for question in self.log.get_member(message.author.id).questions:
-                        difference = question.time_responded - question.time_asked
-                        time = difference.total_seconds()
-                        embed.add_field(name=f'{question.question} (took {time:.0f}s to respond)', value=f'{question.response}', inline=False)
-                    embed.set_author(name=f'{message.author.display_name} completed verification questions', icon_url=message.author.avatar_url)
-                    await log_channel.send(embed=embed)
-                    await log_channel.send(f'**Follow-up options:**')
-                    await log_channel.send(f'$approve {message.author.id}')
-                    await log_channel.send(f'$ask_question {message.author.id} <question>')
-                    await log_channel.send(f'$reject {message.author.id}')
-                else:
-                    await self.send_next_question(message.author.id, message.channel.id)
+    async def close_ticket(self, id, name, channel_id):
+        # Timed out: tell them and the verifiers, then release the ticket
+        # like any other
+        guild = self.bot.get_guild(self.settings.guild)
+        channel = await self.tickets.resolve(guild, channel_id)
+        if channel is not None:
+            try:
+                await channel.send(f'<@{id}> - this verification ticket timed out and has been closed. React to the intro message again to start over.')
+            except discord.HTTPException as e:
+                logging.info(f'Could not post timeout notice for {id} | {name}: {e}')
+        embed=discord.Embed(color=self.red, description=f'<@{id}> ({id}) {name} did not finish verification in time, ticket closed')
+        log_channel = self.bot.get_channel(self.settings.log_channel)
+        await log_channel.send(embed=embed)
+        await self.tickets.release(channel_id)
+
+    def release_ticket(self, channel_id):
+        # The ticket's done with; the backend deletes or archives it in the
+        # background
+        self.actions.submit(functools.partial(self.tickets.release, channel_id),
+                            self.actions.Priority.LOG, ('ticket_release', self.settings.guild),
+                            key=(channel_id, 'release'), description=f'release ticket {channel_id}')
+
+    def get_metrics(self):
+        metrics = {
+            'intro_log_size': len(self.log.log),
+            'intro_ticket_channels': len(self.log.channels),
+        }
+        metrics.update(self.tickets.get_metrics())
+        metrics.update(self.members.get_metrics())
+        return metrics
+
+    async def handle_message(self, parsed):
+        message = parsed.message
+        owner = self.log.get_channel_owner(message.channel.id)
+        if owner is None:
+            # not a ticket channel
+            return
+
+        if message.author.id != owner:
+            # verifiers can talk in the ticket too; only the owner answers questions
+            logging.info(f'{message.author.display_name} spoke in ticket of {owner}, not recording as response', extra={'event': 'ticket_chatter', 'member': message.author.id, 'channel': message.channel.id})
+            return
+
+        # One answer at a time, so quick messages can't skip or repeat a question
+        try:
+            await self.members.run(owner, functools.partial(self.record_answer, message, owner))
+        except self.members.QueueFull as e:
+            logging.warning(f'Dropping response from {owner}: {e}')
+
+    async def record_answer(self, message, owner):
+        if(self.log.get_channel_owner(message.channel.id) != owner):
+            # Ticket closed while this message waited its turn
+            return
+
+        # Record response
+        logging.info(f'{message.author.display_name} sent response: {message.content}', extra={'event': 'ticket_response', 'member': message.author.id, 'channel': message.channel.id})
+        self.log.record_response(owner, message.content)
+        # Check if we have more to send
+        if(self.log.get_current_question_index(owner) >= len(self.settings.questions)):
+            logging.info(f'{message.author.display_name} sent last response!')
+            await message.channel.send('That\'s the last question. Our verification team will either verify your account, ask further question, or deny your application.')
+            # Send responses to log
+            log_channel = self.bot.get_channel(self.settings.log_channel)
+            embed=discord.Embed(color=self.yellow)
+            embed.add_field(name="Mention (ID)", value=f'<@{owner}> ({owner})', inline=True) 
+            embed.add_field(name="Channel", value=f'{message.channel.mention}', inline=True) 
+            for question in self.log.get_member(owner).questions:
+                took = question.time_responded - question.time_asked
+                embed.add_field(name=f'{question.question} (took {took}s to respond)', value=f'{question.response}', inline=False)
+            embed.set_author(name=f'{message.author.display_name} completed verification questions', icon_url=message.author.avatar_url)
+            await log_channel.send(embed=embed)
+            await log_channel.send(f'**Follow-up options:**')
+            await log_channel.send(f'$approve {owner}')
+            await log_channel.send(f'$ask_question {owner} <question>')
+            await log_channel.send(f'$reject {owner}')
+            # Only now, once the answers have been posted, can it be trimmed
+            self.log.finish_user(owner)
+        else:
+            await self.send_next_question(owner, message.channel.id)
 
     @commands.command()
-    async def show_log(self, ctx):
-        await ctx.send(embed=self.log.get_embed())
+    async def show_log(self, ctx, *filters):
+        # $show_log [open|reminded|finished] [max age], eg $show_log open 1h
+        states = {state: state for state in ('open', 'reminded', 'finished')}
+        parsed = pesukarhu.paged_view.parse_filters(filters, states)
+        if parsed is None:
+            await ctx.send(f'Huh? Filter by state ({", ".join(states)}) and / or age like 30s, 5m or 1h - ie, $show_log open 1h')
+            return
+        state, max_age = parsed
+        await self.log.get_view(state, max_age).show(ctx)
+
+def setup(bot):
+    bot.add_cog(IntroBot(bot))
@@ -0,0 +1,78 @@
+import os
+import time
+import asyncio
+from dotenv import load_dotenv
+import logging
+import pesukarhu.telemetry
+
+class KeyedExecutor():
+    '''
+    Runs coroutines one at a time per key (eg a member ID) and concurrently
+    across keys. Calls for one key run in the order run() was called, so an
+    event can't overtake an earlier one for the same member across an
+    await, while other members carry on. A key costs nothing once its last
+    call finishes. At most PESUKARHU_KEYED_QUEUE_SIZE calls may wait on one
+    key; past that run() raises QueueFull, so one flooding member can't pile
+    up unbounded work.
+    '''
+    class QueueFull(Exception):
+        pass
+
+    class Slot():
+        __slots__ = ('lock', 'pending')
+
+        def __init__(self):
+            self.lock = asyncio.Lock()
+            self.pending = 0
+
+    def __init__(self, bot, name):
+        self.bot = bot
+        self.name = name
+        load_dotenv()
+        self.max_pending = int(os.getenv('PESUKARHU_KEYED_QUEUE_SIZE', '32'))
+        logging.info(f'Initializing KeyedExecutor {self.name}:')
+        logging.info(f'   max pending per key = {self.max_pending}')
+        self.slots = {}
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.max_depth = 0
+
+    async def run(self, key, factory):
+        '''
+        Awaits factory() once every earlier call for key has finished and
+        returns its result
+        '''
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self.slots[key] = self.Slot()
+        if(slot.pending >= self.max_pending):
+            self.rejected += 1
+            raise self.QueueFull(f'{self.name}: {slot.pending} calls already waiting on {key}')
+        slot.pending += 1
+        self.pending += 1
+        if(slot.pending > self.max_depth):
+            self.max_depth = slot.pending
+        start = time.perf_counter()
+        try:
+            # asyncio.Lock hands over in the order it was waited on
+            async with slot.lock:
+                pesukarhu.telemetry.record(self.bot, f'{self.name}.key_wait', time.perf_counter() - start)
+                result = await factory()
+                self.completed += 1
+                return result
+        finally:
+            slot.pending -= 1
+            self.pending -= 1
+            if((slot.pending == 0) and (self.slots.get(key) is slot)):
+                del self.slots[key]
+
+    def get_metrics(self):
+        prefix = self.name.lower()
+        return {
+            f'{prefix}_keys_active': len(self.slots),
+            f'{prefix}_calls_pending': self.pending,
+            f'{prefix}_calls_completed': self.completed,
+            f'{prefix}_calls_rejected': self.rejected,
+            f'{prefix}_max_key_depth': self.max_depth,
+        }
@@ -0,0 +1,116 @@
+import os
+import itertools
+import collections
+import functools
+import discord
+from dotenv import load_dotenv
+import logging
+import pesukarhu.clock
+
+class LogSink():
+    '''
+    Coalesces events bound for one log channel. Events are buffered for up
+    to batch_window seconds or batch_size events, then sent as a single
+    message; a lone event is sent as its own embed like before. When one
+    kind of event reaches summary_threshold inside a batch (eg a join storm)
+    it is collapsed into a one line summary, and the full list is kept for
+    $log_details.
+    '''
+    def __init__(self, bot, actions, channel_id):
+        self.bot = bot
+        self.clock = pesukarhu.clock.get_clock(bot)
+        self.actions = actions
+        self.channel_id = channel_id
+        load_dotenv()
+        self.batch_window = float(os.getenv('PESUKARHU_LOG_BATCH_WINDOW', '2.0'))
+        self.batch_size = int(os.getenv('PESUKARHU_LOG_BATCH_SIZE', '25'))
+        self.summary_threshold = int(os.getenv('PESUKARHU_LOG_SUMMARY_THRESHOLD', '10'))
+        self.history_size = int(os.getenv('PESUKARHU_LOG_HISTORY_SIZE', '50'))
+        logging.info(f'Initializing LogSink for channel {self.channel_id}:')
+        logging.info(f'   batch window = {self.batch_window} (sec)')
+        logging.info(f'   batch size = {self.batch_size}')
+        logging.info(f'   summary threshold = {self.summary_threshold}')
+        self.events = []
+        self.first_time = None
+        self.timer = None
+        self.batch_counter = itertools.count(1)
+        self.batches = collections.deque(maxlen=self.history_size)
+
+    @staticmethod
+    def paginate(lines, limit=2000):
+        '''
+        Joins lines into strings of at most limit characters (embed
+        description limit), never splitting a line
+        '''
+        pages = []
+        page = ''
+        for line in lines:
+            if((len(page) + len(line) + 1 > limit) and (page != '')):
+                pages.append(page)
+                page = ''
+            page += line[:limit] + '\n'
+        if(page != ''):
+            pages.append(page)
+        return pages
+
+    def send(self, content=None, embed=None):
+        channel = self.bot.get_channel(self.channel_id)
+        if channel is None:
+            return
+        self.actions.submit(functools.partial(channel.send, content, embed=embed),
+                            self.actions.Priority.LOG, ('channel', self.channel_id),
+                            description=f'log to channel {self.channel_id}')
+
+    def post(self, category, line, embed=None):
+        '''
+        Queues an event. category groups events for summaries (eg "joins"),
+        line is its one line form used inside batches, and embed (optional)
+        is what gets sent if the event ends up alone in its batch.
+        '''
+        if(self.batch_window <= 0):
+            self.send(content=line if embed is None else None, embed=embed)
+            return
+        self.events.append((category, line, embed))
+        if(len(self.events) == 1):
+            self.first_time = self.clock.monotonic()
+            self.timer = self.clock.call_later(self.batch_window, self.flush)
+        if(len(self.events) >= self.batch_size):
+            self.flush()
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        events = self.events
+        self.events = []
+        if(len(events) == 0):
+            return
+        if(len(events) == 1):
+            category, line, embed = events[0]
+            self.send(content=line if embed is None else None, embed=embed)
+            return
+        elapsed = self.clock.monotonic() - self.first_time
+        categories = {}
+        for category, line, embed in events:
+            categories.setdefault(category, []).append(line)
+        lines = []
+        for category, category_lines in categories.items():
+            if(len(category_lines) >= self.summary_threshold):
+                batch_id = next(self.batch_counter)
+                self.batches.append((batch_id, category, category_lines))
+                lines.append(f'**{len(category_lines)} {category} in {elapsed:.0f}s** - details: `$log_details {batch_id}`')
+            else:
+                lines.extend(category_lines)
+        for page in self.paginate(lines):
+            embed=discord.Embed(title=f'{len(events)} events in {elapsed:.0f}s', description=page)
+            self.send(embed=embed)
+
+    def get_details(self, batch_id):
+        '''
+        Returns (category, lines) of a summarized batch, or None if it has
+        aged out of the history
+        '''
+        for entry_id, category, lines in self.batches:
+            if(entry_id == batch_id):
+                return category, lines
+        return None
@@ -7,7 +7,22 @@ from discord.ext.commands import bot
 from dotenv import load_dotenv
 import logging
 import enum
+import asyncio
+import functools
+import bisect
+import array
 import pytimeparse.timeparse
+import pesukarhu.deadline_index
+import pesukarhu.raid_detector
+import pesukarhu.action_queue
+import pesukarhu.log_sink
+import pesukarhu.state_store
+import pesukarhu.telemetry
+import pesukarhu.keyed_executor
+import pesukarhu.extensions
+import pesukarhu.gateway
+import pesukarhu.paged_view
+import pesukarhu.clock
 
 class MemberMonitor(commands.Cog):
     class MemberState(enum.Enum):
@@ -16,15 +31,28 @@ class MemberMonitor(commands.Cog):
         VERIFIED = enum.auto()
         REMOVED = enum.auto()
 
+    class RaidMode(enum.Enum):
+        NORMAL = enum.auto() # every join gets an embed and verification timers
+        RAID = enum.auto() # joins are counted, logged in one line and queued for the raid action
+
+    fetch_page_size = 1000 # members per fetch_members request, Discord's maximum
+    reconcile_period = 10.0 # seconds between reconciles while the guild chunks
+
+    @staticmethod
+    def format_time(epoch):
+        return datetime.datetime.fromtimestamp(epoch).strftime("%Y%m%d|%H:%M:%S")
+
     class Member():
         '''
         Stores info about users who joined. name is at entry time; may not be
         accurate if user changes their name. ID is assumed to be the key for
         a dictionary storing Members, so its not explicitly stored as part of
-        the Member object.
+        the Member object. Times are integer epoch seconds and the fields are
+        slotted, so a member costs a fraction of a dict backed object.
         '''
-        def __init__(self, name, warn_time_offset, kick_time_offset):
-            current_time = datetime.datetime.now()
+        __slots__ = ('name', 'add_time', 'warn_time', 'kick_time', 'trim_retention_time', 'state')
+
+        def __init__(self, name, current_time, warn_time_offset, kick_time_offset):
             self.name = name
             self.add_time = current_time
             self.warn_time = current_time + warn_time_offset
@@ -32,121 +60,228 @@ class MemberMonitor(commands.Cog):
             self.trim_retention_time = None # to be filled in later
             self.state = MemberMonitor.MemberState.UNVERIFIED
 
+        def to_record(self):
+            return {
+                'name': self.name,
+                'add_time': self.add_time,
+                'warn_time': self.warn_time,
+                'kick_time': self.kick_time,
+                'trim_retention_time': self.trim_retention_time,
+                'state': self.state.name,
+            }
+
+        @classmethod
+        def from_record(cls, record):
+            member = cls.__new__(cls)
+            member.name = record['name']
+            # int() also reads records written with float timestamps
+            member.add_time = int(record['add_time'])
+            member.warn_time = int(record['warn_time'])
+            member.kick_time = int(record['kick_time'])
+            if record['trim_retention_time'] is None:
+                member.trim_retention_time = None
+            else:
+                member.trim_retention_time = int(record['trim_retention_time'])
+            member.state = MemberMonitor.MemberState[record['state']]
+            return member
+
     class MemberList():
-        def __init__(self):
+        def __init__(self, store, clock):
             self.member_list = {}
+            self.store = store
+            self.clock = clock
+            # Next state transition time of every member, so maintenance only
+            # has to look at members that are actually due
+            self.deadlines = pesukarhu.deadline_index.DeadlineIndex(clock)
+            # Join times and IDs as two parallel columns sorted by time, so a
+            # join time range is two bisects. Arrays of machine ints take 16
+            # bytes per join instead of a tuple and two int objects
+            self.join_times = array.array('q')
+            self.join_ids = array.array('q')
+            # Rendered $member_list rows, dropped whenever a member changes
+            self.rows = pesukarhu.paged_view.RowCache(self.render_row)
+            logging.info(f'Initializing MemberList:')
+            self.load_settings()
+            self.restore()
+
+        def load_settings(self):
             self.warn_delay = float(os.getenv('PESUKARHU_UNVERIFIED_WARN_DELAY'))
             self.kick_delay = float(os.getenv('PESUKARHU_UNVERIFIED_KICK_DELAY'))
             self.retention_time = float(os.getenv('PESUKARHU_RETENTION_TIME'))
-            logging.info(f'Initializing MemberList:')
             logging.info(f'   warn delay = {self.warn_delay} (sec)')
             logging.info(f'   kick delay = {self.kick_delay} (sec)')
             logging.info(f'   retention_time = {self.retention_time} (sec)')
-            # Convert to timedeltas for math purposes
-            self.warn_delay = datetime.timedelta(0, self.warn_delay)
-            self.kick_delay = datetime.timedelta(0, self.kick_delay)
-            self.retention_time = datetime.timedelta(0, self.retention_time)
+            # Member times are whole epoch seconds
+            self.warn_delay = round(self.warn_delay)
+            self.kick_delay = round(self.kick_delay)
+            self.retention_time = round(self.retention_time)
+
+        def reload_settings(self):
+            # Pending warnings and kicks move to the new delays; verified and
+            # removed members keep the retention they were given
+            self.load_settings()
+            for id, member in self.member_list.items():
+                if((member.state == MemberMonitor.MemberState.UNVERIFIED) or
+                   (member.state == MemberMonitor.MemberState.WARNED)):
+                    member.warn_time = member.add_time + self.warn_delay
+                    member.kick_time = member.add_time + self.kick_delay
+                    self.update_member(id)
+
+        def restore(self):
+            # Pick up where the last run left off; anything already overdue
+            # is handled on the first maintenance pass
+            for id, record in self.store.load('monitored_member').items():
+                self.member_list[id] = MemberMonitor.Member.from_record(record)
+                self.index_join(id)
+                self.update_member(id, persist=False)
+            logging.info(f'   restored {len(self.member_list)} members')
+
+        def update_member(self, id, persist=True):
+            # Re-index and persist a member after any change. Each state has
+            # exactly one deadline that moves it along
+            member = self.member_list[id]
+            self.rows.invalidate(id)
+            if persist:
+                self.store.save('monitored_member', id, member.to_record())
+            if(member.state == MemberMonitor.MemberState.UNVERIFIED):
+                self.deadlines.schedule(id, member.warn_time)
+            elif(member.state == MemberMonitor.MemberState.WARNED):
+                self.deadlines.schedule(id, member.kick_time)
+            else:
+                self.deadlines.schedule(id, member.trim_retention_time)
+
+        def index_join(self, id):
+            # Joins almost always arrive in order, so this is usually an append
+            add_time = self.member_list[id].add_time
+            idx = bisect.bisect_right(self.join_times, add_time)
+            self.join_times.insert(idx, add_time)
+            self.join_ids.insert(idx, id)
+
+        def unindex_join(self, id):
+            # Several joins can share a second; look for the ID among them
+            add_time = self.member_list[id].add_time
+            idx = bisect.bisect_left(self.join_times, add_time)
+            while((idx < len(self.join_times)) and (self.join_times[idx] == add_time)):
+                if(self.join_ids[idx] == id):
+                    del self.join_times[idx]
+                    del self.join_ids[idx]
+                    return
+                idx += 1
+
+        def get_joined_between(self, start_time, end_time):
+            '''
+            IDs of members who joined strictly between start_time and
+            end_time, oldest first
+            '''
+            start = bisect.bisect_right(self.join_times, start_time)
+            end = bisect.bisect_left(self.join_times, end_time)
+            return self.join_ids[start:end].tolist()
 
         def add_member(self, id, name):
-            logging.info(f'Added: {id} - {name}')
-            self.member_list[id] = MemberMonitor.Member(name, self.warn_delay, self.kick_delay)
+            logging.info(f'Added: {id} - {name}', extra={'event': 'member_added', 'member': id})
+            if id in self.member_list:
+                self.unindex_join(id)
+            self.member_list[id] = MemberMonitor.Member(name, int(self.clock.time()), self.warn_delay, self.kick_delay)
+            self.index_join(id)
+            self.update_member(id)
     
         def remove_member(self, id):
-            logging.info(f'Deleted: {id} - {self.member_list[id].name}')
+            logging.info(f'Deleted: {id} - {self.member_list[id].name}', extra={'event': 'member_deleted', 'member': id})
+            self.unindex_join(id)
             del self.member_list[id]
+            self.rows.invalidate(id)
+            self.deadlines.cancel(id)
+            self.store.delete('monitored_member', id)
 
         def set_removed_state(self, id):
-            current_time = datetime.datetime.now()
-            logging.info(f'Set removed: {id} - {self.member_list[id].name}')
+            current_time = int(self.clock.time())
+            logging.info(f'Set removed: {id} - {self.member_list[id].name}', extra={'event': 'member_removed', 'member': id})
             self.member_list[id].state = MemberMonitor.MemberState.REMOVED
             self.member_list[id].trim_retention_time = current_time + self.retention_time
+            self.update_member(id)
 
         def verify_member(self, id):
-            current_time = datetime.datetime.now()
-            logging.info(f'Verified: {id} - {self.member_list[id].name}')
+            current_time = int(self.clock.time())
+            logging.info(f'Verified: {id} - {self.member_list[id].name}', extra={'event': 'member_verified', 'member': id})
             self.member_list[id].state = MemberMonitor.MemberState.VERIFIED
             self.member_list[id].trim_retention_time = current_time + self.retention_time
+            self.update_member(id)
 
         def unverify_member(self, id, name):
-            current_time = datetime.datetime.now()
+            current_time = int(self.clock.time())
             if(id in self.member_list.keys()):
-                logging.info(f'Unverified: {id} - {self.member_list[id].name}')
+                logging.info(f'Unverified: {id} - {self.member_list[id].name}', extra={'event': 'member_unverified', 'member': id})
                 self.member_list[id].state = MemberMonitor.MemberState.UNVERIFIED
+                self.unindex_join(id)
                 self.member_list[id].add_time = current_time
+                self.index_join(id)
                 self.member_list[id].warn_time = current_time + self.warn_delay
                 self.member_list[id].kick_time = current_time + self.kick_delay
+                self.update_member(id)
             else:
                 # Was not in recent joins list, have to add them
-                logging.info(f'Unverified: {id} - {name}')
+                logging.info(f'Unverified: {id} - {name}', extra={'event': 'member_unverified', 'member': id})
                 self.add_member(id, name)
 
         def warn_member(self, id):
-            logging.info(f'Warned: {id} - {self.member_list[id].name}')
+            logging.info(f'Warned: {id} - {self.member_list[id].name}', extra={'event': 'member_warned', 'member': id})
             self.member_list[id].state = MemberMonitor.MemberState.WARNED
+            self.update_member(id)
+
+        def retry_later(self, id, retry_time):
+            # Puts a member whose warning or kick failed back on the deadline
+            # index; its state stays as it was, so the same step runs again
+            self.deadlines.schedule(id, retry_time)
 
-        def trim_unmonitored_members(self):
-            current_time = datetime.datetime.now()
-            # Create a copy here so that the member_list dict doesn't change
-            # size during iteration
-            for key, member in self.member_list.copy().items():
-                if(((member.state == MemberMonitor.MemberState.REMOVED) or
-                    (member.state == MemberMonitor.MemberState.VERIFIED)) and
-                   (member.trim_retention_time <= current_time)):
-                   self.remove_member(key)
-
-        def count_recent_joins(self, time_window):
-            # This could probably be done with a list comprehension
-            current_time = datetime.datetime.now()
-            count = 0
-            for key, member in self.member_list.items():
-                age = current_time - member.add_time
-                if(age.total_seconds() < time_window):
-                    count += 1
-            return count
-
-        def get_embed(self):
-            current_time = datetime.datetime.now()
-            if(len(self.member_list) == 0):
-                id_string = "Empty"
-                add_string = "Empty"
-                state_string = "Empty"
+        def pop_due(self, current_time):
+            # Members whose next transition has passed; they stay unscheduled
+            # until the caller moves them to their next state
+            return self.deadlines.pop_due(current_time)
+
+        async def wait_for_deadline(self, max_delay):
+            await self.deadlines.wait(self.clock.time(), max_delay)
+
+        def render_row(self, id):
+            member = self.member_list.get(id)
+            if member is None:
+                return (f'{id}', 'Gone', 'Gone')
+            # Discord shows the time and age in the reader's timezone and
+            # keeps the age current, so the row doesn't go stale
+            return (f'{id} ({member.name})',
+                    f'<t:{member.add_time}:f> (<t:{member.add_time}:R>)',
+                    member.state.name.capitalize())
+
+        def get_view(self, state=None, max_age=None):
+            '''
+            Paged listing of the members, oldest join first, optionally only
+            those in state and / or who joined at most max_age seconds ago
+            '''
+            if max_age is None:
+                ids = self.join_ids.tolist()
             else:
-                id_string = ""
-                add_string = ""
-                state_string = ""
-
-                for key, member in self.member_list.items():
-                    age = current_time - member.add_time # as timedelta object
-                    age = age.total_seconds() # as float
-                    new_id = f'{key} ({member.name})\n'
-                    new_add = f'{member.add_time.strftime("%Y%m%d|%H:%M:%S")} ({age:.0f})\n'
-                    new_state = f'{member.state.name.capitalize()}\n'
-                    # Check to make sure we don't exceed 1024 characters per field. We
-                    # won't hit the 6000 character total limit
-                    if((len(id_string) + len(new_id) <= 1000) and \
-                       (len(add_string) + len(new_add) <= 1000) and \
-                       (len(state_string) + len(new_state) <= 1000)):
-                        id_string += new_id
-                        add_string += new_add
-                        state_string += new_state
-                    else:
-                        break
-            embed=discord.Embed(title=f'Recent join list: ({len(self.member_list)} members)')
-            embed.add_field(name="ID (name)", value=id_string, inline=True) 
-            embed.add_field(name="Added (age)", value=add_string, inline=True)
-            embed.add_field(name="State", value=state_string, inline=True)
-            return embed
-        
+                current_time = int(self.clock.time())
+                ids = self.get_joined_between(current_time - max_age - 1, current_time + 1)
+            if state is not None:
+                ids = [id for id in ids if self.member_list[id].state == state]
+            filters = []
+            if state is not None:
+                filters.append(state.name.capitalize())
+            if max_age is not None:
+                filters.append(f'joined in the last {max_age}s')
+            return pesukarhu.paged_view.PagedView(f'Recent join list: ({len(ids)} of {len(self.member_list)} members)',
+                                                  ('ID (name)', 'Added (age)', 'State'), ids, self.rows,
+                                                  description=', '.join(filters) if filters else None)
+
         def get_pretty_string(self, id):
             member = self.member_list[id]
             string = f'Name: {member.name}\n'
-            string += f'Add Time: {member.add_time.strftime("%Y%m%d|%H:%M:%S")}\n'
-            string += f'Warn Time: {member.warn_time.strftime("%Y%m%d|%H:%M:%S")}\n'
-            string += f'Kick Time: {member.kick_time.strftime("%Y%m%d|%H:%M:%S")}\n'
+            string += f'Add Time: {MemberMonitor.format_time(member.add_time)}\n'
+            string += f'Warn Time: {MemberMonitor.format_time(member.warn_time)}\n'
+            string += f'Kick Time: {MemberMonitor.format_time(member.kick_time)}\n'
             if(member.trim_retention_time is None):
                 string += f'Retention Time: None\n'
             else:
-                string += f'Retention Time: {member.trim_retention_time.strftime("%Y%m%d|%H:%M:%S")}\n'
+                string += f'Retention Time: {MemberMonitor.format_time(member.trim_retention_time)}\n'
             string += f'State: {member.state.name}'
             return string
 
@@ -161,72 +296,425 @@ class MemberMonitor(commands.Cog):
         load_dotenv()
         self.guild = int(os.getenv('PESUKARHU_GUILD'))
         self.admin_role_id = int(os.getenv('PESUKARHU_ADMIN_ROLE'))
-        self.refresh_period = float(os.getenv('PESUKARHU_MEMBER_REFRESH_PERIOD'))
         self.verified_role_id = int(os.getenv('PESUKARHU_VERIFIED_ROLE_ID'))
         self.unverified_role_id = int(os.getenv('PESUKARHU_UNVERIFIED_ROLE_ID'))
         self.unverified_warning_role_id = int(os.getenv('PESUKARHU_WARNING_ROLE_ID'))
         self.warnings_channel = int(os.getenv('PESUKARHU_WARNING_CHANNEL'))
         self.log_channel = int(os.getenv('PESUKARHU_LOG_CHANNEL'))
-        self.raid_detection_window = float(os.getenv('PESUKARHU_RAID_DETECTION_WINDOW'))
-        self.raid_detection_level = int(os.getenv('PESUKARHU_RAID_DETECTION_LEVEL'))
         logging.info(f'Initializing MemberMonitor:')
         logging.info(f'   guild = {self.guild}')
         logging.info(f'   admin role id = {self.admin_role_id}')
-        logging.info(f'   refresh period = {self.refresh_period}')
         logging.info(f'   verified role id = {self.verified_role_id}')
         logging.info(f'   unverified role id = {self.unverified_role_id}')
         logging.info(f'   unverified warning role id = {self.unverified_warning_role_id}')
         logging.info(f'   warnings channel = {self.warnings_channel}')
         logging.info(f'   log channel = {self.log_channel}')
-        logging.info(f'   raid detection window = {self.raid_detection_window}')
-        logging.info(f'   raid detection level = {self.raid_detection_level}')
+        self.gateway_profile = pesukarhu.gateway.get_profile()
+        self.clock = pesukarhu.clock.get_clock(bot)
+        self.load_settings()
         # Initialize member list maintenance search task
-        self.member_list = self.MemberList()
-        self.member_list_maintenance.change_interval(seconds = self.refresh_period)
+        store = pesukarhu.state_store.get_state_store(bot)
+        handover = pesukarhu.extensions.take_over(bot, 'MemberMonitor')
+        # On a reload the member list is rebuilt from the store, whose reads
+        # include every change the old cog made, written yet or not
+        self.member_list = self.MemberList(store, self.clock)
+        self.actions = pesukarhu.action_queue.get_action_queue(bot)
+        # Members restored from the state store, or joined before a lean
+        # profile start, may not be cached
+        self.resolver = pesukarhu.gateway.get_member_resolver(bot)
+        if handover is None:
+            self.raid_detector = pesukarhu.raid_detector.RaidDetector(self.get_raid_windows(), self.raid_clear_ratio)
+            self.log_sink = pesukarhu.log_sink.LogSink(bot, self.actions, self.log_channel)
+            # Events and moderation actions for one member run in order; other
+            # members aren't held up behind them
+            self.members = pesukarhu.keyed_executor.KeyedExecutor(bot, 'monitor_members')
+            self.raid_mode = self.RaidMode.NORMAL
+            self.raid_queue = [] # (id, name) of raid joins waiting for the next batch
+            self.raid_handled = 0 # this raid
+            self.raid_failed = 0
+            self.raid_batches = 0 # since start
+        else:
+            # Helpers carry on as they were, so join rates, buffered log
+            # lines and per member ordering survive the reload
+            self.raid_detector = handover['raid_detector']
+            self.raid_detector.set_windows(self.get_raid_windows(), self.raid_clear_ratio, self.clock.monotonic())
+            self.log_sink = handover['log_sink']
+            self.log_sink.actions = self.actions
+            self.members = handover['members']
+            self.raid_mode = self.RaidMode[handover['raid_mode']]
+            self.raid_queue = handover['raid_queue']
+            self.raid_handled = handover['raid_handled']
+            self.raid_failed = handover['raid_failed']
+            self.raid_batches = handover['raid_batches']
+        self.raid_flush_handle = None
+        if(len(self.raid_queue) > 0):
+            self.raid_flush_handle = self.clock.call_later(self.raid_batch_period, self.flush_raid_queue)
         self.member_list_maintenance.start()
         # Setup some random color constants
         self.red = 0xFF4500
         self.green = 0x32CD32
         self.yellow = 0xFFFF00
 
+    def load_settings(self):
+        # Thresholds that can change without a restart; see reload_settings
+        self.refresh_period = float(os.getenv('PESUKARHU_MEMBER_REFRESH_PERIOD'))
+        self.raid_detection_window = float(os.getenv('PESUKARHU_RAID_DETECTION_WINDOW'))
+        self.raid_detection_level = int(os.getenv('PESUKARHU_RAID_DETECTION_LEVEL'))
+        self.raid_detection_extra_windows = os.getenv('PESUKARHU_RAID_DETECTION_EXTRA_WINDOWS', '')
+        self.raid_clear_ratio = float(os.getenv('PESUKARHU_RAID_CLEAR_RATIO', '0.5'))
+        self.moderation_retry_delay = float(os.getenv('PESUKARHU_MODERATION_RETRY_DELAY', '60.0'))
+        self.ban_dm_timeout = float(os.getenv('PESUKARHU_BAN_DM_TIMEOUT', '3.0'))
+        self.ban_progress_period = float(os.getenv('PESUKARHU_BAN_PROGRESS_PERIOD', '2.0'))
+        self.ban_preview_size = int(os.getenv('PESUKARHU_BAN_PREVIEW_SIZE', '20'))
+        self.raid_action = os.getenv('PESUKARHU_RAID_ACTION', 'none')
+        self.raid_quarantine_role_id = int(os.getenv('PESUKARHU_RAID_QUARANTINE_ROLE_ID', '0'))
+        self.raid_batch_period = float(os.getenv('PESUKARHU_RAID_BATCH_PERIOD', '5.0'))
+        # Discord's bulk ban takes at most 200 users
+        self.raid_batch_size = min(200, int(os.getenv('PESUKARHU_RAID_BATCH_SIZE', '100')))
+        logging.info(f'   refresh period = {self.refresh_period}')
+        logging.info(f'   moderation retry delay = {self.moderation_retry_delay}')
+        logging.info(f'   raid detection window = {self.raid_detection_window}')
+        logging.info(f'   raid detection level = {self.raid_detection_level}')
+        logging.info(f'   raid action = {self.raid_action}')
+        logging.info(f'   raid quarantine role id = {self.raid_quarantine_role_id}')
+        logging.info(f'   raid batch period = {self.raid_batch_period}')
+        logging.info(f'   raid batch size = {self.raid_batch_size}')
+        if(self.raid_action not in ('none', 'quarantine', 'kick', 'ban')):
+            logging.error(f'Unknown raid action {self.raid_action}, raids will only be logged')
+            self.raid_action = 'none'
+        if((self.raid_action == 'quarantine') and (self.raid_quarantine_role_id == 0)):
+            logging.error(f'Raid action is quarantine but there is no quarantine role, raids will only be logged')
+            self.raid_action = 'none'
+
+    def get_raid_windows(self):
+        raid_windows = [(self.raid_detection_window, self.raid_detection_level)]
+        raid_windows += pesukarhu.raid_detector.RaidDetector.parse_windows(self.raid_detection_extra_windows)
+        return raid_windows
+
+    def reload_settings(self):
+        '''
+        Re-reads the thresholds from the environment (already reloaded from
+        .env by the caller). Members being tracked move to the new warn and
+        kick delays counted from when they joined.
+        '''
+        logging.info(f'Reloading MemberMonitor settings:')
+        self.load_settings()
+        self.raid_detector.set_windows(self.get_raid_windows(), self.raid_clear_ratio, self.clock.monotonic())
+        self.member_list.reload_settings()
+
+    def export_state(self):
+        # Objects from other modules only; anything defined in this module
+        # is rebuilt by the reloaded code
+        return {
+            'raid_detector': self.raid_detector,
+            'log_sink': self.log_sink,
+            'members': self.members,
+            'raid_mode': self.raid_mode.name,
+            'raid_queue': self.raid_queue,
+            'raid_handled': self.raid_handled,
+            'raid_failed': self.raid_failed,
+            'raid_batches': self.raid_batches,
+        }
+
+    def send_channel(self, channel_id, priority, content=None, embed=None):
+        # Queue a message to one of our channels; returns None if the channel
+        # isn't available
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            return None
+        return self.actions.submit(functools.partial(channel.send, content, embed=embed),
+                                   priority, ('channel', channel_id),
+                                   description=f'send to channel {channel_id}')
+
+    async def send_dm(self, discord_member, text):
+        await discord_member.create_dm()
+        await discord_member.dm_channel.send(text)
+
+    def check_still_unverified(self, discord_member, id, member, action):
+        # Catches members who left or got verified while the bot was offline
+        if discord_member is None:
+            logging.warning(f'Could not find {id} | {member.name} to {action}, assuming they left')
+            if id in self.member_list.get_ids():
+                self.member_list.set_removed_state(id)
+            return False
+        if discord.utils.get(discord_member.roles, id=self.verified_role_id) is not None:
+            logging.info(f'{id} | {member.name} is already verified, not going to {action}')
+            if id in self.member_list.get_ids():
+                self.member_list.verify_member(id)
+            # In the lean profile a member restored from the state store
+            # isn't cached, so their verification never reached
+            # on_member_update to take the warning role off
+            self.remove_warning_role(discord_member)
+            return False
+        return True
+
+    def remove_warning_role(self, discord_member):
+        if discord.utils.get(discord_member.roles, id=self.unverified_warning_role_id) is None:
+            return
+        guild = self.bot.get_guild(self.guild)
+        warning_role = guild.get_role(self.unverified_warning_role_id)
+        self.actions.submit(functools.partial(discord_member.remove_roles, warning_role, reason=f'User completed verification'),
+                            self.actions.Priority.ROLE, ('roles', discord_member.id),
+                            key=(discord_member.id, 'remove_warning'), description=f'remove warning role from {discord_member.id}')
+
+    async def warn(self, guild, id, member, current_time):
+        warned_member = await self.resolver.resolve(guild, id)
+        if not self.check_still_unverified(warned_member, id, member, 'warn'):
+            return False
+        try:
+            await self.send_dm(warned_member,
+                f'{member.name} - you will be kicked from the Personal Finance Discord if you do not complete the verification process.\n' \
+                f'We do this to ensure that our users are humans and not advertising bots.\n' \
+                f'Please see #verify-step-1 and #verify-step-2 to see what you need to do for verification\n'
+            )
+        except discord.HTTPException as e:
+            logging.info(f'Could not DM warning to {id} | {member.name}: {e}', extra={'event': 'dm_failed', 'member': id})
+        warning_role = guild.get_role(self.unverified_warning_role_id)
+        await warned_member.add_roles(warning_role,
+                                      reason=f'Warned for verification - joined at {self.format_time(member.add_time)}, current time is {self.format_time(current_time)}')
+        logging.info(f'Warned {id} | {member.name} for verification', extra={'event': 'warn', 'member': id})
+        self.send_channel(self.warnings_channel, self.actions.Priority.MESSAGE,
+                          content=f'<@{id}> - please complete the verification process - see your DMs for additional info')
+        return True
+
+    async def kick(self, guild, id, member, current_time):
+        kicked_member = await self.resolver.resolve(guild, id)
+        if not self.check_still_unverified(kicked_member, id, member, 'kick'):
+            return False
+        logging.info(f'Kicked warned {id} | {member.name} for verification', extra={'event': 'kick', 'member': id})
+        # DM first since we can't reach them once they're gone, but don't
+        # let a closed DM stop the kick
+        try:
+            await self.send_dm(kicked_member,
+                f'{member.name} - you were kicked from the Personal Finance Discord due to lack of verification.\n' \
+                f'We do this to ensure that our users are humans and not advertising bots.\n' \
+                f'If this was in error, you are free to re-join the server at any time through this invite URL:' \
+                f'http://discord.gg/agSSAhXzYD'
+            )
+        except discord.HTTPException as e:
+            logging.info(f'Could not DM {kicked_member.id} | {member.name} before kick: {e}', extra={'event': 'dm_failed', 'member': id})
+        # They may have been verified while the DM was going out
+        if not self.check_still_unverified(kicked_member, id, member, 'kick'):
+            return False
+        await guild.kick(kicked_member,
+                         reason=f'Kicked for failed verification - joined at {self.format_time(member.add_time)}, current time is {self.format_time(current_time)}')
+        return True
+
+    def retry_if_failed(self, id, action, step):
+        # Done callbacks of queued warnings and kicks; returns the result, or
+        # None after putting the member back on the deadline index
+        if((not action.cancelled()) and (action.exception() is None)):
+            return action.result()
+        if(id in self.member_list.get_ids()):
+            reason = 'cancelled' if action.cancelled() else repr(action.exception())
+            logging.warning(f'Could not {step} {id} ({reason}), trying again in {self.moderation_retry_delay:.0f}s')
+            self.member_list.retry_later(id, int(self.clock.time() + self.moderation_retry_delay))
+        return None
+
+    def warn_done(self, id, warn):
+        # The kick deadline only starts once the warning is out, so a kick
+        # can never overtake it. Skipped if the member verified, left or was
+        # unverified again (a later warn time) in the meantime
+        if not self.retry_if_failed(id, warn, 'warn'):
+            return
+        member = self.member_list.member_list.get(id)
+        if((member is not None) and (member.state == MemberMonitor.MemberState.UNVERIFIED) and
+           (member.warn_time <= self.clock.time())):
+            self.member_list.warn_member(id)
+
+    def kick_done(self, id, kick):
+        if not self.retry_if_failed(id, kick, 'kick'):
+            return
+        self.log_sink.post('kicks', f'<@{id}> was kicked due to lack of verification')
+        # Normally on_member_remove gets there first
+        member = self.member_list.member_list.get(id)
+        if((member is not None) and (member.state == MemberMonitor.MemberState.WARNED)):
+            self.member_list.set_removed_state(id)
+
+    async def ban(self, guild, id, name, current_time, actor):
+        banned_member = await self.resolver.resolve(guild, id)
+        if banned_member is None:
+            # Already gone - ban by ID so they can't come back, there's
+            # nobody to DM
+            logging.info(f'{id} | {name} not in the guild, banning by ID')
+            banned_member = discord.Object(id)
+        else:
+            # Best effort; a slow or closed DM mustn't hold up the ban
+            try:
+                await self.clock.wait_for(self.send_dm(banned_member,
+                    f'{name} - you were banned from the Personal Finance Discord due to a raid by spammer bots.\n' \
+                    f'If this was in error and you are a real person, email lufisraccoon@gmail.com or metacognition@gmail.com\n' \
+                    f'Please provide this information to them:\n' \
+                    f'ID: {id} | Name: {name} | Date: {self.format_time(current_time)}'
+                ), timeout=self.ban_dm_timeout)
+            except (discord.HTTPException, asyncio.TimeoutError) as e:
+                logging.info(f'Could not DM {id} | {name} before ban: {e!r}', extra={'event': 'dm_failed', 'member': id})
+        await guild.ban(banned_member,
+                        reason=f'Banned member due to $ban_time command by {actor}')
+        logging.info(f'Banned {id} | {name}', extra={'event': 'ban', 'member': id})
+
     @commands.Cog.listener()
+    @pesukarhu.telemetry.timed()
     async def on_member_join(self, member):
+        await self.members.run(member.id, functools.partial(self.handle_member_join, member))
+
+    async def handle_member_join(self, member):
+        current_time = self.clock.monotonic()
+        started, ended = self.raid_detector.record_join(current_time)
+        # The join may land after the raid died down but before the next
+        # maintenance tick noticed
+        if(ended and (self.raid_mode == self.RaidMode.RAID)):
+            self.leave_raid_mode()
+        if started:
+            self.enter_raid_mode(current_time)
+        if(self.raid_mode == self.RaidMode.RAID):
+            self.handle_raid_join(member)
+            return
         self.member_list.add_member(member.id, member.name)
         # Advertise joining
-        channel = self.bot.get_channel(self.log_channel)
-        if channel is not None:
-            embed=discord.Embed(color=self.yellow)
-            embed.add_field(name="Mention (ID)", value=f'<@{member.id}> ({member.id})', inline=True) 
-            embed.add_field(name="Name", value=f'{member.name}', inline=True)
-            embed.add_field(name="Nick", value=f'{member.nick}', inline=True)
-            embed.set_author(name=f'{member.name} joined server', icon_url=member.avatar_url)
-            await channel.send(embed=embed)
-        # Check if this overflows raid detector
-        raid_count = self.member_list.count_recent_joins(self.raid_detection_window)
-        if(raid_count >= self.raid_detection_level):
-            logging.warning(f'Raid detected - {raid_count} members joined inside window of {self.raid_detection_window} (max of {self.raid_detection_level} allowed)')
-            channel = self.bot.get_channel(self.log_channel)
-            if channel is not None:
-                guild = self.bot.get_guild(self.guild)
-                admin_role = guild.get_role(self.admin_role_id)
-                embed=discord.Embed(color=self.red, description=f'Raid detected - {admin_role.mention}')
-                await channel.send(embed=embed)
+        embed=discord.Embed(color=self.yellow)
+        embed.add_field(name="Mention (ID)", value=f'<@{member.id}> ({member.id})', inline=True) 
+        embed.add_field(name="Name", value=f'{member.name}', inline=True)
+        embed.add_field(name="Nick", value=f'{member.nick}', inline=True)
+        embed.set_author(name=f'{member.name} joined server', icon_url=member.avatar_url)
+        self.log_sink.post('joins', f'📥 <@{member.id}> ({member.id}) {member.name} joined', embed)
+
+    def handle_raid_join(self, member):
+        # Lean path: no embed, and raiders that are about to be kicked or
+        # banned aren't tracked at all. Their one line log entries get
+        # summarized by the log sink
+        if(self.raid_action in ('none', 'quarantine')):
+            self.member_list.add_member(member.id, member.name)
+        if(self.raid_action != 'none'):
+            self.queue_raid_join(member.id, member.name)
+        self.log_sink.post('joins', f'📥 <@{member.id}> ({member.id}) {member.name} joined during raid')
+
+    def enter_raid_mode(self, current_time):
+        # Only the first join over the threshold alerts, the rest are counted
+        # against the same episode
+        rates = self.raid_detector.describe(current_time)
+        logging.warning(f'Raid detected - {rates}')
+        self.raid_mode = self.RaidMode.RAID
+        self.raid_handled = 0
+        self.raid_failed = 0
+        guild = self.bot.get_guild(self.guild)
+        admin_role = guild.get_role(self.admin_role_id)
+        embed=discord.Embed(color=self.red, description=f'Raid detected - {admin_role.mention}\n{rates}\nRaid action: {self.raid_action}')
+        self.send_channel(self.log_channel, self.actions.Priority.MESSAGE, embed=embed)
+        if(self.raid_action == 'none'):
+            return
+        # The joins that tripped the detector are part of the raid too; sweep
+        # the ones from the shortest window over its threshold that haven't
+        # verified yet
+        window = min(window for window, count, threshold in self.raid_detector.get_rates(current_time) if count >= threshold)
+        wall_time = int(self.clock.time())
+        for id in self.member_list.get_joined_between(wall_time - window - 1, wall_time + 1):
+            member = self.member_list.get_member(id)
+            if(member.state == MemberMonitor.MemberState.UNVERIFIED):
+                self.queue_raid_join(id, member.name)
+
+    def leave_raid_mode(self):
+        self.flush_raid_queue()
+        self.raid_mode = self.RaidMode.NORMAL
+        summary = f'Raid ended - {self.raid_detector.episode_joins} joins during raid'
+        if(self.raid_action != 'none'):
+            summary += f', {self.raid_handled} handled by {self.raid_action} ({self.raid_failed} failed, last batch may still be running)'
+        logging.warning(summary)
+        embed=discord.Embed(color=self.green, description=summary)
+        self.log_sink.post('raids', summary, embed)
+
+    def queue_raid_join(self, id, name):
+        self.raid_queue.append((id, name))
+        if(len(self.raid_queue) >= self.raid_batch_size):
+            self.flush_raid_queue()
+        elif self.raid_flush_handle is None:
+            self.raid_flush_handle = self.clock.call_later(self.raid_batch_period, self.flush_raid_queue)
+
+    def flush_raid_queue(self):
+        if self.raid_flush_handle is not None:
+            self.raid_flush_handle.cancel()
+            self.raid_flush_handle = None
+        if(len(self.raid_queue) == 0):
+            return
+        batch = self.raid_queue
+        self.raid_queue = []
+        guild = self.bot.get_guild(self.guild)
+        self.raid_batches += 1
+        self.actions.submit(functools.partial(self.raid_batch, guild, batch, self.raid_action),
+                            self.actions.Priority.MODERATION, ('raid', self.guild),
+                            description=f'raid {self.raid_action} of {len(batch)} joins')
+
+    async def raid_batch(self, guild, batch, action):
+        '''
+        Applies the raid action to a batch of joins as one queued action.
+        Bans use Discord's bulk ban where discord.py has it; kicks and role
+        changes have no bulk endpoint, so those calls go out together and
+        discord.py paces them against the rate limit. No DMs - raiders don't
+        read them and they would only eat into the rate limit.
+        '''
+        if((action == 'ban') and hasattr(guild, 'bulk_ban')):
+            result = await guild.bulk_ban([discord.Object(id) for id, name in batch],
+                                          reason=f'Banned during raid')
+            done = len(result.banned)
+        else:
+            results = await asyncio.gather(*[self.raid_handle_one(guild, id, name, action) for id, name in batch],
+                                           return_exceptions=True)
+            for (id, name), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logging.warning(f'Raid {action} of {id} | {name} failed: {result!r}')
+            done = sum(1 for result in results if result is True)
+        failed = len(batch) - done
+        self.raid_handled += done
+        self.raid_failed += failed
+        self.log_sink.post('raids', f'Raid {action}: {done} of {len(batch)} joins ({failed} skipped or failed)')
+
+    async def raid_handle_one(self, guild, id, name, action):
+        # Raiders joined while we were running, so they're cached; only
+        # quarantine needs the member itself
+        if(action == 'quarantine'):
+            discord_member = await self.resolver.resolve(guild, id)
+        else:
+            discord_member = guild.get_member(id)
+        if((discord_member is not None) and (discord.utils.get(discord_member.roles, id=self.verified_role_id) is not None)):
+            logging.info(f'{id} | {name} verified before the raid batch got to them, skipping')
+            return False
+        if(action == 'quarantine'):
+            if discord_member is None:
+                return False
+            await discord_member.add_roles(guild.get_role(self.raid_quarantine_role_id), reason=f'Quarantined during raid')
+        elif(action == 'kick'):
+            await guild.kick(discord.Object(id) if discord_member is None else discord_member, reason=f'Kicked during raid')
+        elif(action == 'ban'):
+            await guild.ban(discord.Object(id) if discord_member is None else discord_member, reason=f'Banned during raid')
+        logging.info(f'Raid {action}: {id} | {name}', extra={'event': action, 'member': id})
+        return True
 
     @commands.Cog.listener()
+    @pesukarhu.telemetry.timed()
     async def on_member_remove(self, member):
-        logging.info(f'{member.id} | {member.name} left server')
-        self.member_list.set_removed_state(member.id)
-        channel = self.bot.get_channel(self.log_channel)
-        if channel is not None:
-            embed=discord.Embed(color=self.red)
-            embed.add_field(name="Mention (ID)", value=f'<@{member.id}> ({member.id})', inline=True) 
-            embed.add_field(name="Name", value=f'{member.name}', inline=True)
-            embed.add_field(name="Nick", value=f'{member.nick}', inline=True)
-            embed.set_author(name=f'{member.name} left server', icon_url=member.avatar_url)
-            await channel.send(embed=embed)
+        await self.members.run(member.id, functools.partial(self.handle_member_remove, member))
+
+    async def handle_member_remove(self, member):
+        logging.info(f'{member.id} | {member.name} left server', extra={'event': 'leave', 'member': member.id})
+        if member.id in self.member_list.get_ids():
+            self.member_list.set_removed_state(member.id)
+        if(self.raid_mode == self.RaidMode.RAID):
+            # Mostly raiders we just kicked or banned
+            self.log_sink.post('leaves', f'📤 <@{member.id}> ({member.id}) {member.name} left')
+            return
+        embed=discord.Embed(color=self.red)
+        embed.add_field(name="Mention (ID)", value=f'<@{member.id}> ({member.id})', inline=True) 
+        embed.add_field(name="Name", value=f'{member.name}', inline=True)
+        embed.add_field(name="Nick", value=f'{member.nick}', inline=True)
+        embed.set_author(name=f'{member.name} left server', icon_url=member.avatar_url)
+        self.log_sink.post('leaves', f'📤 <@{member.id}> ({member.id}) {member.name} left', embed)
 
     @commands.Cog.listener()
+    @pesukarhu.telemetry.timed()
     async def on_member_update(self, before, after):
+        await self.members.run(after.id, functools.partial(self.handle_member_update, before, after))
+
+    async def handle_member_update(self, before, after):
         # Gain Unverified ==> do nothing (could add, but on_member_join does same thing)
         # Gain Verified ==> remove from member list
         # Lose Verified ==> add to member list (mostly just for test)
@@ -235,125 +723,242 @@ class MemberMonitor(commands.Cog):
         was_unverified = discord.utils.find(lambda r: r.id == self.unverified_role_id, before.roles)
         is_unverified = discord.utils.find(lambda r: r.id == self.unverified_role_id, after.roles)
         if is_verified is not None and was_verified is None:
-            self.member_list.verify_member(after.id)
-            channel = self.bot.get_channel(self.log_channel)
-            if channel is not None:
-                embed=discord.Embed(color=self.green)
-                embed.add_field(name="Mention (ID)", value=f'<@{after.id}> ({after.id})', inline=True) 
-                embed.add_field(name="Name", value=f'{after.name}', inline=True)
-                embed.add_field(name="Nick", value=f'{after.nick}', inline=True)
-                embed.set_author(name=f'{after.name} was verified', icon_url=after.avatar_url)
-                await channel.send(embed=embed)
-            # Remove warning role, if appropriate
-            guild = self.bot.get_guild(self.guild)
-            warning_role = guild.get_role(self.unverified_warning_role_id)
-            warned_member = guild.get_member(after.id)
-            await warned_member.remove_roles(warning_role,
-                                             reason=f'User completed verification')
+            # Raid joins handled by kick or ban aren't tracked
+            if after.id in self.member_list.get_ids():
+                self.member_list.verify_member(after.id)
+            embed=discord.Embed(color=self.green)
+            embed.add_field(name="Mention (ID)", value=f'<@{after.id}> ({after.id})', inline=True) 
+            embed.add_field(name="Name", value=f'{after.name}', inline=True)
+            embed.add_field(name="Nick", value=f'{after.nick}', inline=True)
+            embed.set_author(name=f'{after.name} was verified', icon_url=after.avatar_url)
+            self.log_sink.post('verifications', f'✅ <@{after.id}> ({after.id}) {after.name} was verified', embed)
+            self.remove_warning_role(after)
         if is_unverified is not None and was_unverified is None:
             self.member_list.unverify_member(after.id, after.name)
 
     @commands.command()
-    async def member_list(self, ctx):
-        await ctx.send(embed=self.member_list.get_embed())
+    async def member_list(self, ctx, *filters):
+        # $member_list [state] [max age], eg $member_list unverified 10m
+        states = {state.name.lower(): state for state in MemberMonitor.MemberState}
+        parsed = pesukarhu.paged_view.parse_filters(filters, states)
+        if parsed is None:
+            await ctx.send(f'Huh? Filter by state ({", ".join(states)}) and / or age like 30s, 5m or 1h - ie, $member_list unverified 10m')
+            return
+        state, max_age = parsed
+        await self.member_list.get_view(state, max_age).show(ctx)
 
     @commands.command()
-    async def ban_time(self, ctx, start_time_ago, end_time_ago):
+    async def log_details(self, ctx, batch_id: int):
+        details = self.log_sink.get_details(batch_id)
+        if details is None:
+            await ctx.send(f'No log batch {batch_id} - only the last {self.log_sink.history_size} summaries are kept')
+            return
+        category, lines = details
+        pages = self.log_sink.paginate(lines)
+        for idx, page in enumerate(pages):
+            embed=discord.Embed(title=f'Log batch {batch_id}: {len(lines)} {category} ({idx+1}/{len(pages)})', description=page)
+            await ctx.send(embed=embed)
+
+    @commands.command()
+    async def raid_status(self, ctx):
+        current_time = self.clock.monotonic()
+        if self.raid_detector.active:
+            embed=discord.Embed(color=self.red, title='Raid in progress')
+            embed.add_field(name="Joins this raid", value=f'{self.raid_detector.episode_joins}', inline=True)
+            embed.add_field(name="Duration", value=f'{current_time - self.raid_detector.episode_start:.0f}s', inline=True)
+            embed.add_field(name=f'Raid action ({self.raid_action})', value=f'{self.raid_handled} done, {self.raid_failed} failed, {len(self.raid_queue)} queued', inline=True)
+        else:
+            embed=discord.Embed(color=self.green, title='No raid in progress')
+        for window, count, threshold in self.raid_detector.get_rates(current_time):
+            embed.add_field(name=f'Last {window:.0f}s', value=f'{count} joins ({count / window:.2f}/s, limit {threshold})', inline=False)
+        await ctx.send(embed=embed)
+
+    @commands.command()
+    async def ban_time(self, ctx, start_time_ago, end_time_ago, mode=None):
+        # $ban_time <start> <end> [preview] - preview only reports who would be banned
         logging.warning(f'Ban Time Command String: {ctx.message.content}')
         logging.warning(f'Ban Time Actor: {ctx.message.author.id} | {ctx.message.author.name}')
         start_time_ago = pytimeparse.timeparse.timeparse(start_time_ago)
         end_time_ago = pytimeparse.timeparse.timeparse(end_time_ago)
         logging.warning(f'Ban Arguments: {start_time_ago} (s) ago to {end_time_ago} (s) ago')
-        if(start_time_ago < end_time_ago):
-            await ctx.send(f'Banning all joins from {start_time_ago} (s) to {end_time_ago} (s) ago')
-            current_time = datetime.datetime.now()
-            ids = self.member_list.get_ids()
-            for id in ids:
-                member = self.member_list.get_member(id)
-                age = current_time - member.add_time
-                age = age.total_seconds()
-                if((age > start_time_ago) and (age < end_time_ago)):
-                    await ctx.send(f'Banning {id} | {member.name}')
-                    guild = self.bot.get_guild(self.guild)
-                    banned_member = guild.get_member(id)
-                    logging.info(f'Banned {id} | {member.name} for verification')
-                    await banned_member.create_dm()
-                    await banned_member.dm_channel.send(
-                        f'{member.name} - you were banned from the Personal Finance Discord due to a raid by spammer bots.\n' \
-                        f'If this was in error and you are a real person, email lufisraccoon@gmail.com or metacognition@gmail.com\n' \
-                        f'Please provide this information to them:\n' \
-                        f'ID: {id} | Name: {member.name} | Date: {current_time}'
-                    )
-                    await guild.ban(banned_member,
-                                    reason=f'Banned member due to $ban_time command by {ctx.message.author.name}')
-        else:
+        if((start_time_ago is None) or (end_time_ago is None)):
+            await ctx.send(f'Huh? Times should look like 30s, 5m or 1h - ie, banning from 30s ago to 60s ago would be $ban_time 30s 60s')
+            return
+        if(start_time_ago >= end_time_ago):
             await ctx.send(f'End time is before start time. Order is start end - ie, banning from 30s ago to 60s ago would be $ban_time 30s 60s')
+            return
+        current_time = int(self.clock.time())
+        ids = self.member_list.get_joined_between(current_time - end_time_ago, current_time - start_time_ago)
+        if(mode == 'preview'):
+            sample = ''.join(f'{id} | {self.member_list.get_member(id).name}\n' for id in ids[:self.ban_preview_size])
+            embed=discord.Embed(color=self.yellow, title=f'$ban_time would ban {len(ids)} members', description=sample if sample != '' else 'Nobody')
+            if(len(ids) > self.ban_preview_size):
+                embed.set_footer(text=f'Showing first {self.ban_preview_size}')
+            await ctx.send(embed=embed)
+            return
+        if(mode is not None):
+            await ctx.send(f'Huh? {mode} is not a mode - add preview to see who would be banned without banning')
+            return
+        status = await ctx.send(f'Banning {len(ids)} joins from {start_time_ago} (s) to {end_time_ago} (s) ago')
+        guild = self.bot.get_guild(self.guild)
+        bans = []
+        for id in ids:
+            member = self.member_list.get_member(id)
+            # Concurrency is bounded by the action queue's ban bucket
+            bans.append(self.actions.submit(functools.partial(self.ban, guild, id, member.name, current_time, ctx.message.author.name),
+                                            self.actions.Priority.MODERATION, ('ban', self.guild),
+                                            key=(id, 'ban'), description=f'ban {id}'))
+        # Report progress by editing one message, at most every few seconds
+        done = 0
+        failed = 0
+        last_edit = self.clock.monotonic()
+        for ban in asyncio.as_completed(bans):
+            try:
+                await ban
+            except Exception:
+                failed += 1
+            done += 1
+            if(self.clock.monotonic() - last_edit >= self.ban_progress_period):
+                last_edit = self.clock.monotonic()
+                await status.edit(content=f'Banning {len(ids)} joins from {start_time_ago} (s) to {end_time_ago} (s) ago - {done}/{len(ids)} done, {failed} failed')
+        await status.edit(content=f'Banned {done - failed} of {len(ids)} joins from {start_time_ago} (s) to {end_time_ago} (s) ago ({failed} failed)')
 
-    @tasks.loop(seconds=10) # default value is overridden prior to execution
+    @tasks.loop(seconds=0) # paced by wait_for_deadline instead of a fixed interval
     async def member_list_maintenance(self):
-        # Maintain list
-        self.member_list.trim_unmonitored_members();
-        # Check for people who have been on unverified list too long.
-        current_time = datetime.datetime.now()
-        ids = self.member_list.get_ids()
-        for id in ids:
+        # Sleep until the earliest deadline; refresh period is only an upper
+        # bound now
+        await self.member_list.wait_for_deadline(self.refresh_period)
+        with pesukarhu.telemetry.measure(self.bot, 'MemberMonitor.maintenance_tick'):
+            self.process_due_members()
+
+    def process_due_members(self):
+        if self.raid_detector.update(self.clock.monotonic()):
+            self.leave_raid_mode()
+        # Discord calls are queued rather than awaited, so a slow call for one
+        # member doesn't hold up the rest of the sweep
+        current_time = int(self.clock.time())
+        for id in self.member_list.pop_due(current_time):
             member = self.member_list.get_member(id)
-            if((member.state == MemberMonitor.MemberState.UNVERIFIED) and (member.warn_time) < current_time):
-                guild = self.bot.get_guild(self.guild)
-                warned_member = guild.get_member(id)
-                await warned_member.create_dm()
-                await warned_member.dm_channel.send(
-                    f'{member.name} - you will be kicked from the Personal Finance Discord if you do not complete the verification process.\n' \
-                    f'We do this to ensure that our users are humans and not advertising bots.\n' \
-                    f'Please see #verify-step-1 and #verify-step-2 to see what you need to do for verification\n'
-                )
-                warning_role = guild.get_role(self.unverified_warning_role_id)
-                await warned_member.add_roles(warning_role,
-                                              reason=f'Warned for verification - joined at {member.add_time}, current time is {current_time}')
-                logging.info(f'Warned {id} | {member.name} for verification')
-                channel = self.bot.get_channel(self.warnings_channel)
-                await channel.send(f'<@{id}> - please complete the verification process - see your DMs for additional info')
-                self.member_list.warn_member(id)
+            if((member.state == MemberMonitor.MemberState.REMOVED) or
+               (member.state == MemberMonitor.MemberState.VERIFIED)):
+                # Retention time has passed, stop tracking them
+                self.member_list.remove_member(id)
+                continue
+            guild = self.bot.get_guild(self.guild)
+            if(member.state == MemberMonitor.MemberState.UNVERIFIED):
+                # Marked warned once the warning has gone out; until then the
+                # member has no deadline
+                warn = self.actions.submit(functools.partial(self.members.run, id, functools.partial(self.warn, guild, id, member, current_time)),
+                                           self.actions.Priority.ROLE, ('roles', id),
+                                           key=(id, 'warn'), description=f'warn {id}')
+                warn.add_done_callback(functools.partial(self.warn_done, id))
                 continue
-            if((member.state == MemberMonitor.MemberState.WARNED) and (member.kick_time < current_time)):
-                guild = self.bot.get_guild(self.guild)
-                kicked_member = guild.get_member(id)
-                logging.info(f'Kicked warned {id} | {member.name} for verification')
-                await kicked_member.create_dm()
-                await kicked_member.dm_channel.send(
-                    f'{member.name} - you were kicked from the Personal Finance Discord due to lack of verification.\n' \
-                    f'We do this to ensure that our users are humans and not advertising bots.\n' \
-                    f'If this was in error, you are free to re-join the server at any time through this invite URL:' \
-                    f'http://discord.gg/agSSAhXzYD'
-                )
-                await guild.kick(kicked_member,
-                                 reason=f'Kicked for failed verification - joined at {member.add_time}, current time is {current_time}')
-                channel = self.bot.get_channel(self.log_channel)
-                await channel.send(f'<@{id}> was kicked due to lack of verification')
-                # Don't need to remove member, is already done in on_member_remove + trim functions
+            if(member.state == MemberMonitor.MemberState.WARNED):
+                kick = self.actions.submit(functools.partial(self.members.run, id, functools.partial(self.kick, guild, id, member, current_time)),
+                                           self.actions.Priority.MODERATION, ('kick', self.guild),
+                                           key=(id, 'kick'), description=f'kick {id}')
+                kick.add_done_callback(functools.partial(self.kick_done, id))
                 continue
 
+    def cog_unload(self):
+        self.member_list_maintenance.cancel()
+        if self.raid_flush_handle is not None:
+            self.raid_flush_handle.cancel()
+
+    def get_metrics(self):
+        metrics = {
+            'member_list_size': len(self.member_list.member_list),
+            'member_deadlines': len(self.member_list.deadlines),
+            'member_deadline_heap': len(self.member_list.deadlines.heap),
+            'raid_active': int(self.raid_detector.active),
+            'raid_queued': len(self.raid_queue),
+            'raid_batches': self.raid_batches,
+        }
+        metrics.update(self.members.get_metrics())
+        metrics.update(self.resolver.get_metrics())
+        return metrics
+
     @member_list_maintenance.before_loop
     async def before_member_list_maintenance(self):
         await self.bot.wait_until_ready()
 
+    def reconcile_roles(self, guild, members=None, source='cache'):
+        '''
+        Brings the member list in line with the unverified and warning roles,
+        using members (already narrowed down to holders of those roles), or
+        the role holders cached right now. Members restored from the state
+        store keep their timers; only untracked ones are added, so this can
+        run again as more of the guild comes in.
+        '''
+        if members is None:
+            # Role.members checks each cached member's sorted role IDs for
+            # just that role, without building anyone's role list
+            unverified_role = guild.get_role(self.unverified_role_id)
+            warning_role = guild.get_role(self.unverified_warning_role_id)
+            warned_members = [] if warning_role is None else warning_role.members
+            found = {} if unverified_role is None else {member.id: member for member in unverified_role.members}
+            found.update((member.id, member) for member in warned_members)
+            warned = set(member.id for member in warned_members)
+        else:
+            found = {member.id: member for member in members}
+            warned = set(member.id for member in members
+                         if discord.utils.get(member.roles, id=self.unverified_warning_role_id) is not None)
+        added = 0
+        for id, member in found.items():
+            is_warned = id in warned
+            if id not in self.member_list.get_ids():
+                logging.info(f'Found pre-existing {"warned" if is_warned else "unverified"} member: {id} | {member.name}')
+                self.member_list.add_member(id, member.name)
+                added += 1
+            if(is_warned and (self.member_list.get_member(id).state == MemberMonitor.MemberState.UNVERIFIED)):
+                self.member_list.warn_member(id)
+        if(len(found) > 0):
+            logging.info(f'Reconciled roles from {source} with {len(found)} unverified or warned members - added {added}, tracking {len(self.member_list.get_ids())}')
+
+    async def fetch_and_reconcile(self, guild):
+        # Lean profile: page through the member list over REST instead of
+        # chunking it into the cache, reconciling the ones with our roles
+        # after every page rather than once the whole list is in
+        role_ids = (self.unverified_role_id, self.unverified_warning_role_id)
+        members = []
+        fetched = 0
+        async for member in guild.fetch_members(limit=None):
+            fetched += 1
+            if any(role.id in role_ids for role in member.roles):
+                members.append(member)
+            if(fetched % self.fetch_page_size == 0):
+                self.reconcile_roles(guild, members, f'fetched members ({fetched} so far)')
+                members = []
+        self.reconcile_roles(guild, members, f'fetched members ({fetched} in all)')
+
+    async def chunk_and_reconcile(self, guild):
+        # Chunks land in the cache as they arrive; pick up the role holders
+        # among them every reconcile_period until the guild is complete
+        chunk = self.bot.loop.create_task(guild.chunk())
+        while not chunk.done():
+            try:
+                await self.clock.wait_for(asyncio.shield(chunk), self.reconcile_period)
+            except asyncio.TimeoutError:
+                pass
+            self.reconcile_roles(guild, source='chunked' if chunk.done() else 'chunked so far')
+
     @commands.Cog.listener()
     async def on_ready(self):
         guild = self.bot.get_guild(self.guild)
         logging.info(f'{self.bot.user} is connected to {guild.name} (id: {guild.id})')
-        # Add all users with Unverified role to our list; we'll add more as we go
-        for member in guild.members:
-            for role in member.roles: 
-                if role.id == self.unverified_role_id:
-                    logging.info(f'Found pre-existing unverified member: {guild.id} | {member.name}')
-                    self.member_list.add_member(member.id, member.name)
-                if role.id == self.unverified_warning_role_id:
-                    logging.info(f'Found pre-existing warned member: {guild.id} | {member.name}')
-                    self.member_list.add_member(member.id, member.name)
-                    self.member_list.warn_member(member.id)
+        # Whatever is cached already is reconciled now; the rest of the guild
+        # is reconciled as it comes in
+        self.reconcile_roles(guild)
+        if(self.gateway_profile == 'lean'):
+            self.bot.loop.create_task(self.fetch_and_reconcile(guild))
+        elif not guild.chunked:
+            self.bot.loop.create_task(self.chunk_and_reconcile(guild))
 
     async def cog_check(self, ctx):
         # Check if user has admin role
         guild = self.bot.get_guild(self.guild)
         admin_role = guild.get_role(self.admin_role_id)
-        return admin_role in ctx.author.roles
\ No newline at end of file
+        return admin_role in ctx.author.roles
+
+def setup(bot):
+    bot.add_cog(MemberMonitor(bot))
@@ -0,0 +1,167 @@
+import os
+import re
+import time
+import functools
+import discord
+from discord.ext import commands
+from dotenv import load_dotenv
+import logging
+import pesukarhu.telemetry
+
+class MessageDispatch(commands.Cog):
+    '''
+    Single on_message listener shared by all cogs. Each message is filtered
+    and normalized once, then handed to the handlers whose channel / type /
+    predicate filters match it, with per-handler timing.
+    '''
+    class ParsedMessage():
+        '''
+        Message plus the normalized forms handlers care about. content is
+        lowercased, normalized has non-alphanumerics stripped, words is
+        normalized split on whitespace. Each is worked out the first time a
+        handler asks for it, so one that only needs the message doesn't pay
+        for the others.
+        '''
+        remove_non_alphanumeric = re.compile(r'([^\s\w]|_)+')
+
+        def __init__(self, message):
+            self.message = message
+
+        @classmethod
+        def normalize(cls, content):
+            return cls.remove_non_alphanumeric.sub('', content)
+
+        @functools.cached_property
+        def content(self):
+            return self.message.content.lower()
+
+        @functools.cached_property
+        def normalized(self):
+            return self.normalize(self.content)
+
+        @functools.cached_property
+        def words(self):
+            return self.normalized.split()
+
+    class Subscription():
+        '''
+        A handler and the filters deciding which messages reach it.
+        channel_ids only needs to support "in", so a cog can pass a live
+        dict/set it keeps up to date itself.
+        '''
+        def __init__(self, handler, name, channel_ids, channel_types, predicate):
+            self.handler = handler
+            self.name = name
+            self.channel_ids = channel_ids
+            self.channel_types = channel_types
+            self.predicate = predicate
+            self.count = 0
+            self.total_time = 0.0
+            self.max_time = 0.0
+
+        def matches_channel(self, channel):
+            if((self.channel_ids is not None) and (channel.id not in self.channel_ids)):
+                return False
+            if((self.channel_types is not None) and (not isinstance(channel, self.channel_types))):
+                return False
+            return True
+
+        def record(self, elapsed):
+            self.count += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    def __init__(self, bot):
+        self.bot = bot
+        load_dotenv()
+        self.guild = int(os.getenv('PESUKARHU_GUILD'))
+        self.admin_role_id = int(os.getenv('PESUKARHU_ADMIN_ROLE'))
+        self.slow_handler_time = float(os.getenv('PESUKARHU_SLOW_HANDLER_TIME', '1.0'))
+        self.subscriptions = []
+        logging.info(f'Initializing MessageDispatch:')
+        logging.info(f'   slow handler time = {self.slow_handler_time} (sec)')
+
+    def subscribe(self, handler, name=None, channel_ids=None, channel_types=None, predicate=None):
+        '''
+        handler is a coroutine function taking a ParsedMessage. predicate, if
+        given, is a plain function taking a ParsedMessage.
+        '''
+        if name is None:
+            name = handler.__qualname__
+        logging.info(f'Subscribed message handler: {name}')
+        subscription = self.Subscription(handler, name, channel_ids, channel_types, predicate)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, handler):
+        self.subscriptions = [subscription for subscription in self.subscriptions if subscription.handler != handler]
+
+    async def run_handler(self, subscription, parsed):
+        start = time.perf_counter()
+        try:
+            await subscription.handler(parsed)
+        except Exception:
+            logging.exception(f'Message handler {subscription.name} failed')
+        finally:
+            elapsed = time.perf_counter() - start
+            subscription.record(elapsed)
+            pesukarhu.telemetry.record(self.bot, f'message.{subscription.name}', elapsed)
+            if(elapsed > self.slow_handler_time):
+                logging.warning(f'Slow message handler {subscription.name}: {elapsed:.3f}s')
+
+    @commands.Cog.listener()
+    @pesukarhu.telemetry.timed()
+    async def on_message(self, message):
+        if message.author.bot:
+            # don't respond to myself or other bots
+            return
+
+        # Only parse once a handler actually wants this channel
+        parsed = None
+        for subscription in self.subscriptions:
+            if not subscription.matches_channel(message.channel):
+                continue
+            if parsed is None:
+                parsed = self.ParsedMessage(message)
+            if((subscription.predicate is not None) and (not subscription.predicate(parsed))):
+                continue
+            # Run each handler as its own task, like separate listeners would,
+            # so a slow handler doesn't hold up the others
+            self.bot.loop.create_task(self.run_handler(subscription, parsed))
+
+    def get_embed(self):
+        embed=discord.Embed(title=f'Message handlers: ({len(self.subscriptions)} subscribed)')
+        if(len(self.subscriptions) == 0):
+            embed.add_field(name="Handlers", value="Empty", inline=False)
+        for subscription in self.subscriptions:
+            if(subscription.count == 0):
+                value = 'No messages handled'
+            else:
+                average = subscription.total_time / subscription.count
+                value = f'{subscription.count} messages, avg {average * 1000:.1f}ms, max {subscription.max_time * 1000:.1f}ms, total {subscription.total_time:.1f}s'
+            embed.add_field(name=subscription.name, value=value, inline=False)
+        return embed
+
+    @commands.command()
+    async def dispatch_stats(self, ctx):
+        await ctx.send(embed=self.get_embed())
+
+    async def cog_check(self, ctx):
+        # Check if user has admin role
+        guild = self.bot.get_guild(self.guild)
+        admin_role = guild.get_role(self.admin_role_id)
+        return admin_role in ctx.author.roles
+
+def get_dispatcher(bot):
+    '''
+    Returns the bot's MessageDispatch cog, adding it if this is the first
+    cog asking for it
+    '''
+    dispatcher = bot.get_cog('MessageDispatch')
+    if dispatcher is None:
+        dispatcher = MessageDispatch(bot)
+        bot.add_cog(dispatcher)
+    return dispatcher
+
+def setup(bot):
+    get_dispatcher(bot)
@@ -0,0 +1,132 @@
+import os
+import asyncio
+import discord
+import pytimeparse.timeparse
+from dotenv import load_dotenv
+import logging
+
+class RowCache():
+    '''
+    Rendered listing rows by record ID. render(id) returns a row as a tuple
+    of strings, one per column; a row is rendered on first use and kept
+    until invalidate(id), which the owner calls whenever that record
+    changes. Showing a listing again only renders the records that changed.
+    '''
+    def __init__(self, render):
+        self.render = render
+        self.rows = {}
+        self.rendered = 0
+
+    def get(self, id):
+        row = self.rows.get(id)
+        if row is None:
+            row = self.render(id)
+            self.rows[id] = row
+            self.rendered += 1
+        return row
+
+    def invalidate(self, id):
+        self.rows.pop(id, None)
+
+class PagedView():
+    '''
+    A listing too long for one embed, shown a page at a time with reactions
+    to flip through it. ids is a snapshot of the records listed, in order,
+    columns the embed field names and rows their RowCache. A page's embed
+    is kept until one of its rows is invalidated. Only whoever ran the
+    command can turn the pages, for PESUKARHU_VIEW_TIMEOUT seconds.
+    '''
+    previous_emoji = '◀️'
+    next_emoji = '▶️'
+
+    def __init__(self, title, columns, ids, rows, description=None):
+        load_dotenv()
+        # Rows are kept short enough that a page stays under Discord's 1024
+        # characters per field
+        self.page_size = min(25, max(1, int(os.getenv('PESUKARHU_VIEW_PAGE_SIZE', '15'))))
+        self.timeout = float(os.getenv('PESUKARHU_VIEW_TIMEOUT', '300.0'))
+        self.title = title
+        self.columns = columns
+        self.ids = ids
+        self.rows = rows
+        self.description = description
+        self.pages = {}
+
+    def page_count(self):
+        return max(1, (len(self.ids) + self.page_size - 1) // self.page_size)
+
+    def get_embed(self, page):
+        ids = self.ids[page * self.page_size:(page + 1) * self.page_size]
+        rows = tuple(self.rows.get(id) for id in ids)
+        cached = self.pages.get(page)
+        # Unchanged rows are the same cached objects, so this is identity checks
+        if((cached is not None) and (cached[0] == rows)):
+            return cached[1]
+        embed=discord.Embed(title=self.title)
+        if self.description is not None:
+            embed.description = self.description
+        for idx, column in enumerate(self.columns):
+            value = '\n'.join(row[idx] for row in rows) if len(rows) > 0 else 'Empty'
+            embed.add_field(name=column, value=value[:1024], inline=True)
+        embed.set_footer(text=f'Page {page+1}/{self.page_count()}')
+        self.pages[page] = (rows, embed)
+        return embed
+
+    async def show(self, ctx):
+        page = 0
+        message = await ctx.send(embed=self.get_embed(page))
+        if(self.page_count() == 1):
+            return
+        for emoji in (self.previous_emoji, self.next_emoji):
+            await message.add_reaction(emoji)
+
+        # Presses are queued by a listener rather than a wait_for, so one
+        # made while the page is being edited isn't lost
+        presses = asyncio.Queue()
+
+        async def on_raw_reaction_add(payload):
+            if((payload.message_id == message.id) and (payload.user_id == ctx.author.id) and
+               (payload.emoji.name in (self.previous_emoji, self.next_emoji))):
+                presses.put_nowait(payload)
+
+        ctx.bot.add_listener(on_raw_reaction_add)
+        try:
+            while True:
+                try:
+                    payload = await asyncio.wait_for(presses.get(), self.timeout)
+                except asyncio.TimeoutError:
+                    break
+                step = -1 if payload.emoji.name == self.previous_emoji else 1
+                page = (page + step) % self.page_count()
+                await message.edit(embed=self.get_embed(page))
+                try:
+                    # Ready for the next press; without Manage Messages they'll
+                    # have to unreact first
+                    await message.remove_reaction(payload.emoji, discord.Object(payload.user_id))
+                except discord.HTTPException:
+                    pass
+        finally:
+            ctx.bot.remove_listener(on_raw_reaction_add)
+        try:
+            await message.clear_reactions()
+        except discord.HTTPException:
+            logging.info(f'Could not clear page reactions from {message.id}')
+
+def parse_filters(filters, states):
+    '''
+    Splits listing command arguments into a state, one of states (matched
+    by lowercase name), and a maximum age in seconds like 10m or 2h.
+    Returns (state, max_age) with None for either one not given, or None
+    if an argument is neither.
+    '''
+    state = None
+    max_age = None
+    for string in filters:
+        if string.lower() in states:
+            state = states[string.lower()]
+            continue
+        age = pytimeparse.timeparse.timeparse(string)
+        if age is None:
+            return None
+        max_age = age
+    return state, max_age
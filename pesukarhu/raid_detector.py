@@ -0,0 +1,108 @@
+import collections
+import logging
+
+class RaidDetector():
+    '''
+    Sliding-window join rate detector. Keeps one deque of join timestamps per
+    (window, threshold) pair, so recording a join and evicting old ones is
+    amortized O(1) per window no matter how large the member list is.
+
+    A raid episode starts when any window reaches its threshold and only ends
+    once every window has dropped to clear_ratio of its threshold, so a join
+    rate hovering around the threshold raises one alert instead of one per
+    join.
+    '''
+    def __init__(self, windows, clear_ratio=0.5):
+        # windows is a list of (window length in seconds, join threshold)
+        self.windows = sorted(windows)
+        self.clear_ratio = clear_ratio
+        self.joins = [collections.deque() for window in self.windows]
+        self.active = False
+        self.episode_start = None
+        self.episode_joins = 0
+        for window, threshold in self.windows:
+            logging.info(f'   raid window = {threshold} joins per {window} (sec)')
+        logging.info(f'   raid clear ratio = {self.clear_ratio}')
+
+    @staticmethod
+    def parse_windows(string):
+        '''
+        Parses "window:threshold,window:threshold" (eg "10:10,300:50")
+        '''
+        windows = []
+        if string is None:
+            return windows
+        for entry in string.split(','):
+            entry = entry.strip()
+            if(entry == ''):
+                continue
+            window, threshold = entry.split(':')
+            windows.append((float(window), int(threshold)))
+        return windows
+
+    def evict(self, current_time):
+        for (window, threshold), joins in zip(self.windows, self.joins):
+            cutoff = current_time - window
+            while(joins and joins[0] <= cutoff):
+                joins.popleft()
+
+    def over_threshold(self):
+        return any(len(joins) >= threshold for (window, threshold), joins in zip(self.windows, self.joins))
+
+    def below_clear_level(self):
+        return all(len(joins) <= threshold * self.clear_ratio for (window, threshold), joins in zip(self.windows, self.joins))
+
+    def record_join(self, current_time):
+        '''
+        Records a join; returns (started, ended). started is True only for
+        the join that starts a new raid episode, ended is True if the rates
+        had already dropped far enough to end the last one (see update).
+        Both can be True when a new episode starts straight after.
+        '''
+        ended = self.update(current_time)
+        for joins in self.joins:
+            joins.append(current_time)
+        if self.active:
+            self.episode_joins += 1
+            return False, ended
+        if self.over_threshold():
+            self.active = True
+            self.episode_start = current_time
+            self.episode_joins = 1
+            return True, ended
+        return False, ended
+
+    def update(self, current_time):
+        '''
+        Evicts expired joins; returns True if this ended a raid episode
+        '''
+        self.evict(current_time)
+        if(self.active and self.below_clear_level()):
+            self.active = False
+            return True
+        return False
+
+    def set_windows(self, windows, clear_ratio, current_time):
+        '''
+        Changes the windows in place, eg after a settings reload. Every
+        window is refilled from the longest join history kept so far, and a
+        raid in progress stays in progress.
+        '''
+        history = max(self.joins, key=len) if self.joins else collections.deque()
+        self.windows = sorted(windows)
+        self.clear_ratio = clear_ratio
+        self.joins = [collections.deque(history) for window in self.windows]
+        self.evict(current_time)
+        for window, threshold in self.windows:
+            logging.info(f'   raid window = {threshold} joins per {window} (sec)')
+        logging.info(f'   raid clear ratio = {self.clear_ratio}')
+
+    def get_rates(self, current_time):
+        '''
+        Returns (window, joins inside window, threshold) for every window
+        '''
+        self.evict(current_time)
+        return [(window, len(joins), threshold) for (window, threshold), joins in zip(self.windows, self.joins)]
+
+    def describe(self, current_time):
+        return ', '.join(f'{count}/{threshold} in {window:.0f}s' for window, count, threshold in self.get_rates(current_time))
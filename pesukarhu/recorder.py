@@ -0,0 +1,245 @@
+import os
+import re
+import gzip
+import json
+import string
+import hashlib
+from discord.ext import commands
+from discord.ext import tasks
+from dotenv import load_dotenv
+import logging
+import pesukarhu.clock
+import pesukarhu.extensions
+
+# Role and channel settings recorded by name rather than (anonymized) ID, so
+# a replay can map them onto its own guild
+ROLE_SETTINGS = (
+    ('PESUKARHU_ADMIN_ROLE', 'admin'),
+    ('PESUKARHU_VERIFIED_ROLE_ID', 'verified'),
+    ('PESUKARHU_UNVERIFIED_ROLE_ID', 'unverified'),
+    ('PESUKARHU_WARNING_ROLE_ID', 'warning'),
+    ('PESUKARHU_RAID_QUARANTINE_ROLE_ID', 'quarantine'),
+)
+CHANNEL_SETTINGS = (
+    ('PESUKARHU_LOG_CHANNEL', 'log'),
+    ('PESUKARHU_WARNING_CHANNEL', 'warning'),
+)
+HEADER = 'pesukarhu-recording'
+VERSION = 1
+
+class EventRecorder(commands.Cog):
+    '''
+    Records the gateway events the cogs handle to PESUKARHU_RECORD_FILE,
+    one compact JSON array per line, for replaying offline with
+    benchmarks/run.py replay. Lines are buffered and appended by an
+    executor every PESUKARHU_RECORD_FLUSH_PERIOD seconds; a path ending in
+    .gz is written as gzip members, which read back as one stream.
+
+    The file starts with [HEADER, VERSION, start epoch] and every event is
+    [seconds since start, kind, ...]:
+
+        ["m", channel, author, content]          message in a guild channel
+        ["m", "ticket", author, content, owner]  message in owner's intro ticket
+        ["j", member, roles]                     member joined
+        ["r", member]                            member left, was kicked or banned
+        ["u", member, roles before, roles after] member's roles changed
+        ["a", member, message, emoji]            reaction added
+
+    Members, channels and messages are keyed hashes of their IDs (keyed by
+    PESUKARHU_RECORD_SALT, random per run if unset). The configured roles
+    and channels and the intro message are recorded by name instead, other
+    roles not at all. PESUKARHU_RECORD_CONTENT is shape (default) or none:
+    shape keeps each word's length and repeated letters but substitutes
+    the letters with a permutation keyed by the word, digits and other
+    letters become 0, and words with raccoon in them are kept as raccoon.
+    Bots and direct messages aren't recorded.
+    '''
+    word_pattern = re.compile(r'[^\s\w]|_')
+
+    def __init__(self, bot):
+        self.bot = bot
+        load_dotenv()
+        self.path = os.getenv('PESUKARHU_RECORD_FILE')
+        self.content_mode = os.getenv('PESUKARHU_RECORD_CONTENT', 'shape')
+        self.flush_period = float(os.getenv('PESUKARHU_RECORD_FLUSH_PERIOD', '1.0'))
+        self.guild = int(os.getenv('PESUKARHU_GUILD'))
+        self.roles = self.read_ids(ROLE_SETTINGS)
+        self.channels = self.read_ids(CHANNEL_SETTINGS)
+        self.clock = pesukarhu.clock.get_clock(bot)
+        logging.info(f'Initializing EventRecorder:')
+        logging.info(f'   file = "{self.path}"')
+        logging.info(f'   content = {self.content_mode}')
+        logging.info(f'   flush period = {self.flush_period} (sec)')
+        self.lines = []
+        handover = pesukarhu.extensions.take_over(bot, 'EventRecorder')
+        if handover is None:
+            salt = os.getenv('PESUKARHU_RECORD_SALT', '')
+            # blake2b keys are at most 64 bytes
+            self.salt = hashlib.blake2b(salt.encode()).digest() if salt != '' else os.urandom(32)
+            self.start_time = self.clock.monotonic()
+            self.recorded = 0
+            self.lines.append([HEADER, VERSION, round(self.clock.time(), 3)])
+        else:
+            # Reloaded; same salt and time base, so the file stays one recording
+            for name, value in handover.items():
+                setattr(self, name, value)
+        self.writer.change_interval(seconds=self.flush_period)
+        self.writer.start()
+
+    @staticmethod
+    def read_ids(settings):
+        ids = {}
+        for variable, name in settings:
+            value = os.getenv(variable, '').strip()
+            if value.isdigit():
+                ids[int(value)] = name
+        return ids
+
+    def cog_unload(self):
+        self.writer.cancel()
+        # Whatever is still buffered, written here and now
+        self.append(self.take_lines())
+
+    def export_state(self):
+        return {
+            'salt': self.salt,
+            'start_time': self.start_time,
+            'recorded': self.recorded,
+        }
+
+    def anonymize(self, id):
+        digest = hashlib.blake2b(id.to_bytes(8, 'little'), key=self.salt, digest_size=8).digest()
+        # 63 bits, so it stays a positive int64 for anything reading the file
+        return int.from_bytes(digest, 'little') >> 1
+
+    def get_roles(self, member):
+        return sorted(self.roles[role.id] for role in member.roles if role.id in self.roles)
+
+    def get_channel(self, id):
+        return self.channels.get(id) or self.anonymize(id)
+
+    def shape_word(self, word):
+        if 'raccoon' in word:
+            return 'raccoon'
+        digest = hashlib.blake2b(word.encode(), key=self.salt, digest_size=32).digest()
+        pool = list(string.ascii_lowercase)
+        letters = {}
+        shaped = []
+        for char in word:
+            if((char < 'a') or (char > 'z')):
+                shaped.append('0')
+                continue
+            letter = letters.get(char)
+            if letter is None:
+                # At most 26 distinct letters, so the digest doesn't run out
+                letter = letters[char] = pool.pop(digest[len(letters)] % len(pool))
+            shaped.append(letter)
+        return ''.join(shaped)
+
+    def shape(self, content):
+        if(self.content_mode == 'none'):
+            return ''
+        words = self.word_pattern.sub('', content.lower()).split()
+        return ' '.join(self.shape_word(word) for word in words)
+
+    def record(self, kind, *fields):
+        self.lines.append([round(self.clock.monotonic() - self.start_time, 3), kind, *fields])
+        self.recorded += 1
+
+    def take_lines(self):
+        lines = self.lines
+        self.lines = []
+        return lines
+
+    def append(self, lines):
+        if(len(lines) == 0):
+            return
+        text = ''.join(json.dumps(line, ensure_ascii=False, separators=(',', ':')) + '\n' for line in lines)
+        if self.path.endswith('.gz'):
+            with gzip.open(self.path, 'at', encoding='utf-8') as stream:
+                stream.write(text)
+        else:
+            with open(self.path, 'a', encoding='utf-8') as stream:
+                stream.write(text)
+
+    @tasks.loop(seconds=1.0) # interval set from PESUKARHU_RECORD_FLUSH_PERIOD
+    async def writer(self):
+        lines = self.take_lines()
+        if(len(lines) > 0):
+            await self.bot.loop.run_in_executor(None, self.append, lines)
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if((message.guild is None) or (message.guild.id != self.guild) or message.author.bot):
+            return
+        intro_bot = self.bot.get_cog('IntroBot')
+        owner = intro_bot.log.get_channel_owner(message.channel.id) if intro_bot is not None else None
+        if owner is not None:
+            self.record('m', 'ticket', self.anonymize(message.author.id), self.shape(message.content), self.anonymize(owner))
+        else:
+            self.record('m', self.get_channel(message.channel.id), self.anonymize(message.author.id), self.shape(message.content))
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        if((member.guild.id != self.guild) or member.bot):
+            return
+        self.record('j', self.anonymize(member.id), self.get_roles(member))
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        if((member.guild.id != self.guild) or member.bot):
+            return
+        self.record('r', self.anonymize(member.id))
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if((after.guild.id != self.guild) or after.bot):
+            return
+        before_roles = self.get_roles(before)
+        after_roles = self.get_roles(after)
+        # Nickname, avatar and unconfigured role changes aren't handled by anything
+        if(before_roles != after_roles):
+            self.record('u', self.anonymize(after.id), before_roles, after_roles)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        if((payload.guild_id != self.guild) or ((payload.member is not None) and payload.member.bot)):
+            return
+        intro_bot = self.bot.get_cog('IntroBot')
+        if((intro_bot is not None) and (payload.message_id == intro_bot.state.intro_id)):
+            message = 'intro'
+        else:
+            message = self.anonymize(payload.message_id)
+        self.record('a', self.anonymize(payload.user_id), message, payload.emoji.name)
+
+    def get_metrics(self):
+        return {
+            'recorded_events': self.recorded,
+            'record_buffer': len(self.lines),
+        }
+
+def read_recording(path):
+    '''
+    Yields the events of a recording as (seconds, kind, fields). Recordings
+    appended to across restarts have a header per run; their events are
+    placed after each other by the headers' start times.
+    '''
+    opener = gzip.open if path.endswith('.gz') else open
+    first_start = None
+    offset = 0.0
+    with opener(path, 'rt', encoding='utf-8') as stream:
+        for line in stream:
+            if(line.strip() == ''):
+                continue
+            event = json.loads(line)
+            if(event[0] == HEADER):
+                if(event[1] != VERSION):
+                    raise ValueError(f'{path}: recording version {event[1]}, expected {VERSION}')
+                if first_start is None:
+                    first_start = event[2]
+                offset = event[2] - first_start
+                continue
+            yield event[0] + offset, event[1], event[2:]
+
+def setup(bot):
+    bot.add_cog(EventRecorder(bot))
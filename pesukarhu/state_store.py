@@ -0,0 +1,170 @@
+import os
+import json
+import queue
+import sqlite3
+import threading
+from dotenv import load_dotenv
+import logging
+
+class StateStore():
+    '''
+    SQLite (WAL mode) persistence for bot state that has to survive a
+    restart: plain values like ticket counters, and records (monitored
+    members, pending verifications) stored as JSON by kind and ID.
+
+    Everything is read once at startup. Writes are queued and applied by a
+    background thread in batched transactions, so the event loop never
+    waits on the disk. Until a write is committed it is also kept in
+    unwritten, which reads are patched with, so a cog reloaded with writes
+    still queued reads what its predecessor wrote without waiting for them.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.writes = queue.Queue()
+        self.batch_size = 500
+        self.no_payload = object()
+        self.deleted = object()
+        self.lock = threading.Lock()
+        self.unwritten = {} # ('kv', key) or (kind, id) -> (write number, value or deleted)
+        self.write_count = 0
+        self.failed_writes = 0
+        logging.info(f'Initializing StateStore:')
+        logging.info(f'   path = {self.path}')
+        connection = self.connect()
+        connection.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS records (kind TEXT, id INTEGER, record TEXT, PRIMARY KEY (kind, id))')
+        connection.commit()
+        connection.close()
+        self.thread = threading.Thread(target=self.writer, name='pesukarhu-state-store', daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def execute(self, connection, write):
+        target, number, sql, params, payload = write
+        if payload is not self.no_payload:
+            params = params + (json.dumps(payload),)
+        connection.execute(sql, params)
+
+    def written(self, write):
+        # Committed or given up on; reads go to the database again unless a
+        # newer write to the same target is still queued
+        target, number = write[0], write[1]
+        with self.lock:
+            entry = self.unwritten.get(target)
+            if((entry is not None) and (entry[0] == number)):
+                del self.unwritten[target]
+
+    def writer(self):
+        connection = self.connect()
+        while True:
+            write = self.writes.get()
+            batch = [write]
+            # Drain whatever else is queued into the same transaction
+            while((len(batch) < self.batch_size) and (not self.writes.empty())):
+                batch.append(self.writes.get_nowait())
+            stop = None in batch
+            writes = [write for write in batch if write is not None]
+            try:
+                for write in writes:
+                    self.execute(connection, write)
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                # One bad write mustn't take the rest of the batch with it;
+                # redo it a write per transaction and drop only the failures
+                logging.warning(f'Failed to write {len(writes)} state changes in one transaction, writing them one by one')
+                for write in writes:
+                    try:
+                        self.execute(connection, write)
+                        connection.commit()
+                    except Exception:
+                        connection.rollback()
+                        self.failed_writes += 1
+                        logging.exception(f'Failed to write state change {write[0]}')
+            for write in writes:
+                self.written(write)
+            for write in batch:
+                self.writes.task_done()
+            if stop:
+                connection.close()
+                return
+
+    def queue_write(self, target, sql, params, payload):
+        with self.lock:
+            self.write_count += 1
+            self.unwritten[target] = (self.write_count, self.deleted if payload is self.no_payload else payload)
+        self.writes.put((target, self.write_count, sql, params, payload))
+
+    def get_unwritten(self, match):
+        # Queued writes to the targets match() accepts, taken before the
+        # database is read: anything committed after that is still in here
+        with self.lock:
+            return {target: value for target, (number, value) in self.unwritten.items() if match(target)}
+
+    def set_value(self, key, value):
+        self.queue_write(('kv', key), 'INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key,), value)
+
+    def get_value(self, key, default=None):
+        unwritten = self.get_unwritten(lambda target: target == ('kv', key))
+        if(len(unwritten) > 0):
+            return unwritten[('kv', key)]
+        connection = self.connect()
+        row = connection.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        connection.close()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def save(self, kind, id, record):
+        '''
+        record has to be a snapshot (eg a fresh dict); it is serialized on
+        the writer thread
+        '''
+        self.queue_write((kind, id), 'INSERT OR REPLACE INTO records (kind, id, record) VALUES (?, ?, ?)', (kind, id), record)
+
+    def delete(self, kind, id):
+        self.queue_write((kind, id), 'DELETE FROM records WHERE kind = ? AND id = ?', (kind, id), self.no_payload)
+
+    def load(self, kind):
+        '''
+        Returns all records of a kind as a dict of ID to record
+        '''
+        unwritten = self.get_unwritten(lambda target: target[0] == kind)
+        connection = self.connect()
+        rows = connection.execute('SELECT id, record FROM records WHERE kind = ?', (kind,)).fetchall()
+        connection.close()
+        records = {id: json.loads(record) for id, record in rows}
+        for (kind, id), record in unwritten.items():
+            if record is self.deleted:
+                records.pop(id, None)
+            else:
+                records[id] = record
+        return records
+
+    def get_metrics(self):
+        return {
+            'state_writes_queued': self.writes.qsize(),
+            'state_writes_unwritten': len(self.unwritten),
+            'state_writes_failed': self.failed_writes,
+        }
+
+    def close(self):
+        self.writes.put(None)
+        self.thread.join()
+
+def get_state_store(bot):
+    '''
+    Returns the bot's StateStore, opening it if this is the first cog
+    asking for it
+    '''
+    store = getattr(bot, 'pesukarhu_state_store', None)
+    if store is None:
+        load_dotenv()
+        store = StateStore(os.getenv('PESUKARHU_STATE_DB', 'pesukarhu_state.db'))
+        bot.pesukarhu_state_store = store
+    return store
@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import time
+import queue
+import datetime
+import threading
+import logging
+import logging.handlers
+from dotenv import load_dotenv
+
+class EventLimiter(logging.Filter):
+    '''
+    Per event sampling and rate limiting, applied before a record is
+    queued. Records are grouped by their event field (logging extra, eg
+    extra={'event': 'join', 'member': id}); records without one always
+    pass. samples keeps that fraction of an event's records, rate_limits
+    is a token bucket per event of that many records per second (bursting
+    to one second's worth). Audit events are never dropped. The next record
+    of an event that gets through carries the number dropped before it as
+    its suppressed field.
+    '''
+    def __init__(self, samples, rate_limits, audit_events):
+        super().__init__()
+        self.samples = samples
+        self.rate_limits = rate_limits
+        self.audit_events = audit_events
+        self.tokens = {}
+        self.last_time = {}
+        self.sample_counts = {}
+        self.suppressed = {}
+        self.dropped = 0
+        # Handlers filter under their own lock, but the limiter can be shared
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def parse(string, convert):
+        '''
+        Parses "event:value,event:value" (eg "neat_word:0.1,join:0.5")
+        '''
+        values = {}
+        for entry in (string or '').split(','):
+            entry = entry.strip()
+            if(entry == ''):
+                continue
+            event, value = entry.split(':')
+            values[event.strip()] = convert(value)
+        return values
+
+    def sampled(self, event):
+        # Deterministic: keeps every nth record instead of rolling dice
+        fraction = self.samples.get(event)
+        if fraction is None:
+            return True
+        count = self.sample_counts.get(event, 0) + 1
+        self.sample_counts[event] = count
+        return int(count * fraction) != int((count - 1) * fraction)
+
+    def allowed(self, event):
+        rate = self.rate_limits.get(event)
+        if rate is None:
+            return True
+        current_time = time.monotonic()
+        tokens = self.tokens.get(event, rate)
+        tokens = min(rate, tokens + (current_time - self.last_time.get(event, current_time)) * rate)
+        self.last_time[event] = current_time
+        if(tokens < 1.0):
+            self.tokens[event] = tokens
+            return False
+        self.tokens[event] = tokens - 1.0
+        return True
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if((event is None) or (event in self.audit_events)):
+            return True
+        with self.lock:
+            if((not self.sampled(event)) or (not self.allowed(event))):
+                self.suppressed[event] = self.suppressed.get(event, 0) + 1
+                self.dropped += 1
+                return False
+            suppressed = self.suppressed.pop(event, 0)
+        if(suppressed > 0):
+            record.suppressed = suppressed
+        return True
+
+class JsonFormatter(logging.Formatter):
+    '''
+    One JSON object per line: time, level, module, function, message and
+    whichever of event, member, channel and suppressed the record has
+    '''
+    fields = ('event', 'member', 'channel', 'suppressed')
+
+    def format(self, record):
+        line = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'module': record.module,
+            'function': record.funcName,
+            'message': record.getMessage(),
+        }
+        for field in self.fields:
+            value = getattr(record, field, None)
+            if value is not None:
+                line[field] = value
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+        return json.dumps(line, ensure_ascii=False)
+
+class TextFormatter(logging.Formatter):
+    '''
+    The classic format, noting how many records of the event were dropped
+    before this one
+    '''
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', None)
+        if suppressed is not None:
+            text += f' ({suppressed} more {record.event} suppressed)'
+        return text
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Queues records for the listener thread without formatting them first,
+    so the caller only pays for the filter and a put. A full queue drops
+    the record, except for audit events, which wait for room.
+    '''
+    def __init__(self, queue, audit_events):
+        super().__init__(queue)
+        self.audit_events = audit_events
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Records aren't touched after they're logged, and the formatter on
+        # the other side needs msg, args and exc_info as they are
+        return record
+
+    def enqueue(self, record):
+        if(getattr(record, 'event', None) in self.audit_events):
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging(level=logging.INFO):
+    '''
+    Sends the root logger through a queue to a background thread that
+    formats and writes the records, so logging on the event loop costs a
+    queue put. PESUKARHU_LOG_FORMAT picks text (default) or json lines,
+    PESUKARHU_LOG_FILE a file instead of stderr. PESUKARHU_LOG_SAMPLE and
+    PESUKARHU_LOG_RATE_LIMITS thin out busy events (see EventLimiter);
+    PESUKARHU_LOG_AUDIT_EVENTS are always written. Returns the listener;
+    stop() it on exit to flush what's queued.
+    '''
+    load_dotenv()
+    log_format = os.getenv('PESUKARHU_LOG_FORMAT', 'text')
+    log_file = os.getenv('PESUKARHU_LOG_FILE', '')
+    queue_size = int(os.getenv('PESUKARHU_LOG_QUEUE_SIZE', '10000'))
+    samples = EventLimiter.parse(os.getenv('PESUKARHU_LOG_SAMPLE', ''), float)
+    rate_limits = EventLimiter.parse(os.getenv('PESUKARHU_LOG_RATE_LIMITS', ''), float)
+    audit_events = set(event.strip() for event in os.getenv('PESUKARHU_LOG_AUDIT_EVENTS', 'kick,ban').split(',') if event.strip() != '')
+    if(log_file != ''):
+        output = logging.FileHandler(log_file)
+    else:
+        output = logging.StreamHandler(sys.stderr)
+    if(log_format == 'json'):
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(TextFormatter('%(asctime)s %(levelname)s {%(module)s} [%(funcName)s] %(message)s', datefmt='%Y%m%d|%H:%M:%S'))
+    records = queue.Queue(queue_size)
+    handler = BackgroundQueueHandler(records, audit_events)
+    handler.addFilter(EventLimiter(samples, rate_limits, audit_events))
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    logging.info(f'Logging through background thread:')
+    logging.info(f'   format = {log_format}')
+    logging.info(f'   file = "{log_file}"')
+    logging.info(f'   queue size = {queue_size}')
+    logging.info(f'   sample = {samples}')
+    logging.info(f'   rate limits = {rate_limits} (records/sec)')
+    logging.info(f'   audit events = {sorted(audit_events)}')
+    return listener
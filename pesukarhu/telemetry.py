@@ -0,0 +1,311 @@
+import os
+import time
+import json
+import bisect
+import asyncio
+import functools
+import discord
+from discord.ext import commands
+from discord.ext import tasks
+from dotenv import load_dotenv
+import logging
+import pesukarhu.extensions
+
+class Histogram():
+    '''
+    Fixed exponential buckets from 0.1ms to ~52s. Recording is a bisect and
+    an increment, so it's cheap enough for every event; percentiles are
+    read back as the upper bound of the bucket they fall in.
+    '''
+    bounds = [0.0001 * (2 ** idx) for idx in range(20)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if(seconds > self.max):
+            self.max = seconds
+
+    def percentile(self, fraction):
+        if(self.count == 0):
+            return 0.0
+        target = fraction * self.count
+        cumulative = 0
+        for idx, count in enumerate(self.counts):
+            cumulative += count
+            if(cumulative >= target):
+                return self.bounds[idx] if idx < len(self.bounds) else self.max
+        return self.max
+
+class RateLimitCounter(logging.Handler):
+    '''
+    discord.py retries 429s inside its HTTP client and only tells anyone by
+    logging; count those log records
+    '''
+    def __init__(self, telemetry):
+        super().__init__(level=logging.WARNING)
+        self.telemetry = telemetry
+
+    def emit(self, record):
+        if 'rate limited' in record.getMessage():
+            self.telemetry.rate_limited += 1
+
+class Telemetry(commands.Cog):
+    '''
+    Runtime performance numbers: latency histograms per listener, message
+    handler and command, outbound API call and 429 counts, event loop lag,
+    and sizes reported by the other cogs' get_metrics(). Shown by $perf and
+    optionally written to PESUKARHU_METRICS_FILE (.json, anything else gets
+    Prometheus text format) every PESUKARHU_METRICS_PERIOD seconds.
+
+    Has to be added before the other cogs; with it absent every hook below
+    is a no-op.
+    '''
+    bucket_labels = [f'{bound:g}' for bound in Histogram.bounds] + ['+Inf']
+
+    def __init__(self, bot):
+        self.bot = bot
+        load_dotenv()
+        self.guild = int(os.getenv('PESUKARHU_GUILD'))
+        self.admin_role_id = int(os.getenv('PESUKARHU_ADMIN_ROLE'))
+        self.loop_lag_interval = float(os.getenv('PESUKARHU_LOOP_LAG_INTERVAL', '0.5'))
+        self.metrics_file = os.getenv('PESUKARHU_METRICS_FILE', '')
+        self.metrics_period = float(os.getenv('PESUKARHU_METRICS_PERIOD', '15.0'))
+        logging.info(f'Initializing Telemetry:')
+        logging.info(f'   loop lag interval = {self.loop_lag_interval} (sec)')
+        logging.info(f'   metrics file = "{self.metrics_file}"')
+        logging.info(f'   metrics period = {self.metrics_period} (sec)')
+        handover = pesukarhu.extensions.take_over(bot, 'Telemetry')
+        if handover is None:
+            self.start_time = time.monotonic()
+            self.histograms = {}
+            self.loop_lag = Histogram()
+            self.api_calls = {}
+            self.rate_limited = 0
+        else:
+            # Reloaded; keep counting from where the old cog was
+            for name, value in handover.items():
+                setattr(self, name, value)
+        bot.pesukarhu_telemetry = self
+        # Count every REST call by route
+        self.http_request = bot.http.request
+        bot.http.request = self.counted_request
+        self.rate_limit_counter = RateLimitCounter(self)
+        logging.getLogger('discord.http').addHandler(self.rate_limit_counter)
+        # Commands are timed by the bot wide after invoke hook, which runs
+        # whether the command finished or raised. An on_command_error
+        # listener would stop discord.py printing the errors itself
+        bot.after_invoke(after_command)
+        self.loop_lag_monitor.start()
+        if(self.metrics_file != ''):
+            self.metrics_export.change_interval(seconds=self.metrics_period)
+            self.metrics_export.start()
+
+    def cog_unload(self):
+        self.loop_lag_monitor.cancel()
+        self.metrics_export.cancel()
+        self.bot.http.request = self.http_request
+        logging.getLogger('discord.http').removeHandler(self.rate_limit_counter)
+        self.bot.pesukarhu_telemetry = None
+
+    def export_state(self):
+        return {
+            'start_time': self.start_time,
+            'histograms': self.histograms,
+            'loop_lag': self.loop_lag,
+            'api_calls': self.api_calls,
+            'rate_limited': self.rate_limited,
+        }
+
+    async def counted_request(self, route, **kwargs):
+        key = f'{route.method} {route.path}'
+        self.api_calls[key] = self.api_calls.get(key, 0) + 1
+        return await self.http_request(route, **kwargs)
+
+    def record(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.record(seconds)
+
+    @tasks.loop(seconds=0) # paced by its own sleep
+    async def loop_lag_monitor(self):
+        # How late this sleep wakes up is how long the loop was busy
+        start = time.perf_counter()
+        await asyncio.sleep(self.loop_lag_interval)
+        self.loop_lag.record(max(0.0, time.perf_counter() - start - self.loop_lag_interval))
+
+    @commands.Cog.listener()
+    async def on_command(self, ctx):
+        ctx.pesukarhu_start = time.perf_counter()
+
+    def record_command(self, ctx):
+        start = getattr(ctx, 'pesukarhu_start', None)
+        if((start is not None) and (ctx.command is not None)):
+            self.record(f'command.{ctx.command.qualified_name}', time.perf_counter() - start)
+
+    def get_gauges(self):
+        gauges = {}
+        for cog in self.bot.cogs.values():
+            get_metrics = getattr(cog, 'get_metrics', None)
+            if get_metrics is not None:
+                gauges.update(get_metrics())
+        # The state store isn't a cog
+        store = getattr(self.bot, 'pesukarhu_state_store', None)
+        if store is not None:
+            gauges.update(store.get_metrics())
+        return gauges
+
+    def snapshot(self):
+        return {
+            'uptime_seconds': time.monotonic() - self.start_time,
+            'latency': {name: {
+                            'count': histogram.count,
+                            'sum_seconds': histogram.sum,
+                            'p50_seconds': histogram.percentile(0.50),
+                            'p99_seconds': histogram.percentile(0.99),
+                            'max_seconds': histogram.max,
+                        } for name, histogram in sorted(self.histograms.items())},
+            'loop_lag': {
+                'p50_seconds': self.loop_lag.percentile(0.50),
+                'p99_seconds': self.loop_lag.percentile(0.99),
+                'max_seconds': self.loop_lag.max,
+            },
+            'api_calls': dict(sorted(self.api_calls.items())),
+            'rate_limited': self.rate_limited,
+            'gauges': self.get_gauges(),
+        }
+
+    def prometheus_histogram(self, lines, metric, labels, histogram):
+        cumulative = 0
+        for bound, count in zip(self.bucket_labels, histogram.counts):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        # Plain labels for _sum/_count, without the trailing comma le follows
+        labels = '' if labels == '' else f'{{{labels.rstrip(",")}}}'
+        lines.append(f'{metric}_sum{labels} {histogram.sum}')
+        lines.append(f'{metric}_count{labels} {histogram.count}')
+
+    def prometheus(self):
+        lines = ['# TYPE pesukarhu_handler_seconds histogram']
+        for name, histogram in sorted(self.histograms.items()):
+            self.prometheus_histogram(lines, 'pesukarhu_handler_seconds', f'handler="{name}",', histogram)
+        lines.append('# TYPE pesukarhu_event_loop_lag_seconds histogram')
+        self.prometheus_histogram(lines, 'pesukarhu_event_loop_lag_seconds', '', self.loop_lag)
+        lines.append('# TYPE pesukarhu_api_calls_total counter')
+        for route, count in sorted(self.api_calls.items()):
+            lines.append(f'pesukarhu_api_calls_total{{route="{route}"}} {count}')
+        lines.append('# TYPE pesukarhu_rate_limited_total counter')
+        lines.append(f'pesukarhu_rate_limited_total {self.rate_limited}')
+        for name, value in sorted(self.get_gauges().items()):
+            lines.append(f'# TYPE pesukarhu_{name} gauge')
+            lines.append(f'pesukarhu_{name} {float(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def write_metrics(self, text):
+        # Runs in a worker thread; write then rename so scrapers never see
+        # half a file
+        temporary = f'{self.metrics_file}.tmp'
+        with open(temporary, 'w') as stream:
+            stream.write(text)
+        os.replace(temporary, self.metrics_file)
+
+    @tasks.loop(seconds=15) # default value is overridden prior to execution
+    async def metrics_export(self):
+        if self.metrics_file.endswith('.json'):
+            text = json.dumps(self.snapshot(), indent=1)
+        else:
+            text = self.prometheus()
+        await self.bot.loop.run_in_executor(None, self.write_metrics, text)
+
+    def get_embed(self):
+        snapshot = self.snapshot()
+        embed=discord.Embed(title=f'Performance (up {snapshot["uptime_seconds"] / 3600:.1f}h)')
+        # Slowest first, by p99
+        latency = sorted(snapshot['latency'].items(), key=lambda item: item[1]['p99_seconds'], reverse=True)
+        latency_string = ''
+        for name, stats in latency:
+            new_line = f'{name}: {stats["count"]}x, p50 {stats["p50_seconds"] * 1000:.1f}ms, p99 {stats["p99_seconds"] * 1000:.1f}ms, max {stats["max_seconds"] * 1000:.0f}ms\n'
+            if(len(latency_string) + len(new_line) > 1000):
+                break
+            latency_string += new_line
+        embed.add_field(name="Latency", value=latency_string if latency_string != '' else 'Empty', inline=False)
+        lag = snapshot['loop_lag']
+        embed.add_field(name="Event loop lag", value=f'p50 {lag["p50_seconds"] * 1000:.1f}ms, p99 {lag["p99_seconds"] * 1000:.1f}ms, max {lag["max_seconds"] * 1000:.0f}ms', inline=False)
+        api_calls = sorted(snapshot['api_calls'].items(), key=lambda item: item[1], reverse=True)
+        api_string = ''.join(f'{route}: {count}\n' for route, count in api_calls[:10])
+        embed.add_field(name=f'API calls ({sum(snapshot["api_calls"].values())}, {snapshot["rate_limited"]} rate limited)', value=api_string if api_string != '' else 'None', inline=False)
+        gauge_string = ''.join(f'{name}: {value}\n' for name, value in sorted(snapshot['gauges'].items()))
+        embed.add_field(name="Sizes", value=gauge_string if gauge_string != '' else 'None', inline=False)
+        return embed
+
+    @commands.command()
+    async def perf(self, ctx):
+        await ctx.send(embed=self.get_embed())
+
+    async def cog_check(self, ctx):
+        # Check if user has admin role
+        guild = self.bot.get_guild(self.guild)
+        admin_role = guild.get_role(self.admin_role_id)
+        return admin_role in ctx.author.roles
+
+def get_telemetry(bot):
+    '''
+    Returns the bot's Telemetry cog, or None if telemetry is disabled
+    '''
+    return getattr(bot, 'pesukarhu_telemetry', None)
+
+async def after_command(ctx):
+    telemetry = get_telemetry(ctx.bot)
+    if telemetry is not None:
+        telemetry.record_command(ctx)
+
+def record(bot, name, seconds):
+    telemetry = get_telemetry(bot)
+    if telemetry is not None:
+        telemetry.record(name, seconds)
+
+class measure():
+    '''
+    Context manager timing a block of synchronous code into a histogram
+    '''
+    def __init__(self, bot, name):
+        self.bot = bot
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        record(self.bot, self.name, time.perf_counter() - self.start)
+        return False
+
+def timed(name=None):
+    '''
+    Decorator timing a cog coroutine method (listener or otherwise) into a
+    histogram named Cog.method unless name is given. Goes under
+    @commands.Cog.listener().
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(self, *args, **kwargs):
+            telemetry = get_telemetry(self.bot)
+            if telemetry is None:
+                return await function(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await function(self, *args, **kwargs)
+            finally:
+                telemetry.record(name if name is not None else f'{type(self).__name__}.{function.__name__}', time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def setup(bot):
+    bot.add_cog(Telemetry(bot))
@@ -0,0 +1,196 @@
+import os
+import asyncio
+import collections
+import discord
+from dotenv import load_dotenv
+import logging
+import pesukarhu.clock
+
+class TicketPool():
+    '''
+    Verification ticket channels created ahead of time, so a reaction only
+    has to add the member to a ready channel instead of creating one and
+    setting its permissions one target at a time. Channels are created with
+    their @everyone / verifier overwrites in a single call, one at a time by
+    a background refill that keeps about as many ready as were claimed in
+    the last PESUKARHU_TICKET_POOL_WINDOW seconds (between
+    PESUKARHU_TICKET_POOL_MIN and PESUKARHU_TICKET_POOL_MAX). When the pool
+    runs dry, claims queue up and get the next channel the refill creates,
+    with the member's overwrite included.
+    '''
+    member_permissions = {
+        'send_messages': True,
+        'read_messages': True,
+        'add_reactions': True,
+        'embed_links': True,
+        'attach_files': True,
+        'read_message_history': True,
+        'external_emojis': True,
+    }
+
+    def __init__(self, bot, settings, state, store):
+        self.bot = bot
+        self.clock = pesukarhu.clock.get_clock(bot)
+        self.settings = settings
+        self.state = state
+        self.store = store
+        load_dotenv()
+        self.min_size = int(os.getenv('PESUKARHU_TICKET_POOL_MIN', '2'))
+        self.max_size = int(os.getenv('PESUKARHU_TICKET_POOL_MAX', '20'))
+        self.window = float(os.getenv('PESUKARHU_TICKET_POOL_WINDOW', '600.0'))
+        logging.info(f'Initializing TicketPool:')
+        logging.info(f'   min size = {self.min_size}')
+        logging.info(f'   max size = {self.max_size}')
+        logging.info(f'   window = {self.window} (sec)')
+        # Ready channel IDs, oldest first; survives restarts so the pool
+        # isn't created again on every start
+        self.ready = collections.deque(store.get_value('intro_ticket_pool') or [])
+        self.claims = collections.deque() # monotonic times of recent claims
+        self.waiters = collections.deque() # (future, member) for claims made while empty
+        self.refill_task = None
+        self.created = 0
+        self.claimed_ready = 0
+        self.claimed_waiting = 0
+        self.released = 0
+        logging.info(f'   restored {len(self.ready)} ready channels')
+
+    def save(self):
+        # Queued for the store's writer thread, doesn't block
+        self.store.set_value('intro_ticket_pool', list(self.ready))
+
+    def get_target_size(self, current_time):
+        while((len(self.claims) > 0) and (self.claims[0] <= current_time - self.window)):
+            self.claims.popleft()
+        return min(self.max_size, max(self.min_size, len(self.claims)))
+
+    def get_overwrites(self, guild, member=None):
+        overwrites = {
+            guild.get_role(guild.id): discord.PermissionOverwrite(send_messages=False, read_messages=False),
+            guild.get_role(self.settings.verifier_role): discord.PermissionOverwrite(**self.member_permissions),
+        }
+        if member is not None:
+            overwrites[member] = discord.PermissionOverwrite(**self.member_permissions)
+        return overwrites
+
+    async def create_channel(self, guild, member=None):
+        name = f'verify-{self.state.ticket_count}'
+        self.state.ticket_count += 1
+        self.state.store()
+        channel = await guild.create_text_channel(name, overwrites=self.get_overwrites(guild, member),
+                                                  reason='Verification ticket')
+        self.created += 1
+        return channel
+
+    async def claim(self, guild, member):
+        '''
+        Returns a ticket channel member can use
+        '''
+        self.claims.append(self.clock.monotonic())
+        channel = None
+        while((channel is None) and (len(self.ready) > 0)):
+            # Skip channels somebody deleted while they sat in the pool
+            channel = guild.get_channel(self.ready.popleft())
+        self.save()
+        if channel is None:
+            future = self.bot.loop.create_future()
+            self.waiters.append((future, member))
+            self.refill_soon()
+            channel = await future
+            self.claimed_waiting += 1
+            return channel
+        self.refill_soon()
+        try:
+            await channel.set_permissions(member, **self.member_permissions)
+        except discord.NotFound:
+            # Deleted under us, nothing to give back
+            raise
+        except discord.HTTPException:
+            # The member wasn't added, so the channel is still good for the
+            # next claim
+            self.ready.appendleft(channel.id)
+            self.save()
+            raise
+        except asyncio.CancelledError:
+            # The overwrite may have gone through; nobody else gets it
+            self.bot.loop.create_task(self.release(channel.id))
+            raise
+        self.claimed_ready += 1
+        return channel
+
+    def rebind(self, settings, state):
+        # Handed over to a reloaded IntroBot
+        self.settings = settings
+        self.state = state
+
+    def refill_soon(self):
+        if((self.refill_task is None) or self.refill_task.done()):
+            self.refill_task = self.bot.loop.create_task(self.refill())
+
+    async def refill(self):
+        await self.bot.wait_until_ready()
+        guild = self.bot.get_guild(self.settings.guild)
+        self.ready = collections.deque(id for id in self.ready if guild.get_channel(id) is not None)
+        self.save()
+        while True:
+            # Waiting claims first, they have somebody staring at them
+            while((len(self.waiters) > 0) and self.waiters[0][0].done()):
+                self.waiters.popleft()
+            if(len(self.waiters) > 0):
+                future, member = self.waiters[0]
+            elif(len(self.ready) < self.get_target_size(self.clock.monotonic())):
+                future, member = None, None
+            else:
+                return
+            try:
+                channel = await self.create_channel(guild, member)
+            except discord.HTTPException as e:
+                logging.warning(f'Could not create ticket channel: {e}')
+                for future, member in self.waiters:
+                    if not future.done():
+                        future.set_exception(e)
+                self.waiters.clear()
+                return
+            if((future is not None) and (not future.done())):
+                self.waiters.popleft()
+                future.set_result(channel)
+                continue
+            if future is not None:
+                # Claim went away while we were creating; take the member
+                # back off before pooling the channel for somebody else
+                try:
+                    await channel.set_permissions(member, overwrite=None)
+                except discord.HTTPException as e:
+                    logging.warning(f'Could not reset ticket channel {channel.id}: {e}')
+                    continue
+            self.ready.append(channel.id)
+            self.save()
+
+    async def resolve(self, guild, channel_id):
+        return guild.get_channel(channel_id)
+
+    async def release(self, channel_id):
+        '''
+        Deletes a ticket channel that is no longer needed; channels count
+        against the guild's channel cap
+        '''
+        await self.bot.wait_until_ready()
+        guild = self.bot.get_guild(self.settings.guild)
+        channel = await self.resolve(guild, channel_id)
+        if channel is None:
+            return
+        await channel.delete(reason='Verification ticket finished')
+        self.released += 1
+        logging.info(f'Deleted ticket channel {channel_id}')
+
+    def cancel(self):
+        if self.refill_task is not None:
+            self.refill_task.cancel()
+
+    def get_metrics(self):
+        return {
+            'intro_pool_ready': len(self.ready),
+            'intro_pool_target': self.get_target_size(self.clock.monotonic()),
+            'intro_pool_waiting': len(self.waiters),
+            'intro_pool_created': self.created,
+            'intro_tickets_released': self.released,
+        }
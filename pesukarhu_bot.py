@@ -2,22 +2,37 @@
 # bot.py
 import os
 import logging
-import discord
-from discord.ext import tasks
 from discord.ext import commands
-import pesukarhu.member_monitor
-import pesukarhu.emoji_replace
-import pesukarhu.intro_bot
+import pesukarhu.state_store
+import pesukarhu.gateway
+import pesukarhu.structured_logging
 
 from dotenv import load_dotenv
 
 load_dotenv()
 token = os.getenv('PESUKARHU_TOKEN')
 
-intents = discord.Intents.all()
-logging.basicConfig(format='%(asctime)s %(levelname)s {%(module)s} [%(funcName)s] %(message)s', datefmt='%Y%m%d|%H:%M:%S', level=logging.INFO)
-bot = commands.Bot(command_prefix="$", intents=intents)
-#bot.add_cog(pesukarhu.member_monitor.MemberMonitor(bot))
-bot.add_cog(pesukarhu.emoji_replace.EmojiReplace(bot))
-bot.add_cog(pesukarhu.intro_bot.IntroBot(bot))
-bot.run(token)
\ No newline at end of file
+# Records are formatted and written on a background thread
+log_listener = pesukarhu.structured_logging.setup_logging(logging.INFO)
+# Intents and member caching come from PESUKARHU_GATEWAY_PROFILE (full or lean)
+bot = commands.Bot(command_prefix="$", **pesukarhu.gateway.get_bot_options(pesukarhu.gateway.get_profile()))
+# Cogs are extensions so $reload can swap their code in a running bot
+# Telemetry goes first so the other cogs' hooks find it
+if(os.getenv('PESUKARHU_TELEMETRY', '1') == '1'):
+    bot.load_extension('pesukarhu.telemetry')
+# Gateway events the cogs handle, anonymized, for replaying offline
+if(os.getenv('PESUKARHU_RECORD_FILE', '') != ''):
+    bot.load_extension('pesukarhu.recorder')
+# Shared message pipeline the other cogs subscribe to
+bot.load_extension('pesukarhu.message_dispatch')
+# Outbound executor for moderation and log calls
+bot.load_extension('pesukarhu.action_queue')
+#bot.load_extension('pesukarhu.member_monitor')
+bot.load_extension('pesukarhu.emoji_replace')
+bot.load_extension('pesukarhu.intro_bot')
+# $reload and the file watcher; last, so it knows the load order
+bot.load_extension('pesukarhu.extensions')
+bot.run(token)
+# Let the writer thread finish queued state changes before exiting
+pesukarhu.state_store.get_state_store(bot).close()
+log_listener.stop()
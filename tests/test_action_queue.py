@@ -0,0 +1,113 @@
+import os
+import asyncio
+import types
+import unittest
+import unittest.mock
+import discord
+from pesukarhu.clock import VirtualClock
+from pesukarhu.action_queue import ActionQueue
+
+def server_error():
+    return discord.HTTPException(types.SimpleNamespace(status=500, reason='Internal Server Error'), 'failed')
+
+class ActionQueueTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.clock = VirtualClock(0)
+        bot = types.SimpleNamespace(loop=asyncio.get_running_loop(), pesukarhu_clock=self.clock)
+        env = {
+            'PESUKARHU_GUILD': '1',
+            'PESUKARHU_ADMIN_ROLE': '2',
+            'PESUKARHU_ACTION_WORKERS': '4',
+            'PESUKARHU_ACTION_BUCKET_CONCURRENCY': '1',
+            'PESUKARHU_ACTION_MAX_RETRIES': '2',
+            'PESUKARHU_ACTION_RETRY_DELAY': '1.0',
+        }
+        with unittest.mock.patch.dict(os.environ, env):
+            self.actions = ActionQueue(bot)
+
+    async def asyncTearDown(self):
+        self.actions.cog_unload()
+        await self.clock.settle()
+
+    async def test_duplicate_key_is_not_queued_again(self):
+        calls = []
+        release = asyncio.Event()
+        async def kick():
+            calls.append(self.clock.time())
+            await release.wait()
+            return 'kicked'
+        first = self.actions.submit(kick, ActionQueue.Priority.MODERATION, ('kick', 1), key=(5, 'kick'))
+        await self.clock.settle()
+        # Still running, so the same key shares the first future
+        second = self.actions.submit(kick, ActionQueue.Priority.MODERATION, ('kick', 1), key=(5, 'kick'))
+        self.assertIs(first, second)
+        self.assertEqual(self.actions.deduplicated, 1)
+        release.set()
+        self.assertEqual(await first, 'kicked')
+        self.assertEqual(len(calls), 1)
+        # Finished, so the key can be used again
+        third = self.actions.submit(kick, ActionQueue.Priority.MODERATION, ('kick', 1), key=(5, 'kick'))
+        self.assertIsNot(first, third)
+        self.assertEqual(await third, 'kicked')
+        self.assertEqual(len(calls), 2)
+
+    async def test_retry_backs_off_exponentially(self):
+        attempts = []
+        async def flaky():
+            attempts.append(self.clock.time())
+            if(len(attempts) < 3):
+                raise server_error()
+            return 'done'
+        future = self.actions.submit(flaky, ActionQueue.Priority.ROLE, ('roles', 1))
+        await self.clock.settle()
+        self.assertEqual(attempts, [0])
+        await self.clock.advance(10)
+        self.assertEqual(attempts, [0, 1, 3])
+        self.assertEqual(await future, 'done')
+        self.assertEqual(self.actions.retried, 2)
+        self.assertEqual(self.actions.completed, 1)
+
+    async def test_gives_up_after_max_retries(self):
+        attempts = []
+        async def broken():
+            attempts.append(self.clock.time())
+            raise server_error()
+        future = self.actions.submit(broken, ActionQueue.Priority.ROLE, ('roles', 1), key=(5, 'roles'))
+        await self.clock.advance(60)
+        self.assertEqual(len(attempts), 3)
+        with self.assertRaises(discord.HTTPException):
+            await future
+        self.assertEqual(self.actions.failed, 1)
+        self.assertNotIn((5, 'roles'), self.actions.pending)
+
+    async def test_forbidden_is_not_retried(self):
+        attempts = []
+        async def forbidden():
+            attempts.append(self.clock.time())
+            raise discord.Forbidden(types.SimpleNamespace(status=403, reason='Forbidden'), 'missing permissions')
+        future = self.actions.submit(forbidden, ActionQueue.Priority.MODERATION, ('kick', 1))
+        await self.clock.advance(60)
+        self.assertEqual(len(attempts), 1)
+        with self.assertRaises(discord.Forbidden):
+            await future
+
+    async def test_full_bucket_parks_without_blocking_others(self):
+        release = asyncio.Event()
+        order = []
+        async def slow():
+            await release.wait()
+            order.append('slow')
+        async def fast(name):
+            order.append(name)
+        self.actions.submit(slow, ActionQueue.Priority.MODERATION, ('kick', 1))
+        parked = self.actions.submit(lambda: fast('same bucket'), ActionQueue.Priority.MODERATION, ('kick', 1))
+        other = self.actions.submit(lambda: fast('other bucket'), ActionQueue.Priority.LOG, ('channel', 2))
+        await other
+        self.assertEqual(order, ['other bucket'])
+        self.assertEqual(self.actions.get_metrics()['actions_parked'], 1)
+        release.set()
+        await parked
+        self.assertEqual(order, ['other bucket', 'slow', 'same bucket'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import asyncio
+import unittest
+from pesukarhu.clock import VirtualClock
+from pesukarhu.deadline_index import DeadlineIndex
+
+class DeadlineIndexTest(unittest.TestCase):
+    def test_pop_due_earliest_first(self):
+        index = DeadlineIndex()
+        index.schedule('c', 30)
+        index.schedule('a', 10)
+        index.schedule('b', 20)
+        self.assertEqual(index.pop_due(5), [])
+        self.assertEqual(index.pop_due(20), ['a', 'b'])
+        self.assertEqual(len(index), 1)
+        self.assertNotIn('a', index)
+        self.assertEqual(index.next_deadline(), 30)
+
+    def test_rescheduled_key_leaves_stale_entry(self):
+        index = DeadlineIndex()
+        index.schedule('a', 10)
+        index.schedule('a', 50)
+        # The old entry is still in the heap but must not fire
+        self.assertEqual(len(index.heap), 2)
+        self.assertEqual(index.pop_due(10), [])
+        self.assertEqual(index.next_deadline(), 50)
+        self.assertEqual(index.pop_due(50), ['a'])
+        self.assertEqual(index.heap, [])
+
+    def test_reschedule_earlier(self):
+        index = DeadlineIndex()
+        index.schedule('a', 50)
+        index.schedule('a', 10)
+        self.assertEqual(index.get('a'), 10)
+        self.assertEqual(index.pop_due(10), ['a'])
+        self.assertEqual(index.pop_due(50), [])
+
+    def test_cancel_and_none(self):
+        index = DeadlineIndex()
+        index.schedule('a', 10)
+        index.schedule('b', 10)
+        index.cancel('a')
+        index.schedule('b', None)
+        self.assertEqual(len(index), 0)
+        self.assertIsNone(index.next_deadline())
+        self.assertEqual(index.pop_due(100), [])
+
+    def test_compacts_stale_entries(self):
+        index = DeadlineIndex()
+        for deadline in range(1000):
+            index.schedule('a', deadline)
+        self.assertLess(len(index.heap), 100)
+        self.assertEqual(index.pop_due(998), [])
+        self.assertEqual(index.pop_due(999), ['a'])
+
+class DeadlineIndexWaitTest(unittest.IsolatedAsyncioTestCase):
+    async def test_wait_wakes_on_earlier_deadline(self):
+        clock = VirtualClock(0)
+        index = DeadlineIndex(clock)
+        index.schedule('late', 100)
+        waiter = asyncio.ensure_future(index.wait(clock.time(), 60))
+        await clock.settle()
+        self.assertFalse(waiter.done())
+        index.schedule('early', 5)
+        await clock.settle()
+        self.assertTrue(waiter.done())
+        self.assertEqual(clock.time(), 0)
+
+    async def test_wait_times_out_at_earliest_deadline(self):
+        clock = VirtualClock(0)
+        index = DeadlineIndex(clock)
+        index.schedule('a', 10)
+        waiter = asyncio.ensure_future(index.wait(clock.time(), 60))
+        await clock.advance(9)
+        self.assertFalse(waiter.done())
+        await clock.advance(1)
+        self.assertTrue(waiter.done())
+        self.assertEqual(index.pop_due(clock.time()), ['a'])
+
+if __name__ == '__main__':
+    unittest.main()
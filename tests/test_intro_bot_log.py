@@ -0,0 +1,104 @@
+import os
+import types
+import tempfile
+import unittest
+import unittest.mock
+from pesukarhu.clock import VirtualClock
+from pesukarhu.state_store import StateStore
+from pesukarhu.intro_bot import IntroBot
+
+class IntroBotLogTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.workdir.name, 'state.db')
+        self.store = StateStore(self.path)
+        self.clock = VirtualClock(1000)
+        self.bot = types.SimpleNamespace(pesukarhu_clock=self.clock)
+        self.settings = types.SimpleNamespace(timeout_offset=86400)
+        self.released = []
+        self.env = unittest.mock.patch.dict(os.environ, {
+            'PESUKARHU_INTRO_RETENTION_TIME': '600',
+            'PESUKARHU_INTRO_MAX_FINISHED': '2',
+            'PESUKARHU_INTRO_EXPIRE_TICKETS': '0',
+        })
+        self.env.start()
+        self.log = self.new_log()
+
+    def tearDown(self):
+        self.env.stop()
+        self.store.close()
+        self.workdir.cleanup()
+
+    def new_log(self):
+        return IntroBot.Log(self.bot, self.settings, self.store, self.released.append)
+
+    def finish(self, id, channel):
+        self.log.add_user(id, f'member{id}', channel)
+        self.log.add_question(id, 'question')
+        self.log.record_response(id, 'answer')
+        self.log.finish_user(id)
+
+    def test_channel_index(self):
+        self.log.add_user(1, 'a', 100)
+        self.log.add_user(2, 'b', 200)
+        self.assertEqual(self.log.get_channel_owner(100), 1)
+        self.assertEqual(self.log.get_channel_owner(200), 2)
+        self.assertIsNone(self.log.get_channel_owner(300))
+        # A new ticket for the same member takes the old one out of the index
+        self.log.add_user(1, 'a', 101)
+        self.assertIsNone(self.log.get_channel_owner(100))
+        self.assertEqual(self.log.get_channel_owner(101), 1)
+        self.assertEqual(self.released, [100])
+        self.log.remove_user(2)
+        self.assertIsNone(self.log.get_channel_owner(200))
+        self.assertEqual(self.released, [100, 200])
+
+    def test_channel_index_restored(self):
+        self.log.add_user(1, 'a', 100)
+        self.finish(2, 200)
+        log = self.new_log()
+        self.assertEqual(log.get_channel_owner(100), 1)
+        self.assertEqual(log.get_channel_owner(200), 2)
+        self.assertEqual(list(log.finished), [2])
+
+    def test_trim_drops_oldest_finished(self):
+        self.log.add_user(9, 'open', 900)
+        for id in range(1, 4):
+            self.finish(id, id * 100)
+            self.clock.now += 10
+        # Capped at two finished; open tickets don't count
+        self.assertEqual(list(self.log.finished), [2, 3])
+        self.assertNotIn(1, self.log.log)
+        self.assertIsNone(self.log.get_channel_owner(100))
+        self.assertEqual(self.released, [100])
+        self.assertIn(9, self.log.log)
+        self.assertEqual(sorted(self.store.load('intro_member')), [2, 3, 9])
+
+    def test_finished_expire_after_retention(self):
+        self.finish(1, 100)
+        self.log.add_user(2, 'b', 200)
+        self.assertEqual(self.log.pop_due(self.clock.time() + 599), [])
+        # Unfinished tickets don't expire unless expiry is turned on
+        self.assertEqual(self.log.pop_due(self.clock.time() + 86400 * 7), [1])
+
+    def test_expiry_reminds_then_times_out(self):
+        with unittest.mock.patch.dict(os.environ, {'PESUKARHU_INTRO_EXPIRE_TICKETS': '1'}):
+            self.log.reload_settings()
+        start = self.clock.time()
+        self.log.add_user(1, 'a', 100)
+        self.assertEqual(self.log.pop_due(start + 86400 - 3601), [])
+        self.assertEqual(self.log.pop_due(start + 86400 - 3600), [1])
+        self.log.set_reminded(1)
+        self.assertEqual(self.log.pop_due(start + 86399), [])
+        self.assertEqual(self.log.pop_due(start + 86400), [1])
+
+    def test_expiry_refused_under_min_timeout(self):
+        self.settings.timeout_offset = 30
+        with unittest.mock.patch.dict(os.environ, {'PESUKARHU_INTRO_EXPIRE_TICKETS': '1'}):
+            self.log.reload_settings()
+        self.assertFalse(self.log.expire)
+        self.log.add_user(1, 'a', 100)
+        self.assertNotIn(1, self.log.deadlines)
+
+if __name__ == '__main__':
+    unittest.main()
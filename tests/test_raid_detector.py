@@ -0,0 +1,32 @@
+import unittest
+from pesukarhu.raid_detector import RaidDetector
+
+class RaidDetectorTest(unittest.TestCase):
+    def test_join_after_raid_cleared_ends_episode(self):
+        detector = RaidDetector([(10, 4)])
+        started = [detector.record_join(t)[0] for t in range(4)]
+        self.assertEqual(started, [False, False, False, True])
+        self.assertTrue(detector.active)
+        # The window has emptied by t=20; the join has to report the end
+        # since no later update() will
+        self.assertEqual(detector.record_join(20), (False, True))
+        self.assertFalse(detector.active)
+        self.assertFalse(detector.update(21))
+
+    def test_episode_ended_by_update(self):
+        detector = RaidDetector([(10, 4)])
+        for t in range(4):
+            detector.record_join(t)
+        self.assertFalse(detector.update(5))
+        self.assertTrue(detector.update(20))
+        self.assertFalse(detector.active)
+
+    def test_new_episode_straight_after_old_one(self):
+        detector = RaidDetector([(10, 1)])
+        self.assertEqual(detector.record_join(0), (True, False))
+        self.assertEqual(detector.record_join(20), (True, True))
+        self.assertTrue(detector.active)
+        self.assertEqual(detector.episode_start, 20)
+
+if __name__ == '__main__':
+    unittest.main()
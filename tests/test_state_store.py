@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+from pesukarhu.state_store import StateStore
+
+class StateStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.workdir.name, 'state.db')
+        self.store = StateStore(self.path)
+
+    def tearDown(self):
+        if self.store is not None:
+            self.store.close()
+        self.workdir.cleanup()
+
+    def reopen(self):
+        self.store.close()
+        self.store = StateStore(self.path)
+
+    def test_round_trip(self):
+        self.store.set_value('ticket_count', 7)
+        self.store.save('member', 1, {'name': 'a', 'times': [1, 2]})
+        self.store.save('member', 2, {'name': 'b', 'times': []})
+        self.store.save('other', 1, {'name': 'c'})
+        self.store.delete('member', 2)
+        # Right away, written or not
+        self.assertEqual(self.store.get_value('ticket_count'), 7)
+        self.assertEqual(self.store.load('member'), {1: {'name': 'a', 'times': [1, 2]}})
+        self.reopen()
+        self.assertEqual(self.store.get_value('ticket_count'), 7)
+        self.assertEqual(self.store.get_value('missing', 'default'), 'default')
+        self.assertEqual(self.store.load('member'), {1: {'name': 'a', 'times': [1, 2]}})
+        self.assertEqual(self.store.load('other'), {1: {'name': 'c'}})
+
+    def test_latest_write_wins(self):
+        for count in range(10):
+            self.store.set_value('ticket_count', count)
+            self.store.save('member', 1, {'count': count})
+        self.assertEqual(self.store.get_value('ticket_count'), 9)
+        self.reopen()
+        self.assertEqual(self.store.get_value('ticket_count'), 9)
+        self.assertEqual(self.store.load('member'), {1: {'count': 9}})
+
+    def test_close_drains_queued_writes(self):
+        for id in range(2000):
+            self.store.save('member', id, {'id': id})
+        self.store.close()
+        self.assertEqual(self.store.writes.qsize(), 0)
+        self.assertEqual(self.store.unwritten, {})
+        self.store = StateStore(self.path)
+        self.assertEqual(len(self.store.load('member')), 2000)
+
+    def test_failed_write_keeps_rest_of_batch(self):
+        self.store.save('member', 1, {'name': 'a'})
+        self.store.save('member', 2, {'name': object()}) # not JSON
+        self.store.save('member', 3, {'name': 'c'})
+        self.store.writes.join()
+        self.assertEqual(self.store.failed_writes, 1)
+        self.reopen()
+        self.assertEqual(self.store.load('member'), {1: {'name': 'a'}, 3: {'name': 'c'}})
+
+if __name__ == '__main__':
+    unittest.main()